@@ -0,0 +1,174 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Agenda-based best-first (A*) PCFG parsing: the Viterbi parse of S over the whole sentence
+without filling the CYK chart.
+
+Edges X[i,j] are popped in order of inside probability times an outside estimate and
+the search stops as soon as S[1,N] is popped. The estimate of X[i,j] is
+	spine[X] * product of bestLex[w] over the words outside i..j
+where spine[X] is the best product of binary rule probabilities on a path from S down
+to X and bestLex[w] the best probability of a rule generating w. Both are upper bounds
+of what the outside context can contribute, and the estimate is consistent: combining
+Y[i,s] with Z[s+1,j] through X -> Y Z never gives an edge a higher priority than Y or Z
+had, so an edge is final the first time it is popped and the result is the CYK parse.
+
+Floating-point rounding can break exact ties between derivations by one ulp either way,
+so the search goes on until the agenda drops TIE_SLACK below the goal, and an edge
+popped again with a better derivation is reopened. This keeps the tree identical to
+the one CYKParser picks among equally probable parses.
+'''
+import heapq
+
+from cyk_parser import CYKParser, RULES_FILE
+from metrics import METRICS
+
+TIE_SLACK = 1e-9
+
+
+class AStarParser(CYKParser):
+	'''
+	Same grammar, rule loading and tree output as CYKParser, only the chart is built
+	differently: P and BP hold the edges the search finalized, which include every edge
+	of the best parse. kBest only enumerates parses made of finalized edges.
+	'''
+	def __init__(self, rulesfile=RULES_FILE):
+		self.spine = None		# X id => best product of rule probabilities from S down to X
+		CYKParser.__init__(self, rulesfile=rulesfile)
+
+	def compileRules(self):
+		CYKParser.compileRules(self)
+		self.computeSpine()
+
+	def computeSpine(self):
+		M = len(self.symb2id)
+		spine = [0.0] * (M+1)
+		if 'S' in self.symb2id:
+			spine[self.symb2id['S']] = 1.0
+		# Relax X -> Y Z into Y and Z until nothing improves, probabilities are at most 1
+		# so the best paths are simple and this stops after at most M rounds
+		changed = True
+		while changed:
+			changed = False
+			for (Y, Z), rules in self.binaryRules.items():
+				for X, prob, r in rules:
+					p = spine[X] * prob
+					if p > spine[Y]:
+						spine[Y] = p
+						changed = True
+					if p > spine[Z]:
+						spine[Z] = p
+						changed = True
+		self.spine = spine
+
+	# @param sentence, a string to be parsed
+	# @param cancelToken, an optional workers.CancelToken checked every 1000 popped edges
+	# @param exhaustive, ignored, the search is always exact
+	# @return the words, P and BP, same as CYKParser.parseChart
+	def parseChart(self, sentence, cancelToken=None, exhaustive=False):
+		words = sentence.split()
+		N = len(words)
+		if N == 0 or 'S' not in self.symb2id:
+			return self.denseChart(words, [[None] * (N+1) for i in range(N+2)])
+		S_id = self.symb2id['S']
+		spine = self.spine
+		binaryRules = self.binaryRules
+
+		# outsideLex[i][j] = product of bestLex over the words outside i..j
+		bestLex = [max([p for X, p in self.lexicalRules.get(w, [])] or [0.0]) for w in words]
+		prefix = [1.0] * (N+2)
+		for i in range(1, N+1):
+			prefix[i] = prefix[i-1] * bestLex[i-1]
+		suffix = [1.0] * (N+2)
+		for j in range(N, 0, -1):
+			suffix[j] = suffix[j+1] * bestLex[j-1]
+
+		# An agenda entry is (-priority, span length, rule index, s, i, j, X, inside, Y, Z).
+		# On equal priority the shorter spans come first, so every derivation of an edge
+		# with that priority is on the agenda before the edge is popped, and among those
+		# the rule order and the split point break the tie the way CYKParser does.
+		agenda = []
+		for i in range(1, N+1):
+			for X, p in self.lexicalRules.get(words[i-1], []):
+				priority = p * spine[X] * prefix[i-1] * suffix[i+1]
+				if priority > 0.0:
+					agenda.append((-priority, 0, -1, -1, i, i, X, p, -1, -1))
+		heapq.heapify(agenda)
+
+		chart = [[None] * (N+1) for i in range(N+2)]	# chart[i][j] = {X: (inside, s, Y, Z, rule index)}
+		for i in range(1, N+1):
+			for j in range(i, N+1):
+				chart[i][j] = {}
+		byStart = [[] for i in range(N+2)]		# byStart[i] = finalized (j, X)
+		byEnd = [[] for i in range(N+2)]		# byEnd[j] = finalized (i, X)
+		stop = 0.0		# Set once the goal is popped
+		pops = 0
+		pushes = len(agenda)
+		with METRICS.timer('astar.search'):
+			while agenda and -agenda[0][0] >= stop:
+				negPriority, length, r, s, i, j, X, inside, Y, Z = heapq.heappop(agenda)
+				cell = chart[i][j]
+				old = cell.get(X)
+				if old is not None and not self.better(inside, r, s, old):
+					continue		# Already finalized with a better or equal derivation
+				cell[X] = (inside, s, Y, Z, r)
+				pops += 1
+				if cancelToken is not None and pops % 1000 == 0:
+					cancelToken.check()
+				if i == 1 and j == N and X == S_id:
+					stop = inside * (1.0 - TIE_SLACK)
+					continue
+				if old is None:
+					byStart[i].append((j, X))
+					byEnd[j].append((i, X))
+
+				# X[i,j] as the left child, with the finalized edges starting at j+1
+				for k, Z2 in byStart[j+1]:
+					rules = binaryRules.get((X, Z2))
+					if rules is None:
+						continue
+					pZ = chart[j+1][k][Z2][0]
+					outside = prefix[i-1] * suffix[k+1]
+					target = chart[i][k]
+					for X2, prob, r2 in rules:
+						p = prob * inside * pZ
+						priority = p * spine[X2] * outside
+						if priority > 0.0 and (X2 not in target or self.better(p, r2, j, target[X2])):
+							heapq.heappush(agenda, (-priority, k - i, r2, j, i, k, X2, p, X, Z2))
+							pushes += 1
+				# X[i,j] as the right child, with the finalized edges ending at i-1
+				for h, Y2 in byEnd[i-1]:
+					rules = binaryRules.get((Y2, X))
+					if rules is None:
+						continue
+					pY = chart[h][i-1][Y2][0]
+					outside = prefix[h-1] * suffix[j+1]
+					target = chart[h][j]
+					for X2, prob, r2 in rules:
+						p = prob * pY * inside
+						priority = p * spine[X2] * outside
+						if priority > 0.0 and (X2 not in target or self.better(p, r2, i-1, target[X2])):
+							heapq.heappush(agenda, (-priority, j - h, r2, i-1, h, j, X2, p, Y2, X))
+							pushes += 1
+
+		if METRICS.enabled:
+			METRICS.incr('astar.pops', pops)
+			METRICS.incr('astar.pushes', pushes)
+		return self.denseChart(words, chart)
+
+	# @param inside, r, s, a derivation of an edge
+	# @param old, the finalized (inside, s, Y, Z, rule index) of the same edge
+	# @return True if CYKParser would prefer the derivation
+	def better(self, inside, r, s, old):
+		return inside > old[0] or (inside == old[0] and (r, s) < (old[4], old[1]))
+
+
+def main():
+	sentence = 'fish people fish tanks'
+	parser = AStarParser()
+	parseString, prob = parser.parse(sentence)
+	print(parseString)
+	print(prob)
+
+if __name__ == '__main__':
+	main()
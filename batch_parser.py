@@ -0,0 +1,328 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Parse many sentences at once on all cores.
+
+The rules file is read and compiled once, in the parent process, into a read-only
+CompiledGrammar. Where worker processes are forked they inherit it with the rest of
+the parent's memory, elsewhere it is sent to each worker once. A CYK worker parses in
+a ChartBuffer grown to the longest sentence it was given, and only clears the cells
+the previous parse used, so no chart is allocated per sentence.
+
+	python batch_parser.py sentences.txt [cyk|topdown] [processes]
+
+	with BatchParser('cyk') as parser:
+		for result in parser.parseBatch(sentences):
+			print(result.tree, result.prob, result.seconds)
+
+Results come back in the order of the sentences, each with the time its parse took in
+the worker. The CYK trees and probabilities are those of CYKParser.parse.
+'''
+import array
+import concurrent.futures
+import itertools
+import multiprocessing
+import os
+import sys
+import time
+
+from metrics import METRICS
+from parse_tree import ParseTree
+
+DEFAULT_BATCH = 32			# Sentences sent to a worker per task
+DEFAULT_MAX_WORDS = 32		# Initial chart size, grown to the longest sentence seen
+
+_grammars = {}		# Key => grammar, registered by the parent before its workers fork
+_keys = itertools.count()
+_worker = None		# The ChartBuffer or TopDownWorker of a worker process, built by _initWorker
+
+
+class CompiledGrammar:
+	'''
+	The rule tables CYKParser.compileRules builds, copied into tuples and frozen:
+		symbols			symbol id => symbol, '#' at 0
+		lexical			word => ((X, prob), ...)
+		binary			(Y, Z) => ((X, prob, rule index), ...)
+		children		children[X][rule index] = (Y, Z), None for a lexical rule
+	Assigning an attribute after construction raises AttributeError.
+	'''
+	def __init__(self, parser):
+		self.symbols = tuple(parser.nonterminals)
+		self.M = len(self.symbols)
+		self.start = parser.symb2id.get('S', 0)
+		self.lexical = dict((w, tuple(rules)) for w, rules in parser.lexicalRules.items())
+		self.binary = dict((key, tuple(rules)) for key, rules in parser.binaryRules.items())
+		children = [()]
+		for X in range(1, self.M):
+			production = [None] * len(parser.rules[self.symbols[X]])
+			for r, Y, Z, p in parser.binaryByHead[X]:
+				production[r] = (Y, Z)
+			children.append(tuple(production))
+		self.children = tuple(children)
+		self.frozen = True
+
+	def __setattr__(self, name, value):
+		if getattr(self, 'frozen', False):
+			raise AttributeError('CompiledGrammar is read-only')
+		object.__setattr__(self, name, value)
+
+
+class ChartBuffer:
+	'''
+	A CYK chart kept between parses. Cell (i, j) holds the items of the words i..j, item X
+	of it is at ((i * width) + j) * M + X in the flat prob, split and rule arrays, and
+	items[(i * width) + j] lists the X with a non-zero probability, which is what a new
+	parse has to clear.
+	'''
+	def __init__(self, grammar, maxWords=DEFAULT_MAX_WORDS):
+		self.grammar = grammar
+		self.maxWords = 0
+		self.used = 0		# Length of the sentence whose items are still in the arrays
+		self.reserve(maxWords)
+
+	# @param n, number of words, the arrays are reallocated if they are too small for it
+	def reserve(self, n):
+		if n <= self.maxWords:
+			return
+		self.maxWords = max(n, 2 * self.maxWords)
+		self.width = self.maxWords + 2
+		size = self.width * self.width * self.grammar.M
+		self.prob = array.array('d', [0.0]) * size
+		self.split = array.array('i', [0]) * size
+		self.rule = array.array('i', [0]) * size
+		self.items = [[] for c in range(self.width * self.width)]
+		self.used = 0
+
+	def clear(self):
+		W = self.width
+		M = self.grammar.M
+		for i in range(1, self.used + 1):
+			for j in range(i, self.used + 1):
+				cell = self.items[i*W+j]
+				for X in cell:
+					self.prob[(i*W+j)*M+X] = 0.0
+				cell.clear()
+		self.used = 0
+
+	# @param words, a list of words
+	# @return a ParseTree, or None if the sentence has no parse, and its probability
+	def parse(self, words):
+		N = len(words)
+		self.reserve(N)
+		self.clear()
+		self.used = N
+		g = self.grammar
+		W = self.width
+		M = g.M
+		prob = self.prob
+		split = self.split
+		rule = self.rule
+		items = self.items
+		binary = g.binary
+
+		for i in range(1, N+1):
+			c = i*W+i
+			for X, p in g.lexical.get(words[i-1], ()):
+				if p > 0.0:
+					prob[c*M+X] = p
+					split[c*M+X] = -1
+					items[c].append(X)
+
+		# Same order and tie-breaking as CYKParser.fillChart: the best item of a cell is the
+		# most probable, then the one with the lowest (rule index, split point)
+		for _len in range(1, N):
+			for i in range(1, N-_len+1):
+				j = i + _len
+				cell = items[i*W+j]
+				base = (i*W+j)*M
+				for s in range(i, j):
+					leftItems = items[i*W+s]
+					rightItems = items[(s+1)*W+j]
+					if not leftItems or not rightItems:
+						continue
+					leftBase = (i*W+s)*M
+					rightBase = ((s+1)*W+j)*M
+					for Y in leftItems:
+						pY = prob[leftBase+Y]
+						for Z in rightItems:
+							rules = binary.get((Y, Z))
+							if rules is None:
+								continue
+							pZ = prob[rightBase+Z]
+							for X, pRule, r in rules:
+								p = pRule * pY * pZ
+								k = base + X
+								old = prob[k]
+								if old == 0.0:
+									if p > 0.0:
+										cell.append(X)
+									else:
+										continue
+								elif p < old or (p == old and (r, s) >= (rule[k], split[k])):
+									continue
+								prob[k] = p
+								split[k] = s
+								rule[k] = r
+
+		if N == 0 or g.start == 0 or prob[(W+N)*M+g.start] == 0.0:
+			return (None, 0.0)
+		return (self.buildTree(words), prob[(W+N)*M+g.start])
+
+	# @param words, the words of the last parse
+	# @return the ParseTree of S over all the words
+	def buildTree(self, words):
+		g = self.grammar
+		W = self.width
+		M = g.M
+		tree = ParseTree()
+		stack = [(1, len(words), g.start, -1)]
+		while stack:
+			beg, end, X, parent = stack.pop()
+			node = tree.add(g.symbols[X], parent)
+			k = (beg*W+end)*M+X
+			s = self.split[k]
+			if s == -1:
+				tree.add(words[beg-1], node)
+			else:
+				Y, Z = g.children[X][self.rule[k]]
+				stack.append((s+1, end, Z, node))
+				stack.append((beg, s, Y, node))
+		return tree
+
+
+class TopDownWorker:
+	'''
+	Gives a loaded TopDownParser the parse interface of ChartBuffer, the probability
+	is 1.0 when the sentence is derived from S.
+	'''
+	def __init__(self, parser):
+		self.parser = parser
+
+	def reserve(self, n):
+		pass
+
+	def parse(self, words):
+		tree = self.parser.parseTree(words)
+		return (tree, 1.0 if tree is not None else 0.0)
+
+
+class ParseResult:
+	def __init__(self, tree, prob, seconds):
+		self.tree = tree			# ParseTree or None
+		self.prob = prob
+		self.seconds = seconds		# Parse time in the worker
+
+	def __str__(self):
+		return self.tree.bracketed() if self.tree is not None else ''
+
+
+# @param algorithm, 'cyk' or 'topdown'
+# @param rulesfile, the rules file, or None for the parser's default
+# @return the compiled grammar of a CYKParser, or a loaded TopDownParser
+def compileGrammar(algorithm, rulesfile=None):
+	if algorithm == 'cyk':
+		from cyk_parser import CYKParser, RULES_FILE
+		return CompiledGrammar(CYKParser(rulesfile=rulesfile or RULES_FILE))
+	elif algorithm == 'topdown':
+		from top_down_parser import TopDownParser, RULES_FILE
+		parser = TopDownParser()
+		parser.loadRules(rulesfile or RULES_FILE)
+		return parser
+	raise ValueError('Unknown parsing algorithm: ' + algorithm)
+
+# @param grammar, returned by compileGrammar
+# @return an object with reserve(n) and parse(words) => (tree, prob)
+def createWorker(grammar, maxWords=DEFAULT_MAX_WORDS):
+	if isinstance(grammar, CompiledGrammar):
+		return ChartBuffer(grammar, maxWords)
+	return TopDownWorker(grammar)
+
+# @param worker, returned by createWorker
+# @param sentences, list of word lists
+# @return list of ParseResult
+def parseSentences(worker, sentences):
+	worker.reserve(max([len(words) for words in sentences] or [0]))
+	results = []
+	for words in sentences:
+		start = time.perf_counter()
+		tree, prob = worker.parse(words)
+		results.append(ParseResult(tree, prob, time.perf_counter() - start))
+	return results
+
+def _initWorker(key, grammar, maxWords):
+	global _worker
+	if grammar is None:
+		grammar = _grammars[key]		# Inherited through fork
+	_worker = createWorker(grammar, maxWords)
+
+def _parseBatch(sentences):
+	return parseSentences(_worker, sentences)
+
+
+class BatchParser:
+	'''
+	A process pool whose workers share one compiled grammar. processes=1 parses in this
+	process, with the same chart buffer for every call.
+	'''
+	def __init__(self, algorithm='cyk', rulesfile=None, processes=None, batch=DEFAULT_BATCH, maxWords=DEFAULT_MAX_WORDS):
+		self.algorithm = algorithm
+		self.grammar = compileGrammar(algorithm, rulesfile)
+		self.processes = processes or os.cpu_count() or 1
+		self.batch = batch
+		self.key = None
+		self.worker = None
+		self.executor = None
+		if self.processes == 1:
+			self.worker = createWorker(self.grammar, maxWords)
+		elif 'fork' in multiprocessing.get_all_start_methods():
+			self.key = next(_keys)
+			_grammars[self.key] = self.grammar
+			self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.processes,
+				mp_context=multiprocessing.get_context('fork'), initializer=_initWorker, initargs=(self.key, None, maxWords))
+		else:
+			self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.processes,
+				initializer=_initWorker, initargs=(None, self.grammar, maxWords))
+
+	def close(self):
+		if self.executor is not None:
+			self.executor.shutdown()
+		_grammars.pop(self.key, None)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, excType, excValue, tb):
+		self.close()
+		return False
+
+	# @param sentences, list of strings or of word lists
+	# @return list of ParseResult, in the order of sentences
+	def parseBatch(self, sentences):
+		sentences = [s.split() if isinstance(s, str) else list(s) for s in sentences]
+		with METRICS.timer('batch_parser.batch'):
+			if self.executor is None:
+				results = parseSentences(self.worker, sentences)
+			else:
+				batches = [sentences[i:i+self.batch] for i in range(0, len(sentences), self.batch)]
+				results = []
+				for batch in self.executor.map(_parseBatch, batches):
+					results.extend(batch)
+		METRICS.incr('batch_parser.sentences', len(sentences))
+		return results
+
+
+def main():
+	if len(sys.argv) < 2:
+		print('Usage: python batch_parser.py sentences.txt [cyk|topdown] [processes]')
+		return
+	algorithm = sys.argv[2] if len(sys.argv) > 2 else 'cyk'
+	processes = int(sys.argv[3]) if len(sys.argv) > 3 else None
+	with open(sys.argv[1], encoding='utf-8') as fd:
+		sentences = [line.strip() for line in fd if line.strip() != '']
+	with BatchParser(algorithm, processes=processes) as parser:
+		for sentence, result in zip(sentences, parser.parseBatch(sentences)):
+			print('{0}\t{1}\t{2:g}\t{3:.3f} ms'.format(sentence, result, result.prob, result.seconds * 1000))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,340 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Reproducible benchmark suite over the bundled data/ files.
+
+Usage:
+	python benchmark.py                      Run every benchmark and print the results as JSON
+	python benchmark.py -o out.json          Also write the results to out.json
+	python benchmark.py --save-baseline      Store the results as the baseline (data/bench_baseline.json)
+	python benchmark.py --compare            Compare the results against the stored baseline,
+	                                         exit with status 1 if any metric regressed
+	python benchmark.py --only bmm,cyk       Run a subset of the benchmarks
+
+The viterbi and trigram benchmarks are skipped unless data/emit_matrix.txt and
+data/trigram_model.txt exist. They are not bundled: compute_hmm_parameters.py writes them
+from the People's Daily training corpus data/199801.txt, which has to be added first.
+'''
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+BASELINE_FILE = 'data/bench_baseline.json'
+DOCS_FILE = 'data/docs.txt'
+EMIT_MATRIX_FILE = 'data/emit_matrix.txt'
+TRIGRAM_MODEL_FILE = 'data/trigram_model.txt'
+
+# Text used for the segmentation benchmarks, repeated to the requested length
+SAMPLE_TEXT = '在这一年中，中国的改革开放和现代化建设继续向前迈进。国民经济保持了“高增长、低通胀”的良好发展态势。' \
+	'农业生产再次获得好的收成，企业改革继续深化，人民生活进一步改善。对外经济技术合作与交流不断扩大。'
+
+SEGMENT_LENGTHS = [100, 500, 1000]
+VITERBI_LENGTHS = [100, 500]
+CYK_PP_COUNTS = [0, 2, 4, 6, 8]		# Sentence length is 3 + 2 * count
+NUM_QUERIES = 200
+SEED = 12345
+
+# Default relative change tolerated before a metric is reported as a regression
+DEFAULT_TOLERANCE = 0.15
+
+
+class Result:
+	'''
+	A single benchmark measurement. `better` tells the comparison in which direction
+	a change is an improvement, either 'higher' (throughput) or 'lower' (latency).
+	'''
+	def __init__(self, name, value, unit, better):
+		self.name = name
+		self.value = value
+		self.unit = unit
+		self.better = better
+
+	def toDict(self):
+		return {'value': self.value, 'unit': self.unit, 'better': self.better}
+
+
+# @param func, a callable without arguments
+# @param repeat, number of timed runs
+# @return the smallest elapsed time of `repeat` runs in seconds
+def bestOf(func, repeat=5):
+	func()		# Warm up caches before timing
+	best = float('inf')
+	for i in range(repeat):
+		start = time.perf_counter()
+		func()
+		elapsed = time.perf_counter() - start
+		best = min(best, elapsed)
+	return best
+
+# @param samples, a list of numbers
+# @param pct, percentile in [0, 100]
+# @return the percentile computed with the nearest-rank method
+def percentile(samples, pct):
+	ordered = sorted(samples)
+	if not ordered:
+		return 0.0
+	rank = max(1, int(round(pct / 100.0 * len(ordered))))
+	return ordered[min(rank, len(ordered)) - 1]
+
+def sampleText(length):
+	repeat = length // len(SAMPLE_TEXT) + 1
+	return (SAMPLE_TEXT * repeat)[:length]
+
+def quiet(func):
+	'''
+	Run func with stdout silenced, the segmenters print a line for every unmatched substring
+	'''
+	def wrapper():
+		saved = sys.stdout
+		sys.stdout = open(os.devnull, 'w')
+		try:
+			return func()
+		finally:
+			sys.stdout.close()
+			sys.stdout = saved
+	return wrapper
+
+
+def benchBMM(repeat):
+	from bmm_segment import BMMSegment
+	results = []
+	start = time.perf_counter()
+	bmm = BMMSegment(4)
+	results.append(Result('bmm.load_ms', (time.perf_counter() - start) * 1000, 'ms', 'lower'))
+	for length in SEGMENT_LENGTHS:
+		text = sampleText(length)
+		# MM and RMM are the non-interactive part of BMM, the ambiguity resolution prompts the user
+		elapsed = bestOf(quiet(lambda: (bmm.MM(text), bmm.RMM(text))), repeat)
+		results.append(Result('bmm.chars_per_sec.len{0}'.format(length), length / elapsed, 'chars/s', 'higher'))
+	return results
+
+def benchMP(repeat):
+	from max_prob_segment import MaxProbabilitySegment
+	results = []
+	start = time.perf_counter()
+	mp = MaxProbabilitySegment()
+	results.append(Result('mp.load_ms', (time.perf_counter() - start) * 1000, 'ms', 'lower'))
+	for length in SEGMENT_LENGTHS:
+		text = sampleText(length)
+		elapsed = bestOf(lambda: mp.MaxProbability(text), repeat)
+		results.append(Result('mp.chars_per_sec.len{0}'.format(length), length / elapsed, 'chars/s', 'higher'))
+	return results
+
+def benchViterbi(repeat):
+	if not os.path.exists(EMIT_MATRIX_FILE):
+		print('[Skip] viterbi: {0} not found, run compute_hmm_parameters.py on the training corpus first'.format(EMIT_MATRIX_FILE), file=sys.stderr)
+		return []
+	from max_prob_segment import MaxProbabilitySegment
+	from viterbi_pos_tagger import HMM_Viterbi_POS_TAGGER
+	results = []
+	mp = MaxProbabilitySegment()
+	start = time.perf_counter()
+	tagger = HMM_Viterbi_POS_TAGGER()
+	results.append(Result('viterbi.load_ms', (time.perf_counter() - start) * 1000, 'ms', 'lower'))
+	start = time.perf_counter()
+	prunedTagger = HMM_Viterbi_POS_TAGGER(pruned=True)
+	results.append(Result('viterbi_pruned.load_ms', (time.perf_counter() - start) * 1000, 'ms', 'lower'))
+	for length in VITERBI_LENGTHS:
+		obs = [w.strip('/') for w in mp.MaxProbability(sampleText(length)).split()]
+		elapsed = bestOf(lambda: tagger.Viterbi(obs), repeat)
+		results.append(Result('viterbi.tokens_per_sec.len{0}'.format(length), len(obs) / elapsed, 'tokens/s', 'higher'))
+		elapsed = bestOf(lambda: prunedTagger.Viterbi(obs), repeat)
+		results.append(Result('viterbi_pruned.tokens_per_sec.len{0}'.format(length), len(obs) / elapsed, 'tokens/s', 'higher'))
+	return results
+
+def benchTrigram(repeat):
+	if not os.path.exists(TRIGRAM_MODEL_FILE):
+		print('[Skip] trigram: {0} not found, run compute_hmm_parameters.py on the training corpus first'.format(TRIGRAM_MODEL_FILE), file=sys.stderr)
+		return []
+	from max_prob_segment import MaxProbabilitySegment
+	from trigram_pos_tagger import Trigram_HMM_POS_TAGGER
+	results = []
+	mp = MaxProbabilitySegment()
+	start = time.perf_counter()
+	tagger = Trigram_HMM_POS_TAGGER()
+	results.append(Result('trigram.load_ms', (time.perf_counter() - start) * 1000, 'ms', 'lower'))
+	for length in VITERBI_LENGTHS:
+		obs = [w.strip('/') for w in mp.MaxProbability(sampleText(length)).split()]
+		elapsed = bestOf(lambda: tagger.Viterbi(obs), repeat)
+		results.append(Result('trigram.tokens_per_sec.len{0}'.format(length), len(obs) / elapsed, 'tokens/s', 'higher'))
+	return results
+
+def benchCYK(repeat):
+	from cyk_parser import CYKParser
+	from astar_parser import AStarParser
+	from batch_parser import BatchParser
+	results = []
+	parser = CYKParser()
+	batch = BatchParser(processes=1)
+	pruned = CYKParser(beamRatio=1e-4, coarseToFine=True)
+	astar = AStarParser()
+	for count in CYK_PP_COUNTS:
+		# Every added PP doubles the attachment ambiguity, the sentence always parses
+		sentence = 'people fish tanks' + ' with rods' * count
+		n = len(sentence.split())
+		elapsed = bestOf(lambda: parser.parse(sentence), repeat)
+		results.append(Result('cyk.parse_ms.len{0}'.format(n), elapsed * 1000, 'ms', 'lower'))
+		elapsed = bestOf(lambda: pruned.parse(sentence), repeat)
+		results.append(Result('cyk_pruned.parse_ms.len{0}'.format(n), elapsed * 1000, 'ms', 'lower'))
+		elapsed = bestOf(lambda: astar.parse(sentence), repeat)
+		results.append(Result('astar.parse_ms.len{0}'.format(n), elapsed * 1000, 'ms', 'lower'))
+		elapsed = bestOf(lambda: batch.parseBatch([sentence]), repeat)
+		results.append(Result('cyk_batch.parse_ms.len{0}'.format(n), elapsed * 1000, 'ms', 'lower'))
+	return results
+
+def benchIndex(repeat):
+	from ir_indexer import Indexer
+	from ir_index_searcher import IndexSearcher, Query, SEARCH_MODE_KEYWORD, SEARCH_MODE_PHRASE, SEARCH_MODE_SUBSTRING, SEARCH_MODE_BOOLEAN
+	results = []
+	workDir = tempfile.mkdtemp(prefix='nlp_bench_')
+	try:
+		files = [os.path.join(workDir, name) for name in ('index.txt', 'dict.txt', 'params.txt')]
+		indexers = []
+		elapsed = bestOf(lambda: indexers.append(Indexer(DOCS_FILE, *files)), repeat)
+		results.append(Result('index.build_ms', elapsed * 1000, 'ms', 'lower'))
+
+		indexer = indexers[-1]
+		searcher = IndexSearcher(indexer)
+		rand = random.Random(SEED)
+
+		terms = sorted(indexer.dict)
+		keywordQueries = [rand.choice(terms) for i in range(NUM_QUERIES)]
+
+		# Phrase queries are word bigrams taken from the documents, so they always match
+		with open(DOCS_FILE, encoding='utf-8') as fd:
+			docs = [indexer.preprocess(doc.lower()) for doc in fd]
+		docs = [words for words in docs if len(words) > 1]
+		phraseQueries = []
+		for i in range(NUM_QUERIES):
+			words = rand.choice(docs)
+			j = rand.randrange(len(words) - 1)
+			phraseQueries.append(' '.join(words[j:j+2]))
+
+		# Boolean queries alternate a union and a difference of two keywords
+		booleanQueries = []
+		for i in range(NUM_QUERIES):
+			booleanQueries.append(('{0} OR {1}' if i % 2 == 0 else '{0} NOT {1}').format(rand.choice(terms), rand.choice(terms)))
+
+		ngramSearcher = IndexSearcher(Indexer(DOCS_FILE, *files, ngramSize=2))
+		for mode, label, queries in ((SEARCH_MODE_KEYWORD, 'keyword', keywordQueries), (SEARCH_MODE_PHRASE, 'phrase', phraseQueries),
+				(SEARCH_MODE_BOOLEAN, 'boolean', booleanQueries), (SEARCH_MODE_SUBSTRING, 'substring', phraseQueries)):
+			if mode == SEARCH_MODE_SUBSTRING:
+				searcher = ngramSearcher
+			latencies = []
+			for q in queries:
+				query = Query(q, mode)
+				start = time.perf_counter()
+				searcher.search(query, 10)
+				latencies.append((time.perf_counter() - start) * 1000)
+			for pct in (50, 90, 99):
+				results.append(Result('search.{0}.p{1}_ms'.format(label, pct), percentile(latencies, pct), 'ms', 'lower'))
+	finally:
+		shutil.rmtree(workDir, ignore_errors=True)
+	return results
+
+
+BENCHMARKS = [
+	('bmm', benchBMM),
+	('mp', benchMP),
+	('viterbi', benchViterbi),
+	('trigram', benchTrigram),
+	('cyk', benchCYK),
+	('index', benchIndex),
+]
+
+# @param only, a set of benchmark names to run or None to run all of them
+# @param repeat, number of timed runs per measurement
+# @return a dict ready to be serialized as JSON
+def runBenchmarks(only=None, repeat=5):
+	random.seed(SEED)
+	results = {}
+	for name, bench in BENCHMARKS:
+		if only is not None and name not in only:
+			continue
+		for r in bench(repeat):
+			results[r.name] = r.toDict()
+	return {
+		'meta': {
+			'python': platform.python_version(),
+			'platform': platform.platform(),
+			'repeat': repeat,
+			'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+		},
+		'results': results,
+	}
+
+# @param current, results returned by runBenchmarks
+# @param baseline, results loaded from the baseline file
+# @param tolerance, relative change tolerated before reporting a regression
+# @return a list of (name, baseline value, current value, relative change, status) tuples
+def compareResults(current, baseline, tolerance=DEFAULT_TOLERANCE):
+	rows = []
+	for name, cur in sorted(current['results'].items()):
+		base = baseline['results'].get(name)
+		if base is None or base['value'] == 0:
+			rows.append((name, None, cur['value'], None, 'new'))
+			continue
+		change = (cur['value'] - base['value']) / base['value']
+		# Normalize so that a positive change is always an improvement
+		gain = change if cur['better'] == 'higher' else -change
+		if gain < -tolerance:
+			status = 'REGRESSION'
+		elif gain > tolerance:
+			status = 'improved'
+		else:
+			status = 'ok'
+		rows.append((name, base['value'], cur['value'], change, status))
+	return rows
+
+def printComparison(rows):
+	print('{0:<36} {1:>14} {2:>14} {3:>9}  {4}'.format('metric', 'baseline', 'current', 'change', 'status'))
+	for name, base, cur, change, status in rows:
+		baseStr = '-' if base is None else '{0:.3f}'.format(base)
+		changeStr = '-' if change is None else '{0:+.1%}'.format(change)
+		print('{0:<36} {1:>14} {2:>14.3f} {3:>9}  {4}'.format(name, baseStr, cur, changeStr, status))
+
+
+def main():
+	argParser = argparse.ArgumentParser(description='Benchmark the NLP engines over the bundled data files')
+	argParser.add_argument('-o', '--output', help='write the JSON results to this file')
+	argParser.add_argument('--only', help='comma separated benchmark names: ' + ','.join(name for name, _ in BENCHMARKS))
+	argParser.add_argument('--repeat', type=int, default=5, help='timed runs per measurement (best run is kept)')
+	argParser.add_argument('--baseline', default=BASELINE_FILE, help='baseline file (default: %(default)s)')
+	argParser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+	argParser.add_argument('--compare', action='store_true', help='compare against the baseline')
+	argParser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, help='relative change tolerated (default: %(default)s)')
+	args = argParser.parse_args()
+
+	only = set(args.only.split(',')) if args.only else None
+	current = runBenchmarks(only, args.repeat)
+	text = json.dumps(current, indent=2, sort_keys=True)
+
+	if args.output:
+		with open(args.output, 'w') as fd:
+			fd.write(text + '\n')
+	if args.save_baseline:
+		with open(args.baseline, 'w') as fd:
+			fd.write(text + '\n')
+
+	if args.compare:
+		if not os.path.exists(args.baseline):
+			print('[Error] Baseline file "' + args.baseline + '" not found, run with --save-baseline first', file=sys.stderr)
+			sys.exit(2)
+		with open(args.baseline) as fd:
+			baseline = json.load(fd)
+		rows = compareResults(current, baseline, args.tolerance)
+		printComparison(rows)
+		if any(row[4] == 'REGRESSION' for row in rows):
+			sys.exit(1)
+	else:
+		print(text)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,328 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Word segmentation with a bigram language model trained on the segmented corpus.
+
+	python bigram_segment.py train			Count data/199801.txt and write the model files
+	python bigram_segment.py				Segment a sample sentence
+
+The bigram probabilities live in a BigramTable: an open-addressing hash table over two
+flat arrays, 8-byte packed (w1, w2) keys and 1-byte quantized log-probabilities, so
+the table costs about 18 bytes per bigram at the default load factor.
+'''
+import array
+import math
+import re
+import sys
+
+from metrics import METRICS
+
+TRAINING_TEXT_FILE = 'data/199801.txt'
+BIGRAM_VOCAB_FILE = 'data/bigram_vocab.txt'
+BIGRAM_TABLE_FILE = 'data/bigram_table.bin'
+
+BOS = '<s>'
+EOS = '</s>'
+DEFAULT_DISCOUNT = 0.75
+DEFAULT_MAX_ENTRIES = 2000000	# 2M bigrams is about 36 MB of table
+DEFAULT_MIN_LOG = -20.0			# Smallest log-probability representable after quantization
+LOAD_FACTOR = 0.5
+EMPTY = 0
+HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+MASK64 = (1 << 64) - 1
+
+
+class BigramTable:
+	'''
+	Map (w1, w2) word-id pairs to a log-probability quantized to 255 levels in
+	[minLog, 0]. Keys are stored as ((w1 << 32) | w2) + 1 so that 0 marks an empty
+	slot, collisions are resolved by linear probing.
+	'''
+	def __init__(self, capacity, minLog=DEFAULT_MIN_LOG):
+		size = 1
+		while size < capacity:
+			size <<= 1
+		self.size = size
+		self.mask = size - 1
+		self.minLog = minLog
+		self.step = -minLog / 255.0
+		self.count = 0
+		self.keys = array.array('Q', bytes(8 * size))
+		self.values = array.array('B', bytes(size))
+
+	def slot(self, key):
+		return ((key * HASH_MULTIPLIER) & MASK64) >> 32 & self.mask
+
+	def quantize(self, logp):
+		level = int(round((logp - self.minLog) / self.step))
+		return min(255, max(1, level))
+
+	def put(self, w1, w2, logp):
+		key = ((w1 << 32) | w2) + 1
+		i = self.slot(key)
+		while self.keys[i] != EMPTY and self.keys[i] != key:
+			i = (i + 1) & self.mask
+		if self.keys[i] == EMPTY:
+			if self.count + 1 > self.size * 0.9:
+				raise OverflowError('BigramTable is full, create it with a larger capacity')
+			self.keys[i] = key
+			self.count += 1
+		self.values[i] = self.quantize(logp)
+
+	# @return the log-probability stored for (w1, w2), or None
+	def get(self, w1, w2):
+		key = ((w1 << 32) | w2) + 1
+		keys = self.keys
+		i = self.slot(key)
+		while True:
+			k = keys[i]
+			if k == key:
+				return self.minLog + self.values[i] * self.step
+			if k == EMPTY:
+				return None
+			i = (i + 1) & self.mask
+
+	def memoryBytes(self):
+		return self.keys.itemsize * len(self.keys) + self.values.itemsize * len(self.values)
+
+	def save(self, path):
+		with open(path, 'wb') as fd:
+			header = array.array('d', [self.size, self.count, self.minLog])
+			header.tofile(fd)
+			self.keys.tofile(fd)
+			self.values.tofile(fd)
+
+def loadBigramTable(path):
+	with open(path, 'rb') as fd:
+		header = array.array('d')
+		header.fromfile(fd, 3)
+		table = BigramTable(int(header[0]), header[2])
+		table.count = int(header[1])
+		table.keys = array.array('Q')
+		table.keys.fromfile(fd, table.size)
+		table.values = array.array('B')
+		table.values.fromfile(fd, table.size)
+	return table
+
+
+# @param line, a line of the segmented corpus, eg. '19980101-01-001-002/m  中共中央/nt  总书记/n ...'
+# @return the list of words of the sentence, compound brackets removed
+def corpusWords(line):
+	words = []
+	for p in line.split()[1:]:		# The first token is the sentence id
+		word = p.split('/')[0].lstrip('[')
+		if word:
+			words.append(word)
+	return words
+
+# @param bigrams, dict packed word ids => count
+# @param maxEntries, number of bigrams kept at most
+# @return the bigrams counted more than a threshold, the smallest one of at least 1 that
+# keeps at most maxEntries of them
+def pruneBigrams(bigrams, maxEntries):
+	histogram = {}
+	for c in bigrams.values():
+		histogram[c] = histogram.get(c, 0) + 1
+	threshold = 1
+	left = len(bigrams) - histogram.get(1, 0)
+	for c in sorted(histogram):
+		if left <= maxEntries:
+			break
+		if c > threshold:
+			threshold = c
+			left -= histogram[c]
+	return dict((k, c) for k, c in bigrams.items() if c > threshold)
+
+# @param corpusFile, segmented corpus in the data/199801.txt format
+# @param maxEntries, number of distinct bigrams kept while counting and in the final table
+# @param discount, absolute discount subtracted from every bigram count
+def trainBigramModel(corpusFile=TRAINING_TEXT_FILE, vocabFile=BIGRAM_VOCAB_FILE, tableFile=BIGRAM_TABLE_FILE,
+		maxEntries=DEFAULT_MAX_ENTRIES, discount=DEFAULT_DISCOUNT):
+	'''
+	Stream over the corpus once. Bigram counts are kept in a dict keyed by packed word ids,
+	whenever it grows past 2 * maxEntries the bigrams seen only once are dropped, and those
+	seen more often too if that leaves more than maxEntries (the same bigram may come back
+	later and be counted again). Every prune at least halves the dict, so memory stays
+	bounded and the prunes cost time linear in the corpus.
+	The model is interpolated absolute discounting:
+		P(w2|w1) = max(c(w1 w2) - D, 0) / c(w1) + D * N1+(w1) / c(w1) * P(w2)
+	The table stores the log of the first term, the vocabulary file the unigram counts and
+	the back-off weight D * N1+(w1) / c(w1) of every word.
+	'''
+	word2id = {BOS: 0, EOS: 1}
+	unigrams = [0, 0]
+	bigrams = {}
+	with open(corpusFile, encoding='gbk') as fd:
+		for line in fd:
+			words = corpusWords(line)
+			if not words:
+				continue
+			prev = 0
+			unigrams[0] += 1
+			for word in words + [EOS]:
+				wid = word2id.get(word)
+				if wid is None:
+					wid = len(word2id)
+					word2id[word] = wid
+					unigrams.append(0)
+				unigrams[wid] += 1
+				key = (prev << 32) | wid
+				bigrams[key] = bigrams.get(key, 0) + 1
+				prev = wid
+			if len(bigrams) > 2 * maxEntries:
+				bigrams = pruneBigrams(bigrams, maxEntries)
+
+	if len(bigrams) > maxEntries:
+		kept = sorted(bigrams.items(), key=lambda item: item[1], reverse=True)[:maxEntries]
+		bigrams = dict(kept)
+
+	historyCounts = [0] * len(unigrams)		# c(w1) as a history, over the kept bigrams
+	followers = [0] * len(unigrams)			# N1+(w1)
+	for key, c in bigrams.items():
+		w1 = key >> 32
+		historyCounts[w1] += c
+		followers[w1] += 1
+
+	table = BigramTable(int(len(bigrams) / LOAD_FACTOR) + 1)
+	for key, c in bigrams.items():
+		w1 = key >> 32
+		w2 = key & 0xFFFFFFFF
+		if c > discount:
+			table.put(w1, w2, math.log((c - discount) / historyCounts[w1]))
+	table.save(tableFile)
+
+	with open(vocabFile, 'w', encoding='utf-8') as fd:
+		id2word = sorted(word2id, key=word2id.get)
+		for wid, word in enumerate(id2word):
+			h = historyCounts[wid]
+			backoff = discount * followers[wid] / h if h > 0 else 1.0
+			fd.write('{0} {1} {2}\n'.format(word, unigrams[wid], backoff))
+
+
+class BigramSegment:
+	'''
+	Segment with the bigram model: a Viterbi search over the lattice of dictionary words
+	in which a state is the last word of the path, so each word is scored given its
+	predecessor. A character not covered by any dictionary word becomes a single-character
+	word with a small unigram probability.
+	'''
+	def __init__(self, vocabFile=BIGRAM_VOCAB_FILE, tableFile=BIGRAM_TABLE_FILE):
+		self.word2id = {}
+		self.unigramLogP = array.array('d')
+		self.backoff = array.array('d')
+		self.maxWordLen = 1
+		self.oovLogP = 0.0
+		self.loadVocab(vocabFile)
+		self.table = loadBigramTable(tableFile)
+
+	def loadVocab(self, vocabFile):
+		counts = []
+		with open(vocabFile, encoding='utf-8') as fd:
+			for i, line in enumerate(fd):
+				word, count, backoff = line.rsplit(' ', 2)
+				self.word2id[word] = i
+				counts.append(int(count))
+				self.backoff.append(float(backoff))
+				self.maxWordLen = max(self.maxWordLen, len(word))
+		total = sum(counts)
+		for c in counts:
+			self.unigramLogP.append(math.log(c / total) if c > 0 else float('-inf'))
+		self.oovLogP = math.log(0.5 / total)
+
+	# @return log P(w2 | w1) for word ids, -1 standing for an out-of-vocabulary character
+	def logProb(self, w1, w2):
+		if w2 == -1:
+			return self.oovLogP
+		if w1 == -1:
+			return self.unigramLogP[w2]
+		uni = math.exp(self.unigramLogP[w2])
+		p = self.backoff[w1] * uni
+		disc = self.table.get(w1, w2)
+		if disc is not None:
+			p += math.exp(disc)
+		return math.log(p) if p > 0.0 else self.oovLogP
+
+	# @param inputStr, input string
+	# @param cancelToken, an optional workers.CancelToken checked once per position
+	# @return list of words
+	def segmentWords(self, inputStr, cancelToken=None):
+		inputStr = self.removeWhiteSpace(inputStr)
+		length = len(inputStr)
+		if length == 0:
+			return []
+		BOS_ID = self.word2id[BOS]
+		EOS_ID = self.word2id[EOS]
+
+		# ends[j] maps the id of a word ending at j (exclusive) and starting at i to
+		# (best log score, i, previous state key), the state key being (i, word id)
+		ends = [dict() for j in range(length + 1)]
+		ends[0][(0, BOS_ID)] = (0.0, -1, None)
+		probes = 0
+		with METRICS.timer('bigram.lattice'):
+			for i in range(length):
+				if cancelToken is not None:
+					cancelToken.check(i, length)
+				if not ends[i]:
+					continue
+				for j in range(i + 1, min(length, i + self.maxWordLen) + 1):
+					wid = self.word2id.get(inputStr[i:j])
+					probes += 1
+					if wid is None or wid == BOS_ID or wid == EOS_ID:
+						if j > i + 1:
+							continue
+						wid = -1	# Out-of-vocabulary single character
+					best = None
+					for prevKey, (score, start, back) in ends[i].items():
+						s = score + self.logProb(prevKey[1], wid)
+						if best is None or s > best[0]:
+							best = (s, prevKey)
+					key = (i, wid)
+					old = ends[j].get(key)
+					if old is None or best[0] > old[0]:
+						ends[j][key] = (best[0], i, best[1])
+
+		# Close the sentence with the end-of-sentence token
+		bestKey = None
+		bestScore = None
+		for key, (score, start, back) in ends[length].items():
+			s = score + self.logProb(key[1], EOS_ID)
+			if bestScore is None or s > bestScore:
+				bestScore = s
+				bestKey = key
+
+		words = []
+		j = length
+		key = bestKey
+		while j > 0:
+			score, i, back = ends[j][key]
+			words.append(inputStr[i:j])
+			j = i
+			key = back
+		words.reverse()
+		if METRICS.enabled:
+			METRICS.incr('bigram.dict_probes', probes)
+			METRICS.incr('bigram.words', len(words))
+		return words
+
+	# @param inputStr, input string
+	# @param cancelToken, an optional workers.CancelToken
+	# @return segmented string, same format as MaxProbabilitySegment.MaxProbability
+	def BigramMaxProbability(self, inputStr, cancelToken=None):
+		return ''.join(w + '/  ' for w in self.segmentWords(inputStr, cancelToken))
+
+	def removeWhiteSpace(self, inputStr):
+		return re.sub(r'\s+', '', inputStr)
+
+
+def main():
+	if len(sys.argv) > 1 and sys.argv[1] == 'train':
+		trainBigramModel()
+		return
+	inputStr = '云南幼儿园7dsf名儿童毒鼠强中毒'
+	seg = BigramSegment()
+	print('table: {0} bigrams, {1:.1f} MB'.format(seg.table.count, seg.table.memoryBytes() / 2**20))
+	print(seg.BigramMaxProbability(inputStr))
+
+
+if __name__ == '__main__':
+	main()
@@ -1,15 +1,33 @@
  #!/ usr/ bin/ python
  # -*- coding: utf-8 -*-  
 import re
+import threading
 from tkinter import simpledialog
 from tkinter import *
 
+from metrics import METRICS
+from sentence_cache import fileVersion
+from user_dict import USER_DICT_FILE, readUserDict
+
 K_DICT_FILE = 'data/chinese_dict.txt'
 
 class BMMSegment:
-	def __init__(self, maxLen):
+	# @param maxLen, length of the longest word tried
+	# @param cache, an optional sentence_cache.SentenceCache of (forward, reverse) cutting flags
+	# @param lexicon, an optional lexicon.Lexicon shared with the other engines, used in
+	# place of the dictionary file
+	def __init__(self, maxLen, cache=None, lexicon=None):
 		self.maxLen = maxLen
-		self.myDict = self.buildDict()
+		self.myDict = lexicon.bmmView() if lexicon is not None else self.buildDict()
+		self.cache = cache
+		self.dictLock = threading.Lock()
+		self.updates = 0
+		self.modelVersion = None
+		self.updateVersion()
+
+	def updateVersion(self):
+		''' Change the model version after a dictionary update so cached results are not reused '''
+		self.modelVersion = 'bmm|{0}|{1}|{2}'.format(self.maxLen, fileVersion(K_DICT_FILE), self.updates)
 
 	# @return a set of words as dictionary
 	def buildDict(self):
@@ -20,66 +38,145 @@ class BMMSegment:
 				words.append(tokens[0])
 			return set(words)
 
+	##############################  Live dictionary updates #########################################
+	# Each update is a single set operation, atomic for a segmentation running on another
+	# thread, and the lock keeps concurrent updates and the model version consistent.
+
+	# @param word, a word to add, the longest word tried grows to its length if needed
+	def addWord(self, word):
+		with self.dictLock:
+			self.myDict.add(word)
+			if len(word) > self.maxLen:
+				self.maxLen = len(word)
+			self.updates += 1
+			self.updateVersion()
+
+	# @return True if word was in the dictionary
+	def removeWord(self, word):
+		with self.dictLock:
+			if word not in self.myDict:
+				return False
+			self.myDict.discard(word)
+			self.updates += 1
+			self.updateVersion()
+			return True
+
+	# @param path, a user dictionary file, see user_dict.py, frequencies are ignored
+	# @return number of entries applied
+	def loadUserDict(self, path=USER_DICT_FILE):
+		entries = readUserDict(path)
+		for word, p, remove in entries:
+			if remove:
+				self.removeWord(word)
+			else:
+				self.addWord(word)
+		return len(entries)
+
 	# @param inputStr, a string to be segmented
+	# @param cancelToken, an optional workers.CancelToken checked once per matched word
 	# @return a list of cutting flag
-	def MM(self, inputStr):
+	def MM(self, inputStr, cancelToken=None):
 		totalLen = len(inputStr)
 		startPos = 0
 		result = [False] * totalLen
+		maxLen = self.maxLen		# addWord may grow it while we run
+		probes = 0
+		unmatched = 0
 
 		while startPos < totalLen:
+			if cancelToken is not None:
+				cancelToken.check(startPos, totalLen)
 			remainLen = totalLen - startPos
-			currLen = self.maxLen if remainLen >= self.maxLen else remainLen
+			currLen = maxLen if remainLen >= maxLen else remainLen
 			subStr = inputStr[startPos:startPos+currLen]
+			probes += 1
 			while subStr not in self.myDict and currLen > 0:
 				currLen = currLen - 1
 				subStr = inputStr[startPos:startPos+currLen]
+				probes += 1
 			# Sub-string length decrease to zero, not found in dictionary
 			if currLen == 0:
-				step = self.maxLen if remainLen >= self.maxLen else remainLen
+				step = maxLen if remainLen >= maxLen else remainLen
 				oldPos = startPos
 				startPos += step
 				result[oldPos+step-1] = True
 				tmp = inputStr[oldPos:startPos]
+				unmatched += 1
 				print('[Error] Failed to segment "' + tmp + '", no match found in dictionary')
 			else:
 				# Match found in dictionary, mark a cutting flag
 				result[startPos+len(subStr)-1] = True
 				startPos += currLen
+		if METRICS.enabled:
+			METRICS.incr('bmm.dict_probes', probes)
+			METRICS.incr('bmm.unmatched', unmatched)
 		return result
 		
 	# @param inputStr, a string to be segmented
+	# @param cancelToken, an optional workers.CancelToken checked once per matched word
 	# @return a list of cutting flag
-	def RMM(self, inputStr):
+	def RMM(self, inputStr, cancelToken=None):
 		totalLen = len(inputStr)
 		endPos = totalLen - 1
 		result = [False] * totalLen
+		maxLen = self.maxLen		# addWord may grow it while we run
+		probes = 0
+		unmatched = 0
 
 		while endPos >= 0:
+			if cancelToken is not None:
+				cancelToken.check(totalLen - endPos - 1, totalLen)
 			remainLen = endPos + 1
-			currLen = self.maxLen if remainLen >= self.maxLen else remainLen
+			currLen = maxLen if remainLen >= maxLen else remainLen
 			subStr = inputStr[endPos-currLen+1:endPos+1]
+			probes += 1
 			while subStr not in self.myDict and currLen > 0:
 				currLen = currLen - 1
 				subStr = inputStr[endPos-currLen+1:endPos+1]
+				probes += 1
 			# Sub-string length decrease to zero, not found in dictionary
 			if currLen == 0:
 				# raise Exception('[Error] Failed to segment : ' + inputStr[endPos:endPos+self.maxLen].encode('cp936'))
-				step = self.maxLen if remainLen >= self.maxLen else remainLen
+				step = maxLen if remainLen >= maxLen else remainLen
 				oldPos = endPos
 				endPos -= step
 				result[oldPos] = True
 				tmp = inputStr[oldPos-step+1:oldPos+1]
+				unmatched += 1
 				print('[Error] Failed to segment "' + tmp + '", no match found in dictionary')
 			else:
 				# Match found in dictionary, mark a cutting flag
 				result[endPos] = True
 				endPos -= currLen
+		if METRICS.enabled:
+			METRICS.incr('bmm.dict_probes', probes)
+			METRICS.incr('bmm.unmatched', unmatched)
 		return result
 
+	# @param inputStr, a string without white spaces
+	# @param cancelToken, an optional workers.CancelToken
+	# @return a tuple of (forward, reverse) cutting flags, the part of BMM which does not
+	# interact with the user and can run on a worker thread
+	def matchBothWays(self, inputStr, cancelToken=None):
+		if self.cache is not None:
+			key = self.cache.key(self.modelVersion, inputStr)
+			flags = self.cache.get(key)
+			if flags is not None:
+				return flags
+		with METRICS.timer('bmm.mm'):
+			forward = self.MM(inputStr, cancelToken)
+		with METRICS.timer('bmm.rmm'):
+			reverse = self.RMM(inputStr, cancelToken)
+		if self.cache is not None:
+			self.cache.put(key, (forward, reverse))
+		return (forward, reverse)
+
 	# @param inputStr, a string to be segmented
+	# @param inTextBox, text widget used to highlight the ambiguities or None
+	# @param cancelToken, an optional workers.CancelToken
+	# @param flags, (forward, reverse) cutting flags previously returned by matchBothWays
 	# @return a segmented string
-	def BMM(self, inputStr, inTextBox):
+	def BMM(self, inputStr, inTextBox, cancelToken=None, flags=None):
 		if inputStr == '':
 			return ''
 
@@ -88,9 +185,11 @@ class BMMSegment:
 		totalLen = len(inputStr)
 		cutFlags = [False] * totalLen
 
-		forward = self.MM(inputStr)
-		reverse = self.RMM(inputStr)
+		if flags is None:
+			flags = self.matchBothWays(inputStr, cancelToken)
+		forward, reverse = flags
 		p = 0
+		ambiguities = 0
 
 		while p < totalLen:
 			# Find the unmatched position and put the matched cutting flags to cutFlags
@@ -114,12 +213,48 @@ class BMMSegment:
 				print('Please handle the ambiguity for "' + inputStr[prev+1:notMatchEndPos+1] + '" manually')
 				self.highlightText(inputStr, prev+1, notMatchEndPos, inTextBox)
 				self.resolveAmbiguity(inputStr, cutFlags, prev+1, notMatchEndPos)
+				ambiguities += 1
 				if notMatchEndPos < totalLen:
 					cutFlags[notMatchEndPos] = True
 				p += 1
 		self.highlightText(inputStr, -1, -1, inTextBox)	# Restore the normal style
+		METRICS.incr('bmm.ambiguities', ambiguities)
 		return self.constructResult(inputStr, cutFlags)
 
+	# @param inputStr, a string to be segmented
+	# @param cancelToken, an optional workers.CancelToken
+	# @return list of words, without asking the user to resolve ambiguities
+	def segmentWords(self, inputStr, cancelToken=None):
+		'''
+		Non-interactive BMM: when MM and RMM disagree, keep the result with fewer words,
+		then the one with fewer single-character words, and RMM on a tie.
+		'''
+		inputStr = self.removeWhiteSpace(inputStr)
+		if inputStr == '':
+			return []
+		forward, reverse = self.matchBothWays(inputStr, cancelToken)
+		if forward != reverse:
+			fwdWords = self.flagsToWords(inputStr, forward)
+			revWords = self.flagsToWords(inputStr, reverse)
+			fwdKey = (len(fwdWords), sum(1 for w in fwdWords if len(w) == 1))
+			revKey = (len(revWords), sum(1 for w in revWords if len(w) == 1))
+			return fwdWords if fwdKey < revKey else revWords
+		return self.flagsToWords(inputStr, forward)
+
+	# @param inputStr, input string
+	# @param cutFlags, list of cutting flag of the result string
+	# @return list of words
+	def flagsToWords(self, inputStr, cutFlags):
+		words = []
+		beg = 0
+		for i, isCut in enumerate(cutFlags):
+			if isCut:
+				words.append(inputStr[beg:i+1])
+				beg = i + 1
+		if beg < len(inputStr):
+			words.append(inputStr[beg:])
+		return words
+
 	# @param cutFlags, list of cutting flag of the result string
 	# @param pos, position we are currently at
 	# @return previous cutting position if we found one, otherwise return -1
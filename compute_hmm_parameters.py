@@ -7,6 +7,7 @@ TRANS_MATRIX_FILE = 'data/trans_matrix.txt'
 EMIT_MATRIX_FILE = 'data/emit_matrix.txt'
 TRAINING_TEXT_FILE = 'data/199801.txt'
 INIT_PROB_FILE = 'data/init_prob.txt'
+TRIGRAM_MODEL_FILE = 'data/trigram_model.txt'
 
 
 def collectWordsTags():
@@ -75,6 +76,95 @@ def computeHMMParameters():
 		fd_init.write(' '.join(init_p))
 
 
+# @param trigrams, trigrams, bigrams, unigrams, histBigrams, histUnigrams: dicts of counts
+# keyed by tag-id tuples (bigrams and histories) or tag ids (unigrams)
+# @param total, number of trigram positions in the corpus
+# @return (l1, l2, l3), the unigram, bigram and trigram interpolation weights
+def deletedInterpolation(trigrams, bigrams, unigrams, histBigrams, histUnigrams, total):
+	'''
+	Deleted interpolation (Brants, 2000): every trigram occurrence votes, with its count,
+	for the order whose estimate is best once that occurrence is removed from the counts.
+	'''
+	lambdas = [0, 0, 0]
+	for (t1, t2, t3), count in trigrams.items():
+		h2 = histBigrams[(t1, t2)]
+		h1 = histUnigrams[t2]
+		p3 = (count - 1) / (h2 - 1) if h2 > 1 else 0.0
+		p2 = (bigrams[(t2, t3)] - 1) / (h1 - 1) if h1 > 1 else 0.0
+		p1 = (unigrams[t3] - 1) / (total - 1) if total > 1 else 0.0
+		best = max(p1, p2, p3)
+		if best == p3:
+			lambdas[2] += count
+		elif best == p2:
+			lambdas[1] += count
+		else:
+			lambdas[0] += count
+	s = sum(lambdas)
+	return tuple(l / s for l in lambdas) if s > 0 else (1/3, 1/3, 1/3)
+
+def computeTrigramHMMParameters():
+	'''
+	Count tag trigrams, bigrams and unigrams plus word emissions in one streaming pass over
+	the training text, and write them sparsely (only non-zero counts) with the deleted
+	interpolation weights. Each sentence is padded with two START tags and one STOP tag,
+	whose ids are numTags and numTags+1.
+	'''
+	word2id = {}
+	tag2id = {}
+	with open(WORDS_FILE, encoding='utf-8') as fd:
+		for i, w in enumerate(fd):
+			word2id[w.strip()] = i
+	with open(TAGS_FILE, encoding='utf-8') as fd2:
+		for i, t in enumerate(fd2):
+			tag2id[t.strip()] = i
+	START = len(tag2id)
+	STOP = START + 1
+
+	trigrams = {}
+	bigrams = {}
+	unigrams = {}
+	histBigrams = {}
+	histUnigrams = {}
+	emissions = {}
+	total = 0
+	with open(TRAINING_TEXT_FILE, encoding='gbk') as fd:
+		for line in fd:
+			pairs = line.split()
+			if len(pairs) < 2:
+				continue
+			tags = [START, START]
+			for p in pairs[1:]:		# The first token is the sentence id
+				word, tag = p.split('/')[:2]
+				t = tag2id[tag]
+				tags.append(t)
+				if word in word2id:
+					key = (t, word2id[word])
+					emissions[key] = emissions.get(key, 0) + 1
+			tags.append(STOP)
+			for i in range(2, len(tags)):
+				t1, t2, t3 = tags[i-2], tags[i-1], tags[i]
+				trigrams[(t1, t2, t3)] = trigrams.get((t1, t2, t3), 0) + 1
+				bigrams[(t2, t3)] = bigrams.get((t2, t3), 0) + 1
+				unigrams[t3] = unigrams.get(t3, 0) + 1
+				histBigrams[(t1, t2)] = histBigrams.get((t1, t2), 0) + 1
+				histUnigrams[t2] = histUnigrams.get(t2, 0) + 1
+				total += 1
+
+	lambdas = deletedInterpolation(trigrams, bigrams, unigrams, histBigrams, histUnigrams, total)
+	with open(TRIGRAM_MODEL_FILE, 'w', encoding='utf-8') as fd:
+		fd.write('#LAMBDAS\n' + ' '.join(str(l) for l in lambdas) + '\n')
+		fd.write('#TOTAL\n' + str(total) + '\n')
+		for name, counts in (('#UNIGRAM', unigrams), ('#HIST_UNIGRAM', histUnigrams)):
+			fd.write(name + '\n')
+			for t, ct in sorted(counts.items()):
+				fd.write('{0} {1}\n'.format(t, ct))
+		for name, counts in (('#BIGRAM', bigrams), ('#HIST_BIGRAM', histBigrams), ('#TRIGRAM', trigrams), ('#EMIT', emissions)):
+			fd.write(name + '\n')
+			for key, ct in sorted(counts.items()):
+				fd.write(' '.join(str(k) for k in key) + ' {0}\n'.format(ct))
+
+
 if __name__ == '__main__':
 	# collectWordsTags()
 	computeHMMParameters()
+	computeTrigramHMMParameters()
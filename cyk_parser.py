@@ -1,10 +1,23 @@
 import re
 import operator
-import io
-import sys
+import heapq
+
+from metrics import METRICS
+from parse_tree import ParseTree
 
 RULES_FILE = 'data/rules_pcfg.txt'
 
+DEFAULT_COARSE_THRESHOLD = 1e-5		# Fine items whose coarse max-marginal is below this ratio of the best coarse parse are skipped
+
+
+# @param symbol, a non-terminal of the fine grammar
+# @return its symbol in the coarse grammar, binarization symbols such as '@VP_V' are
+# projected onto the phrase they belong to ('VP')
+def projectSymbol(symbol):
+	if symbol.startswith('@'):
+		return symbol[1:].split('_')[0]
+	return symbol
+
 class DictList(dict):
 	'''
 	Make a custom dict which can store duplicate key-values in list
@@ -35,8 +48,21 @@ class SplitPoint:
 class CYKParser:
 	'''
 	Implement CYK algorithm for parsing PCFG
+
+	By default every (span, non-terminal) cell is filled exhaustively. Setting any of the
+	pruning options switches to a sparse chart in which only the items surviving in the
+	two sub-spans are combined:
+		beamRatio		drop the items of a cell below beamRatio times its best item
+		topK			keep at most topK items per cell
+		coarseToFine	first parse with the coarse grammar obtained by projectSymbol,
+						then skip the fine items whose coarse inside * outside score is
+						below coarseThreshold times the best coarse parse
+	The cell spanning the whole sentence is never pruned. parse(..., exhaustive=True)
+	ignores the options, to validate them against the exact parser.
 	'''
-	def __init__(self):
+	# @param rulesfile, the grammar, 'X -> Y Z p' and 'X -> word p' lines
+	def __init__(self, beamRatio=None, topK=None, coarseToFine=False, coarseThreshold=DEFAULT_COARSE_THRESHOLD,
+			rulesfile=RULES_FILE):
 		self.rules = DictList()
 		self.nonterminals = []
 		self.words = []
@@ -44,33 +70,82 @@ class CYKParser:
 		self.BP = None
 		self.symb2id = {}
 		self.id2symb = {}
-		self.loadRules(RULES_FILE)
+		self.beamRatio = beamRatio
+		self.topK = topK
+		self.coarseToFine = coarseToFine
+		self.coarseThreshold = coarseThreshold
+		self.lexicalRules = None	# word => list of (X id, prob)
+		self.binaryRules = None		# (Y id, Z id) => list of (X id, prob, rule index)
+		self.binaryByHead = None	# X id => list of (rule index, Y id, Z id, prob)
+		self.coarseId = None		# Fine symbol id => coarse symbol id
+		self.coarseLexicalRules = None
+		self.coarseBinaryRules = None
+		self.loadRules(rulesfile)
 
 	def loadRules(self, rulesfile):
-		currIdx = 1
 		with open(rulesfile) as fd:
-			# First pass, build symbol->id and id->symbol mapping for later use
-			for line in fd:
-				if line.strip() == '' or line.startswith('#'):
-					continue
+			lines = [line.strip() for line in fd if line.strip() != '' and not line.startswith('#')]
+		currIdx = 1
+		# First pass, build symbol->id and id->symbol mapping for later use
+		for line in lines:
+			head = line.split()[0]
+			if head not in self.symb2id:
+				self.symb2id[head] = currIdx
+				self.id2symb[currIdx] = head
+				currIdx += 1
+		# Second pass, parse each rule and store them into a dict
+		for line in lines:
+			head, body = re.split('->', line)
+			head = head.strip()
+			body = body.split()
+			body[-1] = float(body[-1])
+			self.rules[head] = body
+		self.nonterminals = ['#'] + sorted(self.symb2id, key=self.symb2id.get)	# For one-based array
+		self.compileRules()
+
+	def compileRules(self):
+		''' Index the rules by their right-hand side for the sparse chart, and build the coarse grammar '''
+		self.lexicalRules = {}
+		self.binaryRules = {}
+		self.binaryByHead = [[] for i in range(len(self.symb2id) + 1)]
+		for X, X_id in self.symb2id.items():
+			seen = set()
+			for r, production in enumerate(self.rules[X]):
+				if len(production) < 3:
+					# Same as checkWordInRules, the first rule for a word wins
+					if production[0] not in seen:
+						seen.add(production[0])
+						self.lexicalRules.setdefault(production[0], []).append((X_id, production[1]))
 				else:
-					symbols = line.split()
-					head = symbols[0]
-					if head not in self.symb2id:
-						self.symb2id[head] = currIdx
-						self.id2symb[currIdx] = head
-						currIdx += 1
-		with open(rulesfile) as fd:
-			# Second pass, parse each rule and store them into a dict	
-			for line in fd:
-				if line.strip() == '':
-					continue
-				head, body = re.split('->', line.strip())
-				head = head.strip()
-				body = body.split()
-				body[-1] = float(body[-1])
-				self.rules[head] = body
-			self.nonterminals = ['#'] + sorted(self.symb2id, key=self.symb2id.get)	# For one-based array
+					# The rule index breaks ties between equally probable items the way the
+					# exhaustive loop does, so both parsers return the same tree
+					key = (self.symb2id[production[0]], self.symb2id[production[1]])
+					self.binaryRules.setdefault(key, []).append((X_id, production[2], r))
+					self.binaryByHead[X_id].append((r, key[0], key[1], production[2]))
+
+		# The coarse rule probability is the max over the fine rules it merges, so a coarse
+		# score is never lower than the fine scores it stands for
+		coarse2id = {}
+		self.coarseId = [0] * (len(self.symb2id) + 1)
+		for X, X_id in self.symb2id.items():
+			self.coarseId[X_id] = coarse2id.setdefault(projectSymbol(X), len(coarse2id) + 1)
+		self.coarseLexicalRules = {}
+		for word, rules in self.lexicalRules.items():
+			self.coarseLexicalRules[word] = self.maxRules((self.coarseId[X], p) for X, p in rules)
+		self.coarseBinaryRules = {}
+		for (Y, Z), rules in self.binaryRules.items():
+			key = (self.coarseId[Y], self.coarseId[Z])
+			merged = self.coarseBinaryRules.get(key, []) + [(self.coarseId[X], p, 0) for X, p, r in rules]
+			self.coarseBinaryRules[key] = [(X, p, 0) for X, p in self.maxRules((X, p) for X, p, r in merged)]
+
+	# @param rules, iterable of (symbol id, prob)
+	# @return list of (symbol id, max prob)
+	def maxRules(self, rules):
+		best = {}
+		for X, p in rules:
+			if p > best.get(X, 0.0):
+				best[X] = p
+		return list(best.items())
 
 	# @param word, a word string
 	# @param symbol, a non-terminal symbol string
@@ -82,92 +157,416 @@ class CYKParser:
 				return r[1]
 		return -1.0
 
+	# @param beg, beginning pos of the subsequence
+	# @param end, ending pos of the subsequence (inclusive)
+	# @param symbol, the NT symbol
+	# @return the parse string of the last parsed sentence
 	def printParseTree(self, beg, end, symbol):
-		sys.stdout = mystdout = io.StringIO()
-		self.printParseTreeAux(beg, end, self.symb2id[symbol])
-		parseString = mystdout.getvalue()
-		sys.stdout = sys.__stdout__
-		mystdout.close()
-
-		return parseString
+		return self.buildTree(self.words, self.BP, beg, end, self.symb2id[symbol]).bracketed()
 
+	# @param words, the words of the sentence
+	# @param BP, the backpointers of its chart
 	# @param beg, beginning pos of the subsequence
 	# @param end, ending pos of the subsequence (inclusive)
 	# @param symbol_id, the NT symbol id
-	# @return a parse string using recursion
-	def printParseTreeAux(self, beg, end, symbol_id):
-		''' 
-		Construct a parse string using the backpoint information recursively.
+	# @return a ParseTree
+	def buildTree(self, words, BP, beg, end, symbol_id):
 		'''
-		backPt = self.BP[beg][end][symbol_id]
-		symb = self.id2symb[symbol_id]
-		if backPt.s == -1:
-			print(symb + '(' + self.words[beg-1] + ')', end='')
-		else:
-			print(symb, end='')
-			print('(', end='')
-			self.printParseTreeAux(beg, backPt.s, backPt.Y)
-			self.printParseTreeAux(backPt.s+1, end, backPt.Z)
-			print(')', end='')
+		Construct the parse tree from the backpointers with an explicit stack.
+		'''
+		tree = ParseTree()
+		stack = [(beg, end, symbol_id, -1)]
+		while stack:
+			beg, end, symbol_id, parent = stack.pop()
+			node = tree.add(self.id2symb[symbol_id], parent)
+			backPt = BP[beg][end][symbol_id]
+			if backPt.s == -1:
+				tree.add(words[beg-1], node)
+			else:
+				# Push the right child first, the left one is added first
+				stack.append((backPt.s+1, end, backPt.Z, node))
+				stack.append((beg, backPt.s, backPt.Y, node))
+		return tree
+
+	# @param sentence, a string to be parsed
+	# @param cancelToken, an optional workers.CancelToken checked once per chart cell
+	# @param exhaustive, fill every cell even when pruning options are set
+	# @return a parse string and its probability, ('', 0.0) if the sentence has no parse
+	def parse(self, sentence, cancelToken=None, exhaustive=False):
+		tree, prob = self.parseTree(sentence, cancelToken, exhaustive)
+		return (tree.bracketed() if tree is not None else '', prob)
+
+	# @param sentence, a string to be parsed
+	# @param cancelToken, an optional workers.CancelToken checked once per chart cell
+	# @param exhaustive, fill every cell even when pruning options are set
+	# @return a ParseTree, or None if the sentence has no parse, and its probability
+	def parseTree(self, sentence, cancelToken=None, exhaustive=False):
+		'''
+		The chart is built in local variables, so several threads can parse with the
+		same parser. The chart of the last parse is kept in words, P and BP for the GUI
+		and kBest.
+		'''
+		words, P, BP = self.parseChart(sentence, cancelToken, exhaustive)
+		N = len(words)
+		S_id = self.symb2id['S']
+		prob = P[1][N][S_id] if N > 0 else 0.0
+		tree = None
+		if prob > 0.0:
+			with METRICS.timer('cyk.tree'):
+				tree = self.buildTree(words, BP, 1, N, S_id)
+		self.words, self.P, self.BP = words, P, BP
+		return (tree, prob)
 
 	# @param sentence, a string to be parsed
-	# @return a parse string and its probability
-	def parse(self, sentence):
+	# @param cancelToken, an optional workers.CancelToken checked once per chart cell
+	# @param exhaustive, fill every cell even when pruning options are set
+	# @return the words, the probability chart P and the backpointer chart BP
+	def parseChart(self, sentence, cancelToken=None, exhaustive=False):
 		'''
 		Implement CYK algorithm for parsing PCFG.
 		'''
 		words = sentence.split()
-		self.words = words
+		if not exhaustive and (self.beamRatio is not None or self.topK is not None or self.coarseToFine):
+			return self.parsePruned(words, cancelToken)
 		N = len(words)			# Number of words
 		M = len(self.symb2id)	# Number of non-terminal symbols
 
 		# N x N x M, P[i][j][k] stores the maximum probability of non-terminal
 		# symbol Xk spanning over word_i...word_j (inclusive) 
-		self.P = [ [[ 0.0 for i in range(M+1) ] for j in range(N+1)] for k in range(N+1)]
+		P = [ [[ 0.0 for i in range(M+1) ] for j in range(N+1)] for k in range(N+1)]
 
 		# N x N x M, BP[i][j][k] stores the split point s of the partition which has the 
 		# maximum probability of (X -> Y Z) spanning over word_i...word_j (inclusive) 
-		self.BP = [ [[ SplitPoint() for i in range(M+1) ] for j in range(N+1)] for k in range(N+1)]
+		BP = [ [[ SplitPoint() for i in range(M+1) ] for j in range(N+1)] for k in range(N+1)]
 	
 		# Initialization
-		for i in range(1, N+1):			# For each word
-			for j in range(1, M+1):		# For each non-terminal symbol
-				symb = self.id2symb[j]
-				prob = self.checkWordInRules(words[i-1], symb)
-				if prob < 0.0:
-					self.P[i][i][j] = 0.0
-				else:
-					self.P[i][i][j] = prob
-
-		for _len in range(1, N):	# Subsequence length 
-			for i in range(1, N-_len+1):	# Subsequence starting pos
-				j = i + _len 				# Subsequence ending pos
-				for k in range(1, M+1):			# For each NT symbol X
-					X = self.nonterminals[k]
-					maxProb = 0.0
-					maxSplitPos = SplitPoint()
-					for production in self.rules[X]:	# For each production of X (X -> Y Z)
-						if len(production) < 3:
-							continue
-						Y = production[0]
-						Z = production[1]
-						Y_id = self.symb2id[Y]
-						Z_id = self.symb2id[Z]
-						prob = production[2]
-						for s in range(i, j):	# For each possible split point s
-							p = prob * self.P[i][s][Y_id] * self.P[s+1][j][Z_id]
-							if maxProb < p:
-								maxProb = p
-								maxSplitPos = SplitPoint(s, Y_id, Z_id)
-
-					self.P[i][j][k] = maxProb
-					self.BP[i][j][k] = maxSplitPos
-		
-		S_id = self.symb2id['S']
-		parseString = self.printParseTree(1, N, 'S')
-		prob = self.P[1][N][S_id]
+		with METRICS.timer('cyk.lexical'):
+			for i in range(1, N+1):			# For each word
+				for j in range(1, M+1):		# For each non-terminal symbol
+					symb = self.id2symb[j]
+					prob = self.checkWordInRules(words[i-1], symb)
+					if prob < 0.0:
+						P[i][i][j] = 0.0
+					else:
+						P[i][i][j] = prob
+
+		cells = 0		# Number of chart cells with non-zero probability
+		splits = 0		# Number of (production, split point) pairs evaluated
+		with METRICS.timer('cyk.binary'):
+			for _len in range(1, N):	# Subsequence length 
+				if cancelToken is not None:
+					cancelToken.check(_len, N)
+				for i in range(1, N-_len+1):	# Subsequence starting pos
+					j = i + _len 				# Subsequence ending pos
+					if cancelToken is not None:
+						cancelToken.check()
+					for k in range(1, M+1):			# For each NT symbol X
+						X = self.nonterminals[k]
+						maxProb = 0.0
+						maxSplitPos = SplitPoint()
+						for production in self.rules[X]:	# For each production of X (X -> Y Z)
+							if len(production) < 3:
+								continue
+							Y = production[0]
+							Z = production[1]
+							Y_id = self.symb2id[Y]
+							Z_id = self.symb2id[Z]
+							prob = production[2]
+							splits += j - i
+							for s in range(i, j):	# For each possible split point s
+								p = prob * P[i][s][Y_id] * P[s+1][j][Z_id]
+								if maxProb < p:
+									maxProb = p
+									maxSplitPos = SplitPoint(s, Y_id, Z_id)
+
+						P[i][j][k] = maxProb
+						if maxProb > 0.0:
+							cells += 1
+						BP[i][j][k] = maxSplitPos
+		if METRICS.enabled:
+			METRICS.incr('cyk.cells', cells)
+			METRICS.incr('cyk.split_evals', splits)
+		return (words, P, BP)
+
+	##############################  Pruned parsing #########################################
+
+	# @param words, the words of the sentence
+	# @param cancelToken, an optional workers.CancelToken
+	# @return the words, P and BP, same as parseChart
+	def parsePruned(self, words, cancelToken=None):
+		allowed = None
+		if self.coarseToFine:
+			with METRICS.timer('cyk.coarse'):
+				allowed = self.coarseAllowed(words, cancelToken)
+
+		with METRICS.timer('cyk.binary'):
+			chart = self.fillChart(words, self.lexicalRules, self.binaryRules, cancelToken,
+				self.beamRatio, self.topK, allowed, self.coarseId)
+		return self.denseChart(words, chart)
+
+	# @param words, the words of the sentence
+	# @param chart, chart[i][j] maps X to (prob, s, Y, Z, rule index), None or empty for no item
+	# @return the words, P and BP, same as parseChart
+	def denseChart(self, words, chart):
+		# Copy the items into the dense P and BP the tree builder and the GUI read
+		N = len(words)
+		M = len(self.symb2id)
+		noSplit = SplitPoint()
+		P = [[[0.0] * (M+1) for j in range(N+1)] for k in range(N+1)]
+		BP = [[[noSplit] * (M+1) for j in range(N+1)] for k in range(N+1)]
+		for i in range(1, N+1):
+			for j in range(i, N+1):
+				for X, (p, s, Y, Z, r) in (chart[i][j] or {}).items():
+					P[i][j][X] = p
+					if s != -1:
+						BP[i][j][X] = SplitPoint(s, Y, Z)
+		return (words, P, BP)
+
+	# @param words, the words of the sentence
+	# @param lexicalRules, word => list of (X, prob)
+	# @param binaryRules, (Y, Z) => list of (X, prob, rule index)
+	# @param beamRatio, topK, per-cell pruning, or None
+	# @param allowed, allowed[i][j] is the set of projected symbols a cell may hold, or None
+	# @param project, symbol id => projected symbol id, used with allowed
+	# @return chart, chart[i][j] maps X to (prob, s, Y, Z, rule index) for the items kept over words i..j
+	def fillChart(self, words, lexicalRules, binaryRules, cancelToken=None, beamRatio=None, topK=None,
+			allowed=None, project=None):
+		N = len(words)
+		chart = [[None] * (N+1) for i in range(N+2)]
+		for i in range(1, N+1):
+			cell = {}
+			for X, p in lexicalRules.get(words[i-1], []):
+				if allowed is None or project[X] in allowed[i][i]:
+					cell[X] = (p, -1, -1, -1, -1)
+			chart[i][i] = self.pruneCell(cell, beamRatio, topK) if N > 1 else cell
+
+		cells = 0
+		splits = 0
+		pruned = 0
+		for _len in range(1, N):
+			if cancelToken is not None:
+				cancelToken.check(_len, N)
+			for i in range(1, N-_len+1):
+				j = i + _len
+				cell = {}
+				allowedHere = allowed[i][j] if allowed is not None else None
+				for s in range(i, j):
+					left = chart[i][s]
+					right = chart[s+1][j]
+					if not left or not right:
+						continue
+					for Y, itemY in left.items():
+						pY = itemY[0]
+						for Z, itemZ in right.items():
+							rules = binaryRules.get((Y, Z))
+							if rules is None:
+								continue
+							pZ = itemZ[0]
+							splits += len(rules)
+							for X, prob, r in rules:
+								if allowedHere is not None and project[X] not in allowedHere:
+									continue
+								p = prob * pY * pZ
+								old = cell.get(X)
+								if old is None or p > old[0] or (p == old[0] and (r, s) < (old[4], old[1])):
+									cell[X] = (p, s, Y, Z, r)
+				cells += len(cell)
+				if j < N or i > 1:
+					kept = self.pruneCell(cell, beamRatio, topK)
+					pruned += len(cell) - len(kept)
+					cell = kept
+				chart[i][j] = cell
+		if METRICS.enabled:
+			METRICS.incr('cyk.cells', cells)
+			METRICS.incr('cyk.split_evals', splits)
+			METRICS.incr('cyk.pruned', pruned)
+		return chart
+
+	# @param cell, X => (prob, s, Y, Z, rule index)
+	# @return the items kept by the beam and top-k
+	def pruneCell(self, cell, beamRatio, topK):
+		if not cell:
+			return cell
+		if beamRatio is not None:
+			threshold = max(item[0] for item in cell.values()) * beamRatio
+			cell = dict((X, item) for X, item in cell.items() if item[0] >= threshold)
+		if topK is not None and len(cell) > topK:
+			cell = dict(sorted(cell.items(), key=lambda kv: kv[1][0], reverse=True)[:topK])
+		return cell
+
+	# @param words, the words of the sentence
+	# @return allowed, allowed[i][j] is the set of coarse symbols whose max-marginal over
+	# words i..j is within coarseThreshold of the best coarse parse
+	def coarseAllowed(self, words, cancelToken=None):
+		N = len(words)
+		chart = self.fillChart(words, self.coarseLexicalRules, self.coarseBinaryRules, cancelToken)
+		S = self.coarseId[self.symb2id['S']]
+		allowed = [[set() for j in range(N+1)] for i in range(N+2)]
+		if N == 0 or S not in chart[1][N]:
+			return allowed		# No coarse parse, so no fine parse either
+		best = chart[1][N][S][0]
+
+		# Viterbi outside scores, top-down over the spans
+		outside = [[dict() for j in range(N+1)] for i in range(N+2)]
+		outside[1][N][S] = 1.0
+		for _len in range(N-1, 0, -1):
+			for i in range(1, N-_len+1):
+				j = i + _len
+				out = outside[i][j]
+				if not out:
+					continue
+				for s in range(i, j):
+					left = chart[i][s]
+					right = chart[s+1][j]
+					if not left or not right:
+						continue
+					for Y, itemY in left.items():
+						for Z, itemZ in right.items():
+							pY = itemY[0]
+							pZ = itemZ[0]
+							for X, prob, r in self.coarseBinaryRules.get((Y, Z), []):
+								o = out.get(X)
+								if o is None:
+									continue
+								oY = o * prob * pZ
+								if oY > outside[i][s].get(Y, 0.0):
+									outside[i][s][Y] = oY
+								oZ = o * prob * pY
+								if oZ > outside[s+1][j].get(Z, 0.0):
+									outside[s+1][j][Z] = oZ
+
+		threshold = best * self.coarseThreshold
+		for i in range(1, N+1):
+			for j in range(i, N+1):
+				for X, o in outside[i][j].items():
+					if chart[i][j][X][0] * o >= threshold:
+						allowed[i][j].add(X)
+		return allowed
+
+	##############################  k-best parsing #########################################
+
+	# @param sentence, a string to be parsed
+	# @param k, number of parses wanted
+	# @param cancelToken, an optional workers.CancelToken
+	# @return a list of at most k (ParseTree, probability), best first
+	def parseKBest(self, sentence, k, cancelToken=None):
+		words, P, BP = self.parseChart(sentence, cancelToken)
+		return KBestExtractor(self, words, P).extract(k)
+
+	# @param k, number of parses wanted
+	# @return the k best parses of S over the chart of the last parse, best first
+	def kBest(self, k):
+		return KBestExtractor(self, self.words, self.P).extract(k)
+
+
+class KBestExtractor:
+	'''
+	Lazy k-best extraction (Huang and Chiang 2005, algorithm 3) over a CYK chart. Every
+	chart item X[i,j] keeps the list of its derivations found so far, best first, and a
+	heap of candidates. A derivation is a rule and split point plus the rank of the
+	derivation used for each child, and the j-th best derivation of an item is only
+	computed when a parent asks for it, so k parses cost little more than the best one.
+	The first parse is the one CYKParser.parse returns.
+	'''
+	def __init__(self, parser, words, P):
+		self.parser = parser
+		self.words = words
+		self.P = P
+		self.derivations = {}		# (i, j, X) => list of (prob, r, s, Y, Z, rank of left, rank of right)
+		self.candidates = {}		# (i, j, X) => heap of candidate derivations
+		self.seen = {}				# (i, j, X) => set of (r, s, ranks) pushed
+
+	# @param k, number of parses wanted
+	# @return a list of at most k (ParseTree, probability), best first
+	def extract(self, k):
+		N = len(self.words)
+		S_id = self.parser.symb2id.get('S')
+		if N == 0 or S_id is None or self.P[1][N][S_id] == 0.0:
+			return []
+		root = (1, N, S_id)
+		results = []
+		with METRICS.timer('cyk.kbest'):
+			for rank in range(k):
+				if not self.lazyKthBest(root, rank):
+					break
+				results.append((self.derivationTree(root, rank), self.derivations[root][rank][0]))
+		return results
+
+	# @param item, (i, j, X)
+	# @return the candidate heap of item, holding the best derivation of each hyperedge
+	def getCandidates(self, item):
+		i, j, X = item
+		P = self.P
+		cand = []
+		if i == j:
+			if P[i][i][X] > 0.0:
+				cand.append((-P[i][i][X], -1, -1, -1, -1, 0, 0))
+		else:
+			for r, Y, Z, prob in self.parser.binaryByHead[X]:
+				for s in range(i, j):
+					p = prob * P[i][s][Y] * P[s+1][j][Z]
+					if p > 0.0:
+						cand.append((-p, r, s, Y, Z, 0, 0))
+		heapq.heapify(cand)
+		self.seen[item] = set((c[1], c[2], 0, 0) for c in cand)
+		return cand
+
+	# @param item, (i, j, X)
+	# @param rank, zero-based rank of the derivation wanted
+	# @return True if item has at least rank+1 derivations, which are then in self.derivations[item]
+	def lazyKthBest(self, item, rank):
+		D = self.derivations.get(item)
+		if D is None:
+			D = self.derivations[item] = []
+			self.candidates[item] = self.getCandidates(item)
+		cand = self.candidates[item]
+		while len(D) <= rank:
+			if D:
+				self.lazyNext(item, D[-1])
+			if not cand:
+				return False
+			negP, r, s, Y, Z, left, right = heapq.heappop(cand)
+			D.append((-negP, r, s, Y, Z, left, right))
+		return True
+
+	# @param item, (i, j, X)
+	# @param d, the derivation of item just added to its list, push its successors
+	def lazyNext(self, item, d):
+		p, r, s, Y, Z, left, right = d
+		if r == -1:
+			return		# A word has a single derivation
+		i, j, X = item
+		prob = self.parser.rules[self.parser.id2symb[X]][r][2]
+		seen = self.seen[item]
+		for newLeft, newRight in ((left + 1, right), (left, right + 1)):
+			key = (r, s, newLeft, newRight)
+			if key in seen:
+				continue
+			if not self.lazyKthBest((i, s, Y), newLeft) or not self.lazyKthBest((s+1, j, Z), newRight):
+				continue
+			seen.add(key)
+			newP = prob * self.derivations[(i, s, Y)][newLeft][0] * self.derivations[(s+1, j, Z)][newRight][0]
+			heapq.heappush(self.candidates[item], (-newP, r, s, Y, Z, newLeft, newRight))
 
-		return (parseString, prob)
+	# @param item, (i, j, X)
+	# @param rank, rank of a derivation of item
+	# @return the ParseTree of the derivation
+	def derivationTree(self, item, rank):
+		tree = ParseTree()
+		stack = [(item, rank, -1)]
+		while stack:
+			item, rank, parent = stack.pop()
+			# The best derivation of a child is only materialized here
+			self.lazyKthBest(item, rank)
+			i, j, X = item
+			p, r, s, Y, Z, left, right = self.derivations[item][rank]
+			node = tree.add(self.parser.id2symb[X], parent)
+			if r == -1:
+				tree.add(self.words[i-1], node)
+			else:
+				stack.append(((s+1, j, Z), right, node))
+				stack.append(((i, s, Y), left, node))
+		return tree
 
 def main():
 	sentence = 'fish people fish tanks'
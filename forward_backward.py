@@ -0,0 +1,110 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Per-token tag posteriors for the bigram HMM with the scaled forward-backward algorithm.
+
+	tagger = HMM_Viterbi_POS_TAGGER()
+	fb = HMMPosteriors(tagger.hmm)
+	gamma = fb.posteriors(words)			# T x K, gamma[t][k] = P(tag_t = states[k] | words)
+	confidence = gamma.max(axis=1)			# Route a sentence to review if confidence.min() is low
+'''
+import numpy as np
+
+from viterbi_pos_tagger import HMMModel, HMM_Viterbi_POS_TAGGER, OOV_EMIT_P
+from max_prob_segment import MaxProbabilitySegment
+from metrics import METRICS
+
+
+class HMMPosteriors:
+	'''
+	Holds the HMMModel arrays as NumPy matrices. Each time step is a K x K matrix-vector
+	product, and batchPosteriors runs all the sentences of a batch through the same
+	time step at once.
+	'''
+	def __init__(self, hmm=None):
+		self.hmm = hmm if hmm is not None else HMMModel()
+		self.trans = np.asarray(self.hmm.trans_p, dtype=np.float64)		# K x K
+		self.init = np.asarray(self.hmm.init_p, dtype=np.float64)		# K
+		# V x K so that the emissions of a sentence are a row gather
+		self.emit = np.ascontiguousarray(np.asarray(self.hmm.emit_p, dtype=np.float64).T)
+		self.K = len(self.hmm.states)
+
+	# @param observations, a list of segmented word
+	# @return a T x K matrix of emission probabilities
+	def emissions(self, observations):
+		ids = np.array([self.hmm.word2id.get(w, -1) for w in observations], dtype=np.int64)
+		E = self.emit[np.maximum(ids, 0)]
+		E[ids < 0] = OOV_EMIT_P
+		return E
+
+	# @param observations, a list of segmented word
+	# @return a T x K matrix of posterior tag probabilities, each row sums to 1
+	def posteriors(self, observations):
+		return self.batchPosteriors([observations])[0]
+
+	# @param sentences, a list of lists of segmented words
+	# @return a list of T_i x K posterior matrices, one per sentence
+	def batchPosteriors(self, sentences):
+		B = len(sentences)
+		if B == 0:
+			return []
+		lengths = np.array([len(s) for s in sentences], dtype=np.int64)
+		Tmax = int(lengths.max())
+		K = self.K
+		if Tmax == 0:
+			return [np.zeros((0, K)) for s in sentences]
+
+		with METRICS.timer('posteriors.batch'):
+			# Padded positions get uniform emissions, their values are never read back
+			E = np.ones((B, Tmax, K))
+			for b, s in enumerate(sentences):
+				if s:
+					E[b, :len(s)] = self.emissions(s)
+
+			alpha = np.empty((B, Tmax, K))
+			scale = np.empty((B, Tmax))
+			a = self.init * E[:, 0]
+			for t in range(Tmax):
+				if t > 0:
+					a = (alpha[:, t-1] @ self.trans) * E[:, t]
+				c = a.sum(axis=1)
+				# A zero scale means the sentence is impossible under the model up to t,
+				# restart the recursion from the emissions alone
+				dead = c <= 0.0
+				if dead.any():
+					a[dead] = E[dead, t]
+					c[dead] = a[dead].sum(axis=1)
+				alpha[:, t] = a / c[:, None]
+				scale[:, t] = c
+
+			beta = np.ones((B, Tmax, K))
+			for t in range(Tmax-2, -1, -1):
+				bt = ((E[:, t+1] * beta[:, t+1]) @ self.trans.T) / scale[:, t+1, None]
+				# Positions at or past the last word of a sentence keep beta = 1
+				active = t < lengths - 1
+				beta[active, t] = bt[active]
+
+			gamma = alpha * beta
+			norm = gamma.sum(axis=2, keepdims=True)
+			gamma = np.where(norm > 0.0, gamma / np.where(norm > 0.0, norm, 1.0), 1.0 / K)
+
+		METRICS.incr('posteriors.tokens', int(lengths.sum()))
+		return [gamma[b, :lengths[b]] for b in range(B)]
+
+	# @param observations, a list of segmented word
+	# @return a list of (word, best tag, posterior probability of that tag)
+	def confidence(self, observations):
+		gamma = self.posteriors(observations)
+		best = gamma.argmax(axis=1)
+		return [(w, self.hmm.states[k], float(gamma[t, k])) for t, (w, k) in enumerate(zip(observations, best))]
+
+
+if __name__ == '__main__':
+	inputStr = '在这一年中，中国的改革开放和现代化ss建设继续向前迈进。'
+	mp = MaxProbabilitySegment()
+	segmented =  mp.MaxProbability(inputStr)
+	obs = [w.strip('/') for w in segmented.split()]
+	tagger = HMM_Viterbi_POS_TAGGER()
+	print(tagger.Viterbi(obs))
+	for word, tag, p in HMMPosteriors(tagger.hmm).confidence(obs):
+		print('{0}/{1}  {2:.4f}'.format(word, tag, p))
@@ -0,0 +1,351 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Inside-outside (EM) training of the PCFG used by CYKParser.
+
+Each iteration computes the inside and outside charts of every sentence of the corpus,
+accumulates the expected number of times each rule is used, and sets the probability
+of a rule to its expected count divided by the expected count of its head. The grammar
+is read by CYKParser.loadRules and written back in the same format, line for line, so
+the result can be given to CYKParser(rulesfile=...) directly.
+
+	python inside_outside.py corpus.txt rules_out.txt [iterations] [processes]
+
+The corpus holds one sentence per line, words separated by white spaces. Sentences with
+a word no rule generates have no parse and are skipped.
+
+The charts are NumPy arrays and all the spans of one length are computed at once, so a
+sentence of N words costs 2N array operations. Sentences are sent in batches to a
+process pool, each worker receives the grammar once and the rule probabilities with
+every batch.
+'''
+import concurrent.futures
+import math
+import os
+import sys
+
+import numpy as np
+
+from cyk_parser import CYKParser, RULES_FILE
+from metrics import METRICS
+
+DEFAULT_ITERATIONS = 10
+DEFAULT_BATCH = 64			# Sentences sent to a worker per task
+START_SYMBOL = 'S'
+
+_grammar = None			# The PCFGArrays of a worker process, set once by _initWorker
+
+
+# @param heads, array of symbol ids, one per rule
+# @return (order, starts, targets) to sum a per-rule array by symbol with np.add.reduceat
+def groupBy(heads):
+	order = np.argsort(heads, kind='stable')
+	sortedHeads = heads[order]
+	starts = np.flatnonzero(np.r_[True, sortedHeads[1:] != sortedHeads[:-1]]) if len(heads) else np.zeros(0, dtype=np.int64)
+	return order, starts, sortedHeads[starts]
+
+# @param values, array whose last axis runs over the rules
+# @param group, (order, starts, targets) returned by groupBy
+# @param M, number of symbol ids
+# @return array whose last axis runs over the symbols, the sum of the values of their rules
+def sumBySymbol(values, group, M):
+	order, starts, targets = group
+	result = np.zeros(values.shape[:-1] + (M,))
+	if len(order):
+		result[..., targets] = np.add.reduceat(values[..., order], starts, axis=-1)
+	return result
+
+
+class PCFGArrays:
+	'''
+	The rules of a CYKParser as flat arrays. Binary rule b is X -> Y Z with
+	binX[b], binY[b], binZ[b] the symbol ids and binRule[b] its index in parser.rules[X];
+	lexical rule l is lexX[l] -> word, lexRule[l] its index in parser.rules[X]. The
+	probabilities are kept apart from the structure (see probabilities()), so the same
+	arrays serve every iteration.
+	'''
+	def __init__(self, parser):
+		self.M = len(parser.symb2id) + 1		# Ids are one-based
+		self.S = parser.symb2id.get(START_SYMBOL, 0)
+		binX, binY, binZ, binRule = [], [], [], []
+		lexX, lexRule = [], []
+		lexByWord = {}
+		for X, X_id in parser.symb2id.items():
+			for r, Y, Z, p in parser.binaryByHead[X_id]:
+				binX.append(X_id)
+				binY.append(Y)
+				binZ.append(Z)
+				binRule.append(r)
+			seen = set()
+			for r, production in enumerate(parser.rules[X]):
+				# Same as CYKParser.compileRules, only the first rule for a word is used
+				if len(production) < 3 and production[0] not in seen:
+					seen.add(production[0])
+					lexByWord.setdefault(production[0], []).append(len(lexX))
+					lexX.append(X_id)
+					lexRule.append(r)
+		self.binX = np.array(binX, dtype=np.int64)
+		self.binY = np.array(binY, dtype=np.int64)
+		self.binZ = np.array(binZ, dtype=np.int64)
+		self.binRule = np.array(binRule, dtype=np.int64)
+		self.lexX = np.array(lexX, dtype=np.int64)
+		self.lexRule = np.array(lexRule, dtype=np.int64)
+		# word => (symbol ids, lexical rule ids)
+		self.lexicon = {}
+		for word, ids in lexByWord.items():
+			ids = np.array(ids, dtype=np.int64)
+			self.lexicon[word] = (self.lexX[ids], ids)
+		self.byX = groupBy(self.binX)
+		self.byY = groupBy(self.binY)
+		self.byZ = groupBy(self.binZ)
+
+	# @param parser, a CYKParser with the same rules
+	# @return (binary rule probabilities, lexical rule probabilities)
+	def probabilities(self, parser):
+		symbols = parser.nonterminals
+		binP = np.array([parser.rules[symbols[X]][r][-1] for X, r in zip(self.binX, self.binRule)], dtype=np.float64)
+		lexP = np.array([parser.rules[symbols[X]][r][-1] for X, r in zip(self.lexX, self.lexRule)], dtype=np.float64)
+		return binP, lexP
+
+	# @param binP, lexP, the rule probabilities
+	# @param words, a sentence as a list of words
+	# @return (expected binary rule counts, expected lexical rule counts, log probability of
+	# the sentence), or None if the sentence has no parse
+	def expectedCounts(self, binP, lexP, words):
+		'''
+		inside[i, k, X] is the probability of X generating words i..k-1 and outside[i, k, X]
+		the probability of S generating everything but them with X in their place. Each
+		word is scaled by its best lexical probability so long sentences do not underflow,
+		the scale factors cancel out of the expected counts.
+		'''
+		N = len(words)
+		M = self.M
+		if N == 0 or self.S == 0:
+			return None
+		inside = np.zeros((N+1, N+1, M))
+		logScale = 0.0
+		lexical = []
+		for i, w in enumerate(words):
+			entry = self.lexicon.get(w)
+			if entry is None:
+				return None
+			Xs, ids = entry
+			probs = lexP[ids]
+			scale = probs.max()
+			if scale <= 0.0:
+				return None
+			inside[i, i+1, Xs] = probs / scale
+			logScale += math.log(scale)
+			lexical.append(entry)
+
+		# All the spans of one length at once: span n is words n..n+length-1 and split d
+		# puts words n..n+d-1 on the left
+		for length in range(2, N+1):
+			starts, cuts, left, right = self.children(inside, N, length)
+			ruleInside = (left * right).sum(axis=1) * binP
+			inside[starts[:, 0], starts[:, 0] + length] = sumBySymbol(ruleInside, self.byX, M)
+		Z = inside[0, N, self.S]
+		if Z <= 0.0:
+			return None
+
+		outside = np.zeros((N+1, N+1, M))
+		outside[0, N, self.S] = 1.0
+		binCounts = np.zeros(len(binP))
+		for length in range(N, 1, -1):
+			starts = np.arange(N - length + 1)
+			parent = outside[starts, starts + length][:, self.binX] * binP		# spans x rules
+			if not parent.any():
+				continue
+			starts, cuts, left, right = self.children(inside, N, length)
+			binCounts += (parent * (left * right).sum(axis=1)).sum(axis=0)
+			parent = parent[:, None, :]
+			# Each (start, cut) and (cut, end) pair occurs once, so += does not lose updates
+			outside[starts, cuts] += sumBySymbol(parent * right, self.byY, M)
+			outside[cuts, starts + length] += sumBySymbol(parent * left, self.byZ, M)
+
+		lexCounts = np.zeros(len(lexP))
+		for i, (Xs, ids) in enumerate(lexical):
+			lexCounts[ids] += inside[i, i+1, Xs] * outside[i, i+1, Xs]
+		return binCounts / Z, lexCounts / Z, math.log(Z) + logScale
+
+	# @param inside, the inside chart
+	# @param N, number of words
+	# @param length, span length
+	# @return (starts, cuts, left, right), starts is a column of span starts, cuts[n, d] the
+	# split points of span n, left and right the inside probabilities of Y and Z for every
+	# span, split point and binary rule
+	def children(self, inside, N, length):
+		starts = np.arange(N - length + 1)[:, None]
+		cuts = starts + np.arange(1, length)[None, :]
+		left = inside[starts, cuts][..., self.binY]
+		right = inside[cuts, starts + length][..., self.binZ]
+		return starts, cuts, left, right
+
+
+def _initWorker(grammar):
+	global _grammar
+	_grammar = grammar
+
+def _countBatch(task):
+	return countBatch(_grammar, *task)
+
+# @param grammar, a PCFGArrays
+# @param binP, lexP, the rule probabilities
+# @param sentences, list of word lists
+# @return (binary counts, lexical counts, log likelihood, number of parsed sentences)
+def countBatch(grammar, binP, lexP, sentences):
+	binCounts = np.zeros(len(binP))
+	lexCounts = np.zeros(len(lexP))
+	logLikelihood = 0.0
+	parsed = 0
+	for words in sentences:
+		result = grammar.expectedCounts(binP, lexP, words)
+		if result is None:
+			continue
+		binCounts += result[0]
+		lexCounts += result[1]
+		logLikelihood += result[2]
+		parsed += 1
+	return binCounts, lexCounts, logLikelihood, parsed
+
+# @param path, one sentence per line
+# @return list of word lists, empty lines are dropped
+def readCorpus(path):
+	with open(path, encoding='utf-8') as fd:
+		return [line.split() for line in fd if line.strip() != '']
+
+
+class InsideOutsideTrainer:
+	'''
+	Holds a CYKParser whose rule probabilities are updated in place after each
+	iteration, so trainer.parser parses with the current grammar, and the process
+	pool computing the expected counts. processes=1 computes them in this process.
+	'''
+	def __init__(self, rulesfile=RULES_FILE, processes=None, batch=DEFAULT_BATCH):
+		self.rulesfile = rulesfile
+		self.parser = CYKParser(rulesfile=rulesfile)
+		self.grammar = PCFGArrays(self.parser)
+		self.binP, self.lexP = self.grammar.probabilities(self.parser)
+		self.processes = processes or os.cpu_count() or 1
+		self.batch = batch
+		self.executor = None
+		if self.processes > 1:
+			self.executor = concurrent.futures.ProcessPoolExecutor(
+				max_workers=self.processes, initializer=_initWorker, initargs=(self.grammar,))
+
+	def close(self):
+		if self.executor is not None:
+			self.executor.shutdown()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, excType, excValue, tb):
+		self.close()
+		return False
+
+	# @param sentences, list of word lists
+	# @return (binary counts, lexical counts, log likelihood, number of parsed sentences)
+	def expectedCounts(self, sentences):
+		tasks = [(self.binP, self.lexP, sentences[i:i+self.batch]) for i in range(0, len(sentences), self.batch)]
+		if self.executor is not None:
+			results = self.executor.map(_countBatch, tasks)
+		else:
+			results = (countBatch(self.grammar, *task) for task in tasks)
+		binCounts = np.zeros(len(self.binP))
+		lexCounts = np.zeros(len(self.lexP))
+		logLikelihood = 0.0
+		parsed = 0
+		for b, l, ll, n in results:
+			binCounts += b
+			lexCounts += l
+			logLikelihood += ll
+			parsed += n
+		return binCounts, lexCounts, logLikelihood, parsed
+
+	# @param binCounts, lexCounts, expected rule counts
+	def maximize(self, binCounts, lexCounts):
+		''' Normalize the counts by head, the rules of a head never used keep their probabilities '''
+		grammar = self.grammar
+		total = np.bincount(grammar.binX, weights=binCounts, minlength=grammar.M) + \
+			np.bincount(grammar.lexX, weights=lexCounts, minlength=grammar.M)
+		used = total > 0.0
+		binUsed = used[grammar.binX]
+		lexUsed = used[grammar.lexX]
+		self.binP = np.where(binUsed, binCounts / np.where(binUsed, total[grammar.binX], 1.0), self.binP)
+		self.lexP = np.where(lexUsed, lexCounts / np.where(lexUsed, total[grammar.lexX], 1.0), self.lexP)
+
+		parser = self.parser
+		symbols = parser.nonterminals
+		for X, r, p in zip(grammar.binX, grammar.binRule, self.binP):
+			parser.rules[symbols[X]][r][-1] = float(p)
+		for X, r, p in zip(grammar.lexX, grammar.lexRule, self.lexP):
+			parser.rules[symbols[X]][r][-1] = float(p)
+		parser.compileRules()
+
+	# @param sentences, list of word lists
+	# @return (log likelihood of the sentences before the update, number of parsed sentences)
+	def iterate(self, sentences):
+		with METRICS.timer('inside_outside.estep'):
+			binCounts, lexCounts, logLikelihood, parsed = self.expectedCounts(sentences)
+		self.maximize(binCounts, lexCounts)
+		METRICS.incr('inside_outside.sentences', parsed)
+		return logLikelihood, parsed
+
+	# @param path, where to write the current grammar, in the format and line order of
+	# the rules file the trainer was built from
+	def writeRules(self, path):
+		parser = self.parser
+		seen = {}		# head => number of its rules already written, the index in parser.rules
+		lines = []
+		with open(self.rulesfile) as fd:
+			for line in fd:
+				if line.strip() == '' or line.startswith('#') or '->' not in line:
+					lines.append(line)
+					continue
+				head, body = line.split('->', 1)
+				head = head.strip()
+				r = seen.get(head, 0)
+				seen[head] = r + 1
+				production = parser.rules[head][r]
+				lines.append('{0} -> {1} {2:.6g}\n'.format(head, ' '.join(production[:-1]), production[-1]))
+		tmp = path + '.tmp'
+		with open(tmp, 'w') as fd:
+			fd.writelines(lines)
+		os.replace(tmp, path)
+
+	# @param sentences, list of word lists
+	# @param outFile, rules file rewritten after every iteration
+	# @param iterations, number of EM iterations
+	# @param tolerance, stop early when the log likelihood improves by less than this
+	# @param log, function(iteration, log likelihood, parsed sentences) called after each
+	# iteration, or None
+	# @return list of the log likelihoods, one per iteration, before its update
+	def train(self, sentences, outFile, iterations=DEFAULT_ITERATIONS, tolerance=1e-4, log=None):
+		history = []
+		for it in range(iterations):
+			logLikelihood, parsed = self.iterate(sentences)
+			self.writeRules(outFile)
+			history.append(logLikelihood)
+			if log is not None:
+				log(it + 1, logLikelihood, parsed)
+			if parsed == 0 or (it > 0 and logLikelihood - history[-2] < tolerance):
+				break
+		return history
+
+
+def main():
+	if len(sys.argv) < 3:
+		print('Usage: python inside_outside.py corpus.txt rules_out.txt [iterations] [processes]')
+		return
+	iterations = int(sys.argv[3]) if len(sys.argv) > 3 else DEFAULT_ITERATIONS
+	processes = int(sys.argv[4]) if len(sys.argv) > 4 else None
+	sentences = readCorpus(sys.argv[1])
+	def log(it, logLikelihood, parsed):
+		print('Iteration {0}: log likelihood {1:.4f} over {2}/{3} sentences'.format(it, logLikelihood, parsed, len(sentences)))
+	with InsideOutsideTrainer(processes=processes) as trainer:
+		trainer.train(sentences, sys.argv[2], iterations, log=log)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,181 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Compressed sets of doc ids in the style of roaring bitmaps.
+
+The doc ids are split by their high 16 bits into chunks of 65536 ids, and each non-empty
+chunk is one container holding the low 16 bits:
+	array container		a sorted array('H'), for at most ARRAY_LIMIT ids (8 KB at most)
+	bitmap container	a Python int whose bit i is set for low bits i, for denser chunks,
+						so AND / OR / AND NOT of two dense chunks run over machine words
+						inside the interpreter
+A container is turned into the other kind whenever an operation crosses ARRAY_LIMIT, so
+no container ever takes more than 8 KB.
+
+	a = DocBitmap.fromSorted([1, 5, 70000])
+	b = DocBitmap.universe(100000) - a
+	list(a & b), len(a | b)
+'''
+import array
+import re
+
+CHUNK_BITS = 16
+LOW_MASK = (1 << CHUNK_BITS) - 1
+CHUNK_BYTES = (1 << CHUNK_BITS) // 8
+ARRAY_LIMIT = 4096		# An array container of this size takes as much memory as a bitmap container
+ONE_BIT = re.compile('1')
+
+
+# @param lows, sorted low bits
+# @return the bitmap container holding them
+def toBits(lows):
+	if isinstance(lows, int):
+		return lows
+	buf = bytearray(CHUNK_BYTES)
+	for x in lows:
+		buf[x >> 3] |= 1 << (x & 7)
+	return int.from_bytes(buf, 'little')
+
+# @param container, an array or bitmap container
+# @return its low bits, sorted
+def toLows(container):
+	if not isinstance(container, int):
+		return container
+	# bin() is most significant bit first, reversed it gives bit i at index i
+	return array.array('H', [m.start() for m in ONE_BIT.finditer(bin(container)[:1:-1])])
+
+# @param container, an int, an array or a list of sorted low bits
+# @return the container in its smallest form, None if empty
+def normalize(container):
+	if isinstance(container, int):
+		count = container.bit_count()
+		if count == 0:
+			return None
+		return toLows(container) if count <= ARRAY_LIMIT else container
+	if len(container) == 0:
+		return None
+	if len(container) > ARRAY_LIMIT:
+		return toBits(container)
+	return container if isinstance(container, array.array) else array.array('H', container)
+
+# @param bits, a bitmap container
+# @return a function telling whether a low value is in it, without shifting the int
+def memberTest(bits):
+	buf = bits.to_bytes(CHUNK_BYTES, 'little')
+	return lambda x: buf[x >> 3] >> (x & 7) & 1
+
+
+class DocBitmap:
+	'''
+	An immutable set of doc ids, containers maps the high bits of a doc id to the
+	container of its chunk. The operators &, | and - return new bitmaps.
+	'''
+	__slots__ = ('containers',)
+
+	def __init__(self, containers=None):
+		self.containers = containers if containers is not None else {}
+
+	# @param docIds, increasing doc ids
+	@classmethod
+	def fromSorted(cls, docIds):
+		containers = {}
+		high = -1
+		lows = None
+		for docId in docIds:
+			h = docId >> CHUNK_BITS
+			if h != high:
+				if lows:
+					containers[high] = normalize(lows)
+				high = h
+				lows = []
+			lows.append(docId & LOW_MASK)
+		if lows:
+			containers[high] = normalize(lows)
+		return cls(containers)
+
+	# @param n, number of documents
+	# @return the bitmap of every doc id in 0..n-1
+	@classmethod
+	def universe(cls, n):
+		containers = {}
+		for high in range((n + LOW_MASK) >> CHUNK_BITS):
+			size = min(n - (high << CHUNK_BITS), 1 << CHUNK_BITS)
+			containers[high] = normalize((1 << size) - 1)
+		return cls(containers)
+
+	def __len__(self):
+		return sum(c.bit_count() if isinstance(c, int) else len(c) for c in self.containers.values())
+
+	def __bool__(self):
+		return bool(self.containers)
+
+	def __iter__(self):
+		for high in sorted(self.containers):
+			base = high << CHUNK_BITS
+			for low in toLows(self.containers[high]):
+				yield base + low
+
+	def __contains__(self, docId):
+		c = self.containers.get(docId >> CHUNK_BITS)
+		if c is None:
+			return False
+		low = docId & LOW_MASK
+		if isinstance(c, int):
+			return memberTest(c)(low) == 1
+		lo, hi = 0, len(c)
+		while lo < hi:
+			mid = (lo + hi) // 2
+			if c[mid] < low:
+				lo = mid + 1
+			else:
+				hi = mid
+		return lo < len(c) and c[lo] == low
+
+	def __and__(self, other):
+		small, large = (self, other) if len(self.containers) <= len(other.containers) else (other, self)
+		result = {}
+		for high, a in small.containers.items():
+			b = large.containers.get(high)
+			if b is None:
+				continue
+			if isinstance(a, int) and isinstance(b, int):
+				c = normalize(a & b)
+			elif isinstance(a, int) or isinstance(b, int):
+				lows, bits = (b, a) if isinstance(a, int) else (a, b)
+				test = memberTest(bits)
+				c = normalize([x for x in lows if test(x)])
+			else:
+				c = normalize(sorted(set(a).intersection(b)))
+			if c is not None:
+				result[high] = c
+		return DocBitmap(result)
+
+	def __or__(self, other):
+		result = dict(self.containers)
+		for high, b in other.containers.items():
+			a = result.get(high)
+			if a is None:
+				result[high] = b
+			elif isinstance(a, int) or isinstance(b, int):
+				result[high] = normalize(toBits(a) | toBits(b))
+			else:
+				result[high] = normalize(sorted(set(a).union(b)))
+		return DocBitmap(result)
+
+	def __sub__(self, other):
+		result = {}
+		for high, a in self.containers.items():
+			b = other.containers.get(high)
+			if b is None:
+				result[high] = a
+				continue
+			if isinstance(a, int):
+				c = normalize(a & ~toBits(b))
+			elif isinstance(b, int):
+				test = memberTest(b)
+				c = normalize([x for x in a if not test(x)])
+			else:
+				c = normalize(sorted(set(a).difference(b)))
+			if c is not None:
+				result[high] = c
+		return DocBitmap(result)
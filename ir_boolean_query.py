@@ -0,0 +1,138 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Boolean queries over the doc id bitmaps of the index.
+
+	wind AND (rain OR storm) NOT king
+	king henry OR queen
+
+The operators AND, OR and NOT are upper case, in lower case they are ordinary terms.
+There are no phrases: quotes are stripped from the terms by the tokenizer like any
+other punctuation, so '"king henry"' is 'king AND henry', use a phrase query for the
+exact words.
+NOT binds tightest, then AND, then OR, parentheses group, and two operands with no
+operator between them are ANDed, so 'a NOT b' is 'a AND NOT b'. A query parses into a
+tree of tuples:
+	('term', text)
+	('not', node)
+	('and', [nodes])
+	('or', [nodes])
+evaluate turns it into a DocBitmap given the bitmap of a term. NOT is evaluated as a
+difference with the other operands of its AND, only a NOT standing alone is taken
+from the set of every document.
+'''
+import re
+
+TOKEN = re.compile(r'\(|\)|[^\s()]+')
+OPERATORS = ('AND', 'OR', 'NOT')
+
+
+class BooleanQueryParser:
+	'''
+	Recursive descent parser of the grammar
+		or		->	and ('OR' and)*
+		and		->	not ('AND'? not)*
+		not		->	'NOT' not | primary
+		primary	->	'(' or ')' | term
+	'''
+	# @param text, the query string
+	# @return the root node of the query
+	def parse(self, text):
+		self.tokens = TOKEN.findall(text)
+		self.pos = 0
+		if not self.tokens:
+			raise ValueError('Invalid Boolean query: empty query')
+		node = self.parseOr()
+		if self.pos < len(self.tokens):
+			raise ValueError('Invalid Boolean query: unexpected ' + self.tokens[self.pos])
+		return node
+
+	def peek(self):
+		return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+	def parseOr(self):
+		nodes = [self.parseAnd()]
+		while self.peek() == 'OR':
+			self.pos += 1
+			nodes.append(self.parseAnd())
+		return nodes[0] if len(nodes) == 1 else ('or', nodes)
+
+	def parseAnd(self):
+		nodes = [self.parseNot()]
+		while self.peek() is not None and self.peek() not in ('OR', ')'):
+			if self.peek() == 'AND':
+				self.pos += 1
+			nodes.append(self.parseNot())
+		return nodes[0] if len(nodes) == 1 else ('and', nodes)
+
+	def parseNot(self):
+		if self.peek() == 'NOT':
+			self.pos += 1
+			return ('not', self.parseNot())
+		return self.parsePrimary()
+
+	def parsePrimary(self):
+		token = self.peek()
+		if token is None:
+			raise ValueError('Invalid Boolean query: missing operand at the end')
+		self.pos += 1
+		if token == '(':
+			node = self.parseOr()
+			if self.peek() != ')':
+				raise ValueError('Invalid Boolean query: missing )')
+			self.pos += 1
+			return node
+		if token == ')' or token in OPERATORS:
+			raise ValueError('Invalid Boolean query: unexpected ' + token)
+		return ('term', token)
+
+
+# @param text, a Boolean query string
+# @return the root node of the query
+def parseBooleanQuery(text):
+	return BooleanQueryParser().parse(text)
+
+# @param node, a node of a parsed query
+# @param negated, whether node is under an odd number of NOTs
+# @return the texts of the terms a matching document may be scored on, the ones not negated
+def positiveTerms(node, negated=False):
+	kind = node[0]
+	if kind == 'term':
+		return [] if negated else [node[1]]
+	elif kind == 'not':
+		return positiveTerms(node[1], not negated)
+	return [t for child in node[1] for t in positiveTerms(child, negated)]
+
+# @param node, a node of a parsed query
+# @param termBitmap, function of the text of a term returning its DocBitmap
+# @param universe, function returning the DocBitmap of every document
+# @return the DocBitmap of the documents matching node
+def evaluate(node, termBitmap, universe):
+	kind = node[0]
+	if kind == 'term':
+		return termBitmap(node[1])
+	elif kind == 'not':
+		return universe() - evaluate(node[1], termBitmap, universe)
+	elif kind == 'or':
+		result = evaluate(node[1][0], termBitmap, universe)
+		for child in node[1][1:]:
+			result = result | evaluate(child, termBitmap, universe)
+		return result
+
+	# AND: intersect the positive operands smallest first, then subtract the negated ones
+	positives = [evaluate(child, termBitmap, universe) for child in node[1] if child[0] != 'not']
+	negatives = [child[1] for child in node[1] if child[0] == 'not']
+	if positives:
+		positives.sort(key=len)
+		result = positives[0]
+		for bitmap in positives[1:]:
+			if not result:
+				return result
+			result = result & bitmap
+	else:
+		result = universe()
+	for child in negatives:
+		if not result:
+			break
+		result = result - evaluate(child, termBitmap, universe)
+	return result
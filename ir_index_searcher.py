@@ -1,12 +1,34 @@
+import re
+import heapq
+
 from ir_indexer import Indexer
+from ir_term_dict import autoEdits
+from ir_bitmap import DocBitmap
+from ir_boolean_query import parseBooleanQuery, positiveTerms, evaluate
+from metrics import METRICS
 
 SEARCH_MODE_KEYWORD = 0
 SEARCH_MODE_PHRASE = 1
+SEARCH_MODE_SUBSTRING = 2
+SEARCH_MODE_BOOLEAN = 3
+
+MAX_EXPANSIONS = 50		# Dictionary terms a wildcard or fuzzy query term expands to at most
+FUZZY_TERM = re.compile(r'^(.+)~(\d*)$')		# 'term~' or 'term~2'
 
 class Query:
 	'''
-	Query class representing a query, two search modes are supported currently, 
-	keyword and phrase
+	Query class representing a query, four search modes are supported currently, 
+	keyword, phrase, substring and Boolean. A substring query matches the characters of
+	the documents, it needs an Indexer built with ngramSize. A Boolean query combines
+	terms with AND, OR, NOT and parentheses, see ir_boolean_query
+
+	The terms of a keyword query are expanded in the dictionary:
+		econ*		every term starting with 'econ', '*' and '?' may be anywhere
+		beuty~2		every term within 2 edits of 'beuty', 'beuty~' allows the edits
+					autoEdits gives for its length
+		beuty		a term missing from the dictionary is taken as 'beuty~'
+	The terms of a Boolean query are expanded the same way, except that a term missing
+	from the dictionary matches nothing
 	'''
 	def __init__(self, queryString, searchMode):
 		self.queryString = queryString
@@ -26,76 +48,87 @@ class Hit:
 
 class IndexSearcher:
 
-	def __init__(self, indexer):
+	# @param indexer, the Indexer searched
+	# @param tokenizer, the tokenizer of the queries, the one the index was built with by default
+	def __init__(self, indexer, tokenizer=None):
 		self.indexer = indexer
+		self.tokenizer = tokenizer if tokenizer is not None else indexer.tokenizer
 
 	# @param query, a Query object representing a query
 	# @param topN, number of hits returned with top-n scores
+	# @param cancelToken, an optional workers.CancelToken checked once per scored document
 	# @return a list of Hit objects representing search results or None if no match
-	def search(self, query, topN=10):
+	def search(self, query, topN=10, cancelToken=None):
 		'''
 		Use TF-IDF to evaluate the score of each document in the corpus given a query and
 		return topN documents with the highest score
 		'''
+		METRICS.incr('search.queries')
+		with METRICS.timer('search.total'):
+			hits = self.searchAux(query, topN, cancelToken)
+		if hits:
+			METRICS.incr('search.hits', len(hits))
+		return hits
+
+	def searchAux(self, query, topN, cancelToken):
 		hits = []
-		indices = self.indexer.indices
+		docPostings = self.indexer.docPostings
 		dictionary = self.indexer.dict
 
 		if query.searchMode == SEARCH_MODE_KEYWORD:
-			q = query.queryString.lower().strip()
-			# Return None if query string is not in our dictionary
-			if q not in dictionary or q == '':
+			# The query is tokenized like the documents, a Chinese query may give several
+			# terms and a document is scored by the sum of the TF-IDF of those it contains,
+			# weighted down for the terms matched with edits
+			terms = self.expandQuery(query.queryString.lower().strip())
+			# Return None if no query term is in our corpus
+			if not terms:
 				return
-			else:
-				indexList = indices[q]
-				# Query string does not appear in our corpus
-				if not indexList:
-					return
-				else:
-					# Used to ensure we just compute TFIDF for once for those terms which 
-					# occurs multiple times in a doc
-					seenDocs = set()	
-					for index in indexList:
-						if index.docId not in seenDocs:
-							seenDocs.add(index.docId)
-							score = self.indexer.computeTFIDF(q, index.docId)
-							hits.append( Hit(index.docId, score) )
-
-					# Sort the hits according to score 
-					hits.sort(key=lambda x: x.score, reverse=True)
-					# Return top-n hits or less if total number of hits is less than topN
-					topN = min(len(hits), topN)
-					return hits[:topN]
+			scores = {}
+			for q, weight in terms:
+				# A term of the collection may be missing from a shard
+				postings = docPostings.get(q)
+				if not postings:
+					continue
+				# The doc-level tier gives each document once with its term frequency
+				METRICS.incr('search.postings', len(postings))
+				for docId, tf in postings:
+					if cancelToken is not None:
+						cancelToken.check()
+					scores[docId] = scores.get(docId, 0.0) + self.weighted(self.indexer.termScore(q, docId, tf, len(postings)), weight)
+			hits = [Hit(docId, score) for docId, score in scores.items()]
+
+			# Sort the hits according to score 
+			hits.sort(key=lambda x: x.score, reverse=True)
+			# Return top-n hits or less if total number of hits is less than topN
+			topN = min(len(hits), topN)
+			return hits[:topN]
 
 		elif query.searchMode == SEARCH_MODE_PHRASE:
-			docSet = set()	# Docs left in this set are those containing all query terms of the query string
-			queries = query.queryString.lower().strip().split()
-			flag = False
+			docSet = None	# Docs left in this set are those containing all query terms of the query string
+			queries = self.tokenizer.tokenize(query.queryString.lower().strip())
 
 			if not queries:
 				return
 
 			for q in queries:
 				# Part of the query string is not in corpus, return None
-				if q not in dictionary:
-					return
-				
-				indexList = indices[q]
-				# Part of the query string is not in corpus, return None
-				if not indexList:
+				if q not in dictionary or not docPostings.get(q):
 					return
-				else:
-					newDocSet = set([index.docId for index in indexList])
-					if not flag:
-						flag = True
-						docSet = newDocSet
-					else:
-						docSet = docSet.intersection(newDocSet)
+				bitmap = self.indexer.docSets[q]
+				METRICS.incr('search.bitmap_docs', len(bitmap))
+				docSet = bitmap if docSet is None else docSet & bitmap
+
+			# The positions of the query terms in the candidates, from the positional tier
+			positions = None
+			if len(queries) > 1 and docSet:
+				positions = self.indexer.loadPositions(queries, set(docSet))
 
 			for doc in docSet:
+				if cancelToken is not None:
+					cancelToken.check()
 
 				# Check if this document contains the whole continguous query string
-				if not self.containsWholeQuery(queries, doc):
+				if not self.containsWholeQuery(queries, doc, positions):
 					continue
 				else:
 					score = 0.0
@@ -113,10 +146,137 @@ class IndexSearcher:
 
 			return hits[:topN]
 
+		elif query.searchMode == SEARCH_MODE_SUBSTRING:
+			ngramIndex = self.indexer.ngramIndex
+			if ngramIndex is None:
+				raise ValueError('Substring search needs an Indexer built with ngramSize')
+			matches = ngramIndex.search(query.queryString.lower().strip(), cancelToken)
+			if not matches:
+				return
+			for docId, starts in matches.items():
+				hits.append(Hit(docId, ngramIndex.computeTFIDF(docId, len(starts), len(matches))))
+
+			hits.sort(key=lambda x: x.score, reverse=True)
+			topN = min(len(hits), topN)
+			return hits[:topN]
+
+		elif query.searchMode == SEARCH_MODE_BOOLEAN:
+			# The operators are upper case, the terms are lowercased when looked up
+			root = parseBooleanQuery(query.queryString.strip())
+			universe = lambda: DocBitmap.universe(self.indexer.totalDocs)
+			with METRICS.timer('search.boolean'):
+				docSet = evaluate(root, lambda text: self.termBitmap(text)[0], universe)
+			if not docSet:
+				return
+			METRICS.incr('search.boolean_docs', len(docSet))
+			scores = self.scoreDocSet(docSet, positiveTerms(root), cancelToken)
+			hits = [Hit(docId, scores.get(docId, 0.0)) for docId in docSet]
+			# Documents with equal scores stay in doc id order
+			return heapq.nlargest(topN, hits, key=lambda x: x.score)
+
 		else:
 			raise ValueError('Invalid query, not supported search mode')
 
-	def containsWholeQuery(self, queries, docId):
+	# @param text, a term of a Boolean query
+	# @return (DocBitmap of the documents matching it, list of (term, weight) of the
+	# dictionary terms it is scored on), the bitmap is the union over every term a
+	# wildcard or fuzzy term expands to, only the terms scored are cut to MAX_EXPANSIONS
+	def termBitmap(self, text):
+		text = text.lower()
+		docSets = self.indexer.docSets
+		if '*' in text or '?' in text or FUZZY_TERM.match(text):
+			terms = self.expandQuery(text, None)
+			result = DocBitmap()
+			for t, weight in terms:
+				if t in docSets:
+					result = result | docSets[t]
+			return (result, self.capExpansions(terms))
+		# A term the tokenizer splits, such as a Chinese word, needs all its parts
+		words = self.tokenizer.tokenize(text)
+		if not words or any(not self.indexer.docPostings.get(q) for q in words):
+			return (DocBitmap(), [])
+		bitmaps = sorted((docSets[q] for q in words), key=len)
+		result = bitmaps[0]
+		for bitmap in bitmaps[1:]:
+			result = result & bitmap
+		return (result, [(q, 1.0) for q in words])
+
+	# @param docSet, DocBitmap of the documents matching a Boolean query
+	# @param texts, the terms of the query not under a NOT
+	# @param cancelToken, an optional workers.CancelToken checked once per term
+	# @return dict doc id => sum of the TF-IDF of the terms the document contains, for the
+	# documents of docSet and possibly others
+	def scoreDocSet(self, docSet, texts, cancelToken):
+		indexer = self.indexer
+		weights = {}
+		for text in texts:
+			for t, weight in self.termBitmap(text)[1]:
+				weights[t] = max(weight, weights.get(t, 0.0))
+		scores = {}
+		for t, weight in weights.items():
+			if cancelToken is not None:
+				cancelToken.check()
+			postings = indexer.docPostings.get(t)
+			if not postings:
+				continue
+			METRICS.incr('search.postings', len(postings))
+			for docId, tf in postings:
+				scores[docId] = scores.get(docId, 0.0) + self.weighted(indexer.termScore(t, docId, tf, len(postings)), weight)
+		return scores
+
+	# @param text, a keyword query string, lowercased
+	# @param limit, number of terms a query term expands to at most, None for all of them
+	# @return a list of (term, weight) of the terms of our corpus the query stands for, the
+	# weight is 1 / (1 + edit distance)
+	def expandQuery(self, text, limit=MAX_EXPANSIONS):
+		termDict = self.indexer.termDict
+		weights = {}
+		for token in text.split():
+			if '*' in token or '?' in token:
+				expansions = [(t, 1.0) for t in termDict.wildcard(token)]
+			else:
+				m = FUZZY_TERM.match(token)
+				maxEdits = None
+				if m is not None:
+					token = m.group(1)
+					maxEdits = int(m.group(2)) if m.group(2) else -1
+				expansions = []
+				for q in self.tokenizer.tokenize(token):
+					if maxEdits is None and q in termDict:
+						expansions.append((q, 1.0))
+					else:
+						edits = maxEdits if maxEdits is not None and maxEdits >= 0 else autoEdits(q)
+						expansions.extend((t, 1. / (1 + d)) for t, d in termDict.fuzzy(q, edits))
+			METRICS.incr('search.expanded_terms', len(expansions))
+			if limit is not None:
+				expansions = self.capExpansions(expansions, limit)
+			for t, weight in expansions:
+				# Skip the terms not appearing in our corpus
+				if self.indexer.termCount(t) and weight > weights.get(t, 0.0):
+					weights[t] = weight
+		return list(weights.items())
+
+	# @param expansions, a list of (term, weight)
+	# @param limit, number of terms kept at most
+	# @return the closest, then the most frequent terms of expansions
+	def capExpansions(self, expansions, limit=MAX_EXPANSIONS):
+		if len(expansions) <= limit:
+			return expansions
+		expansions = sorted(expansions, key=lambda e: (-e[1], -self.indexer.termCount(e[0])))
+		return expansions[:limit]
+
+	# @param score, a TF-IDF, negative when the term frequency is below 0.1
+	# @param weight, in (0, 1]
+	# @return the score lowered by the fraction 1 - weight of its magnitude
+	def weighted(self, score, weight):
+		return score - (1. - weight) * abs(score)
+
+	# @param queries, a list of query terms
+	# @param docId, the target document of interest, containing every query term
+	# @param positions, dict term => dict doc id => positions returned by
+	# Indexer.loadPositions for the document, None for a single term
+	# @return True if the query terms are at consecutive positions in the document
+	def containsWholeQuery(self, queries, docId, positions):
 		'''
 		Check if the target document contains a whole continguous query terms 
 		'''
@@ -125,31 +285,14 @@ class IndexSearcher:
 			# contain the whole continguous query string if it's length is 1
 			return True
 		else:
-			# Begin recursively checking if the next term of the query follows
-			# the current term in the same document
-			q = queries[0]
-			for index in [idx for idx in self.indexer.indices[q] if idx.docId == docId]:
-				pos = index.wordPos
-				if self.hasTermAtPosition(queries, 1, docId, pos+1):
-					return True
-			return False
-
-	# @param queries, a list of query terms
-	# @param i, used to get the current query term
-	# @param docId, the target document of interest
-	# @param pos, position of the current query term in the target document
-	# @return True if `queries[i]` is at position `pos` in document `docId` recursively or False 
-	def hasTermAtPosition(self, queries, i, docId, pos):
-		'''
-		Recursively check if the query terms exists in order in the target document
-		'''
-		if i == len(queries):
+			# The start positions where the first term is followed by the i-th term at
+			# offset i, for every i
+			starts = set(positions[queries[0]].get(docId, ()))
+			for i in range(1, len(queries)):
+				starts.intersection_update(p - i for p in positions[queries[i]].get(docId, ()))
+				if not starts:
+					return False
 			return True
-		q = queries[i]
-		for index in self.indexer.indices[q]:
-			if index.docId == docId and index.wordPos == pos:
-				return self.hasTermAtPosition(queries, i+1, docId, pos+1)
-		return False		
 
 
 
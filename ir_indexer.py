@@ -1,23 +1,54 @@
 import operator
-import re
-import string
 import math
 
+from metrics import METRICS
+from ir_tokenizer import WhitespaceTokenizer
+from ir_ngram_index import NgramIndex
+from ir_term_dict import TermDictionary
+from ir_bitmap import DocBitmap
+from ir_postings import DocPostings
 
-class Index:
+
+class CollectionStats:
 	'''
-	A class representing an Inverted-Index object
+	Statistics of a whole collection split into index shards. Set on the Indexer of each
+	shard, they make its TF-IDF and its query expansion agree with those of one index
+	over the whole collection
 	'''
-	def __init__(self, docId, wordPos):
-		self.docId = docId
-		self.wordPos = wordPos
-
-	def __str__(self):
-		return '({0},{1})'.format(self.docId, self.wordPos)
+	# @param totalDocs, number of documents of the collection
+	# @param docFreqs, dict term => number of documents containing it
+	# @param termCounts, dict term => number of occurrences of it
+	def __init__(self, totalDocs, docFreqs, termCounts):
+		self.totalDocs = totalDocs
+		self.docFreqs = docFreqs
+		self.termCounts = termCounts
+
+	# @param statsList, the CollectionStats of the parts of a collection
+	# @return the CollectionStats of the whole collection
+	@classmethod
+	def merge(cls, statsList):
+		docFreqs = {}
+		termCounts = {}
+		for stats in statsList:
+			for term, n in stats.docFreqs.items():
+				docFreqs[term] = docFreqs.get(term, 0) + n
+			for term, n in stats.termCounts.items():
+				termCounts[term] = termCounts.get(term, 0) + n
+		return cls(sum(stats.totalDocs for stats in statsList), docFreqs, termCounts)
 
 
 class Indexer:
-	def __init__(self, docsFile, indexFile, dictFile, paramsFile):
+	'''
+	The index has two tiers. The doc-level tier, docPostings, maps a term to its
+	DocPostings (doc id, term frequency) and is all the ranking reads, it stays in memory.
+	The positional tier is the index file itself, one line per term listing its
+	(doc id, word position) pairs: only the offsets of the lines are kept in memory, and
+	loadPositions reads the lines of the terms of a phrase query when it is verified.
+	'''
+	# @param tokenizer, an ir_tokenizer tokenizer, WhitespaceTokenizer by default
+	# @param ngramSize, also build a character n-gram index of this n for substring search,
+	# or None
+	def __init__(self, docsFile, indexFile, dictFile, paramsFile, tokenizer=None, ngramSize=None):
 		self.docsFile = docsFile
 		self.indexFile = indexFile
 		self.dictFile = dictFile
@@ -25,11 +56,25 @@ class Indexer:
 		self.totalDocs = 0				# Total number of documents
 		self.totalTermsPerDoc = []		# Total number of terms in each document
 		self.dict = None 
-		self.indices = None
-
-		# Use this to build the indices
-		self.buildDict()
-		self.buildIndex()
+		self.termDict = None			# The terms of dict, sorted for prefix, wildcard and fuzzy lookups
+		self.docPostings = None			# term => DocPostings, the doc-level tier
+		self.positionOffsets = None		# term => byte offset of its line in the index file, the positional tier
+		self.docSets = None				# term => DocBitmap of the documents containing it
+		self.tokenizer = tokenizer if tokenizer is not None else WhitespaceTokenizer()
+		self.ngramIndex = None
+		self.collectionStats = None		# CollectionStats of the whole collection if this index is a shard of it
+
+		# Use this to build the indices, the documents are tokenized once for both
+		texts = self.readDocs()
+		with METRICS.timer('index.tokenize'):
+			docs = self.tokenizeDocs(texts)
+		with METRICS.timer('index.build_dict'):
+			self.buildDict(docs)
+		with METRICS.timer('index.build_index'):
+			self.buildIndex(docs)
+		if ngramSize is not None:
+			with METRICS.timer('index.build_ngrams'):
+				self.buildNgramIndex(ngramSize, texts)
 
 		# Use this to prepare data for the searcher
 		# self.loadDict()
@@ -37,93 +82,188 @@ class Indexer:
 		# self.loadParamsFromFile()
 
 
-	def buildDict(self):
+	# @return the documents, lowercased, one per line of the documents file
+	def readDocs(self):
+		with open(self.docsFile, encoding='utf-8') as fd:
+			return [doc.rstrip('\n').lower() for doc in fd]
+
+	# @param texts, the documents returned by readDocs, or None to read them
+	# @return a list of word lists, one per document
+	def tokenizeDocs(self, texts=None):
+		if texts is None:
+			texts = self.readDocs()
+		return self.tokenizer.tokenizeMany(texts)
+
+	# @param n, the n-gram size
+	# @param texts, the documents returned by readDocs, or None to read them
+	def buildNgramIndex(self, n, texts=None):
+		if texts is None:
+			texts = self.readDocs()
+		self.ngramIndex = NgramIndex(n)
+		self.ngramIndex.build(texts)
+
+	# @param docs, the documents returned by tokenizeDocs, or None to read them
+	def buildDict(self, docs=None):
+		if docs is None:
+			docs = self.tokenizeDocs()
 		self.dict = {}
 		newIndex = 0
-		with open(self.docsFile) as fd:
-			for i, line in enumerate(fd):
-				line = line.lower()
-				words = self.preprocess(line)	# Preprocess each doc 
-				for word in words:
-					if word not in self.dict:
-						self.dict[word] = newIndex
-						newIndex += 1
-		with open(self.dictFile, 'w') as fd:
+		for words in docs:
+			for word in words:
+				if word not in self.dict:
+					self.dict[word] = newIndex
+					newIndex += 1
+		self.termDict = TermDictionary(self.dict)
+		with open(self.dictFile, 'w', encoding='utf-8') as fd:
 			for word, id in sorted(self.dict.items(), key=operator.itemgetter(1)):
 				fd.write(word + '\n')
 
 	def loadDict(self):
 		self.dict = {}
-		with open(self.dictFile) as fd:
+		with open(self.dictFile, encoding='utf-8') as fd:
 			for id, word in enumerate(fd):
 				self.dict[word.strip()] = id
+		self.termDict = TermDictionary(self.dict)
 
 	# @param doc, a document's string
-	# @return a list of words with punctuations removed
+	# @return a list of words with punctuations removed, by the tokenizer of the index
 	def preprocess(self, doc):
-		regex = re.compile('[{0}]'.format(re.escape(string.punctuation)))
-		doc = regex.sub('', doc)
-		return doc.split()
-
-	def buildIndex(self):
-		forwardIndices = []
-
-		with open(self.docsFile) as fd:
-			for i, doc in enumerate(fd):
-				doc = doc.lower()
-				self.totalDocs += 1
-				words = self.preprocess(doc)
-				self.totalTermsPerDoc.append(len(words))
-				for j, word in enumerate(words):
-					forwardIndices.append( (word, Index(i, j)) )
-
-			# Sort the forward indices such that index objects of the same term groups together
-			forwardIndices.sort(key=lambda x: x[0])
-			
-			# Initialize the value of each term=>indices mapping to a empty list
-			self.indices = {}
-			for word in self.dict:
-				self.indices[word] = []
-
-			# Collect the indices
-			for word, index in forwardIndices:
-				self.indices[word].append(index)
-
-			self.saveIndexToFile()
-			self.saveParamsToFile()
-
-	def saveIndexToFile(self):
+		return self.tokenizer.tokenize(doc)
+
+	# @param docs, the documents returned by tokenizeDocs, or None to read them
+	def buildIndex(self, docs=None):
+		if docs is None:
+			docs = self.tokenizeDocs()
+		# Initialize the value of each term=>postings mapping to a empty list, in the
+		# order of the dictionary
+		postingLists = {}
+		for word in self.dict:
+			postingLists[word] = []
+
+		# Collect the (doc id, positions) of each term, in doc id order
+		for i, words in enumerate(docs):
+			self.totalDocs += 1
+			self.totalTermsPerDoc.append(len(words))
+			positions = {}
+			for j, word in enumerate(words):
+				wordPositions = positions.get(word)
+				if wordPositions is None:
+					positions[word] = [j]
+				else:
+					wordPositions.append(j)
+			for word, wordPositions in positions.items():
+				postingLists[word].append((i, wordPositions))
+
+		self.docPostings = {}
+		for word, postingList in postingLists.items():
+			if postingList:
+				self.docPostings[word] = DocPostings([docId for docId, ps in postingList], [len(ps) for docId, ps in postingList])
+		self.buildDocSets()
+
+		# The positions are only kept on disk
+		self.saveIndexToFile(postingLists)
+		self.saveParamsToFile()
+
+	# @param postingLists, dict term => list of (doc id, positions), in doc id order
+	def saveIndexToFile(self, postingLists):
 		'''
-		Serialized the indices to file
+		Serialize the positional tier to file and record the offset of each term's line
 		'''
-		with open(self.indexFile, 'w') as fd:
-			for term, indexList in self.indices.items():
-				fd.write(term)
-				for index in indexList:
-					fd.write(' ' + str(index))
-				fd.write('\n')
+		self.positionOffsets = {}
+		with open(self.indexFile, 'wb') as fd:
+			offset = 0
+			for term, postingList in postingLists.items():
+				line = term + ''.join(' ({0},{1})'.format(docId, p) for docId, ps in postingList for p in ps) + '\n'
+				data = line.encode('utf-8')
+				fd.write(data)
+				self.positionOffsets[term] = offset
+				offset += len(data)
 
 	def loadIndexFromFile(self):
 		'''
-		Deserialize the indices from file
+		Build the doc-level tier from the index file and record the offset of each
+		term's line, the positions are not kept
 		'''
-		with open(self.indexFile) as fd:
-			self.indices = {}
-			for word in self.dict:
-				self.indices[word] = []
-
+		self.docPostings = {}
+		self.positionOffsets = {}
+		with open(self.indexFile, 'rb') as fd:
+			offset = 0
 			for line in fd:
-				term = ''
-				indexList = []
-
-				items = line.strip().split()
+				items = line.decode('utf-8').split()
 				term = items[0]
-
-				if len(items) > 1:
-					for item in items[1:]:
-						it = item.strip('()')
-						docId, wordPos = it.split(',')
-						self.indices[term].append( Index(int(docId), int(wordPos)) )
+				self.positionOffsets[term] = offset
+				offset += len(line)
+
+				docIds = []
+				tfs = []
+				for item in items[1:]:
+					docId = int(item[1:item.index(',')])
+					if docIds and docIds[-1] == docId:
+						tfs[-1] += 1
+					else:
+						docIds.append(docId)
+						tfs.append(1)
+				if docIds:
+					self.docPostings[term] = DocPostings(docIds, tfs)
+		self.buildDocSets()
+
+	# @param terms, terms of the index
+	# @param docIds, a set of doc ids
+	# @return dict term => dict doc id => positions of the term in the documents of docIds,
+	# read from the positional tier
+	def loadPositions(self, terms, docIds):
+		result = {}
+		with open(self.indexFile, 'rb') as fd:
+			for term in terms:
+				if term in result:
+					continue
+				fd.seek(self.positionOffsets[term])
+				positions = {}
+				for item in fd.readline().decode('utf-8').split()[1:]:
+					docId, wordPos = item.strip('()').split(',')
+					docId = int(docId)
+					if docId in docIds:
+						positions.setdefault(docId, []).append(int(wordPos))
+				result[term] = positions
+		METRICS.incr('index.positional_reads', len(result))
+		return result
+
+	def buildDocSets(self):
+		'''
+		Compress the doc ids of the postings of each term into a bitmap, for the Boolean
+		queries and the intersections of the phrase queries
+		'''
+		self.docSets = {}
+		for term, postings in self.docPostings.items():
+			self.docSets[term] = DocBitmap.fromSorted(postings.docIds)
+
+	# @return the CollectionStats of the documents of this index
+	def localStats(self):
+		docFreqs = dict((term, len(postings)) for term, postings in self.docPostings.items())
+		termCounts = dict((term, postings.total) for term, postings in self.docPostings.items())
+		return CollectionStats(self.totalDocs, docFreqs, termCounts)
+
+	# @param stats, the CollectionStats of the collection this index is a shard of, its
+	# terms replace those of this index in the expansion of the query terms
+	def setCollectionStats(self, stats):
+		self.collectionStats = stats
+		self.termDict = TermDictionary(stats.termCounts)
+
+	# @param term, a term
+	# @return number of occurrences of term in the collection
+	def termCount(self, term):
+		if self.collectionStats is not None:
+			return self.collectionStats.termCounts.get(term, 0)
+		postings = self.docPostings.get(term)
+		return postings.total if postings is not None else 0
+
+	# @param term, a term
+	# @param numDocs, number of documents of this index containing term
+	# @return the IDF of term, over the whole collection if this index is a shard of it
+	def computeIDF(self, term, numDocs):
+		if self.collectionStats is not None:
+			return math.log10(self.collectionStats.totalDocs / self.collectionStats.docFreqs[term])
+		return math.log10(self.totalDocs / numDocs)
 
 	def saveParamsToFile(self):
 		with open(self.paramsFile, 'w') as fd:
@@ -138,7 +278,7 @@ class Indexer:
 	def getDocsFromIds(self, docIds):
 		docs = {}
 		docIds.sort()
-		with open(self.docsFile) as fd:
+		with open(self.docsFile, encoding='utf-8') as fd:
 			j = 0
 			for i, doc in enumerate(fd):
 				if i == docIds[j]:
@@ -155,20 +295,18 @@ class Indexer:
 		'''
 		Compute the TFIDF given a term and the document it resides
 		'''
-		numTerms = 0	# Count of occurences of the given term in the this doc
-		numDocs = 0		# Count of docs containing the given term
-
-		seenDocs = set()
-		for index in self.indices[term]:
-			if index.docId == docId:
-				numTerms += 1
-			if index.docId not in seenDocs:
-				seenDocs.add(index.docId)
-				numDocs += 1
+		postings = self.docPostings[term]
+		return self.termScore(term, docId, postings.frequency(docId), len(postings))
+
+	# @param term, a term
+	# @param docId, a document containing it
+	# @param numTerms, count of occurences of the term in this doc
+	# @param numDocs, count of docs of this index containing the term
+	# @return the TF-IDF of the term in the document
+	def termScore(self, term, docId, numTerms, numDocs):
 		tf = numTerms / self.totalTermsPerDoc[docId]
-		df = self.totalDocs / numDocs
 
-		tfidf = (1. + math.log10(tf)) * math.log10(df)
+		tfidf = (1. + math.log10(tf)) * self.computeIDF(term, numDocs)
 
 		return tfidf
 
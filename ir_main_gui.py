@@ -7,9 +7,11 @@ from tkinter.filedialog import askopenfilename
 
 from ir_indexer import Indexer
 from ir_index_searcher import *
+from ir_boolean_query import parseBooleanQuery, positiveTerms
 from tkHyperlinkManager import HyperlinkManager
+from metrics import METRICS
+from workers import BackgroundRunner, Cancelled
 
-import time
 import re
 
 class App(Frame):
@@ -19,9 +21,11 @@ class App(Frame):
          
         self.parent = parent
         
+        METRICS.enable()
+        self.runner = BackgroundRunner(self)
         self.initUI()
 
-        indexer = Indexer('data/docs.txt', 'data/index.txt', 'data/dict.txt', 'data/params.txt')
+        indexer = Indexer('data/docs.txt', 'data/index.txt', 'data/dict.txt', 'data/params.txt', ngramSize=2)
         self.searcher = IndexSearcher(indexer)
         self.resultDocs = {}
         self.query = ''
@@ -29,6 +33,7 @@ class App(Frame):
     def initUI(self):
       
         self.parent.bind('<Return>', self.onSearch)
+        self.parent.bind('<Escape>', self.onCancel)
         self.parent.title("基于TF-IDF信息检索 -- Search for Shakespeare")
         self.pack(fill=BOTH, expand=1)
 
@@ -50,6 +55,15 @@ class App(Frame):
         self.phraseMode = Radiobutton(self, text="短语模式", variable=self.mode, value=2)
         self.phraseMode.pack()
 
+        self.substringMode = Radiobutton(self, text="子串模式", variable=self.mode, value=3)
+        self.substringMode.pack()
+
+        self.booleanMode = Radiobutton(self, text="布尔模式 (AND/OR/NOT)", variable=self.mode, value=4)
+        self.booleanMode.pack()
+
+        self.progress = Progressbar(self, mode='indeterminate', length=200)
+        self.progress.pack()
+
         self.label2 = Label(self, text=' 结果：')
         self.label2.pack(anchor="w")
 
@@ -71,44 +85,67 @@ class App(Frame):
         self.outputText.delete('1.0', END)
         self.docText.delete('1.0', END)
         self.query = query.lower()
-        isResultEmpty = True
-        start = time.clock()
+        METRICS.reset()
 
         if self.mode.get() == 1:
             q = Query(query, SEARCH_MODE_KEYWORD)
-
-            hits = self.searcher.search(q, 10)
-            elapsed = time.clock() - start
-
-            if hits is not None:
-                isResultEmpty = False
-                for hit in hits:
-                    linkText = 'doc {0}'.format(hit.docId)
-                    self.outputText.insert(INSERT, linkText, 
-                    self.hyperlinkManager.add(self.onLinkClicked, hit.docId))
-                    self.outputText.insert(INSERT, '    score: {0:.6f}\n'.format(hit.score))
-        else:
+        elif self.mode.get() == 2:
             q = Query(query, SEARCH_MODE_PHRASE)
-            hits = self.searcher.search(q, 10)
-            elapsed = time.clock() - start
+        elif self.mode.get() == 3:
+            q = Query(query, SEARCH_MODE_SUBSTRING)
+        else:
+            q = Query(query, SEARCH_MODE_BOOLEAN)
 
+        def work(token):
+            hits = self.searcher.search(q, 10, token)
+            docs = {}
             if hits is not None:
-                isResultEmpty = False
-                for hit in hits:
-                    linkText = 'doc {0}'.format(hit.docId)
-                    self.outputText.insert(INSERT, linkText, 
-                    self.hyperlinkManager.add(self.onLinkClicked, hit.docId))
-                    self.outputText.insert(INSERT, '    score: {0:.6f}\n'.format(hit.score))
-
-        if isResultEmpty:
+                docs = self.searcher.indexer.getDocsFromIds([hit.docId for hit in hits])
+                if q.searchMode == SEARCH_MODE_KEYWORD:
+                    # Highlight the dictionary terms the query was expanded to
+                    terms = sorted((t for t, w in self.searcher.expandQuery(self.query)), key=len, reverse=True)
+                    self.query = '|'.join(re.escape(t) for t in terms)
+                elif q.searchMode == SEARCH_MODE_BOOLEAN:
+                    # Highlight the terms not under a NOT
+                    terms = set(t for text in positiveTerms(parseBooleanQuery(query)) for t, w in self.searcher.termBitmap(text)[1])
+                    # A query of NOT only has nothing to highlight, (?!) never matches
+                    self.query = '|'.join(re.escape(t) for t in sorted(terms, key=len, reverse=True)) or '(?!)'
+                else:
+                    self.query = re.escape(self.query)
+            return (hits, docs)
+
+        self.label2['text'] = ' 搜索中...'
+        self.progress.start()
+        self.runner.submit(work, self.showHits, self.onSearchError)
+
+    def showHits(self, result):
+        self.progress.stop()
+        hits, docs = result
+        if hits is None:
+            self.label2['text'] = ' 结果：'
             self.outputText.insert(INSERT, '0 results returned')
             return
 
-        self.label2['text'] = ' 结果：     耗时：{0:.1f} ms'.format(elapsed*1000)
-        docIds = [hit.docId for hit in hits]
-        self.resultDocs = self.searcher.indexer.getDocsFromIds(docIds)
+        for hit in hits:
+            linkText = 'doc {0}'.format(hit.docId)
+            self.outputText.insert(INSERT, linkText, 
+            self.hyperlinkManager.add(self.onLinkClicked, hit.docId))
+            self.outputText.insert(INSERT, '    score: {0:.6f}\n'.format(hit.score))
+
+        self.label2['text'] = ' 结果：     ' + METRICS.summary('search.')
+        self.resultDocs = docs
         self.onLinkClicked(hits[0].docId)
 
+    def onSearchError(self, error):
+        self.progress.stop()
+        if isinstance(error, Cancelled):
+            self.label2['text'] = ' 已取消'
+        else:
+            self.label2['text'] = ' 出错: ' + str(error)
+
+    def onCancel(self, event=None):
+        self.runner.cancel()
+
     def onLinkClicked(self, docId):
         self.docText.delete('1.0', END)
         # self.docText.insert(INSERT, self.resultDocs[docId])
@@ -0,0 +1,131 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Character n-gram positional index for substring search without segmentation.
+
+Every character offset of a document starts one gram, text[i:i+n], the last n-1 grams
+of a document being shorter. A substring query of length m >= n is covered by the grams
+at offsets 0, n, 2n, ... and m-n: the documents holding all of them are intersected,
+rarest gram first, and a start position p is a match when every covering gram of the
+query sits at p plus its offset. A query shorter than n is every gram it is a prefix of.
+Matching is exact, and does not depend on the coverage of a dictionary.
+
+	index = NgramIndex(2)
+	index.build(['the old man', '人民生活进一步改善'])
+	index.search('生活')			{1: [2]}
+'''
+import bisect
+import math
+
+from ir_postings import Postings, encodePostings
+from metrics import METRICS
+
+DEFAULT_NGRAM = 2
+
+
+class NgramIndex:
+	def __init__(self, n=DEFAULT_NGRAM):
+		if n < 1:
+			raise ValueError('The n-gram size must be at least 1')
+		self.n = n
+		self.postings = {}			# gram => Postings
+		self.grams = []				# Sorted grams, for the queries shorter than n
+		self.docLengths = []		# Number of characters of each document
+		self.totalDocs = 0
+
+	# @param texts, the documents, doc ids are their indices
+	def build(self, texts):
+		n = self.n
+		lists = {}		# gram => list of (doc id, positions)
+		self.docLengths = []
+		for docId, text in enumerate(texts):
+			self.docLengths.append(len(text))
+			grams = {}
+			for i in range(len(text)):
+				gram = text[i:i+n]
+				positions = grams.get(gram)
+				if positions is None:
+					grams[gram] = [i]
+				else:
+					positions.append(i)
+			for gram, positions in grams.items():
+				entries = lists.get(gram)
+				if entries is None:
+					lists[gram] = [(docId, positions)]
+				else:
+					entries.append((docId, positions))
+		self.totalDocs = len(self.docLengths)
+		self.postings = dict((gram, Postings(encodePostings(entries), len(entries))) for gram, entries in lists.items())
+		self.grams = sorted(self.postings)
+
+	# @param query, the substring searched for, as it appears in the documents
+	# @param cancelToken, an optional workers.CancelToken checked once per candidate document
+	# @return dict doc id => sorted start positions of the query in the document
+	def search(self, query, cancelToken=None):
+		m = len(query)
+		n = self.n
+		if m == 0:
+			return {}
+		if m < n:
+			return self.searchPrefix(query)
+
+		offsets = list(range(0, m - n + 1, n))
+		if offsets[-1] != m - n:
+			offsets.append(m - n)
+		covering = []
+		for k in offsets:
+			postings = self.postings.get(query[k:k+n])
+			if postings is None:
+				return {}
+			covering.append((postings, k))
+		covering.sort(key=lambda item: item[0].docFreq)
+
+		# Candidate documents, intersected from the rarest gram
+		candidates = set(covering[0][0].docIds())
+		for postings, k in covering[1:]:
+			if not candidates:
+				return {}
+			candidates.intersection_update(postings.docIds())
+		METRICS.incr('search.postings', sum(postings.docFreq for postings, k in covering))
+		if not candidates:
+			return {}
+
+		# Positions of the covering grams in the candidates, then the start positions
+		# every one of them agrees with
+		selected = [(postings.select(candidates), k) for postings, k in covering]
+		result = {}
+		for docId in sorted(candidates):
+			if cancelToken is not None:
+				cancelToken.check()
+			positions, k = selected[0]
+			starts = set(p - k for p in positions[docId])
+			for positions, k in selected[1:]:
+				starts.intersection_update(p - k for p in positions[docId])
+				if not starts:
+					break
+			if starts:
+				result[docId] = sorted(starts)
+		return result
+
+	# @param query, a string shorter than n
+	# @return dict doc id => sorted start positions of the query in the document
+	def searchPrefix(self, query):
+		result = {}
+		i = bisect.bisect_left(self.grams, query)
+		while i < len(self.grams) and self.grams[i].startswith(query):
+			for docId, positions in self.postings[self.grams[i]]:
+				result.setdefault(docId, []).extend(positions)
+			i += 1
+		for positions in result.values():
+			positions.sort()
+		return result
+
+	# @param docId, a document matching a query
+	# @param occurrences, number of matches of the query in the document
+	# @param numDocs, number of documents matching the query
+	# @return the TF-IDF of the query in the document, tf relative to the document length
+	# in characters
+	def computeTFIDF(self, docId, occurrences, numDocs):
+		tf = occurrences / self.docLengths[docId]
+		df = self.totalDocs / numDocs
+		return (1. + math.log10(tf)) * math.log10(df)
@@ -0,0 +1,133 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Compressed positional postings shared by the index structures.
+
+A postings list is the documents a term occurs in, in increasing doc id order, each
+with the increasing positions of the term in it. It is stored as one bytes object of
+unsigned LEB128 varints:
+	doc id gap, number of positions, first position, position gaps..., doc id gap, ...
+The first doc id gap is the doc id itself. Small gaps take one byte, so a list costs a
+few bytes per occurrence instead of a Python object.
+
+	data = encodePostings([(3, [0, 7]), (10, [2])])
+	postings = Postings(data, 2)
+	for docId, positions in postings: ...
+
+DocPostings keeps only the documents and the number of occurrences in each, for the
+ranking of queries that never look at positions.
+'''
+import array
+import bisect
+
+
+# @param out, a bytearray
+# @param n, a non-negative integer appended to out as a varint
+def writeVarint(out, n):
+	while n >= 0x80:
+		out.append((n & 0x7f) | 0x80)
+		n >>= 7
+	out.append(n)
+
+# @param data, bytes
+# @param pos, offset of a varint in data
+# @return (value, offset just past it)
+def readVarint(data, pos):
+	b = data[pos]
+	if b < 0x80:
+		return (b, pos + 1)
+	n = b & 0x7f
+	shift = 7
+	while True:
+		pos += 1
+		b = data[pos]
+		n |= (b & 0x7f) << shift
+		if b < 0x80:
+			return (n, pos + 1)
+		shift += 7
+
+# @param postings, iterable of (doc id, positions) in increasing doc id order, positions
+# increasing
+# @return the encoded postings list
+def encodePostings(postings):
+	out = bytearray()
+	lastDoc = 0
+	for docId, positions in postings:
+		writeVarint(out, docId - lastDoc)
+		lastDoc = docId
+		writeVarint(out, len(positions))
+		last = 0
+		for p in positions:
+			writeVarint(out, p - last)
+			last = p
+	return bytes(out)
+
+
+class Postings:
+	'''
+	An encoded postings list and its document frequency. Iterating decodes it and yields
+	(doc id, list of positions).
+	'''
+	__slots__ = ('data', 'docFreq')
+
+	def __init__(self, data, docFreq):
+		self.data = data
+		self.docFreq = docFreq
+
+	def __len__(self):
+		return self.docFreq
+
+	def __iter__(self):
+		data = self.data
+		pos = 0
+		docId = 0
+		end = len(data)
+		while pos < end:
+			gap, pos = readVarint(data, pos)
+			docId += gap
+			count, pos = readVarint(data, pos)
+			positions = []
+			p = 0
+			for i in range(count):
+				gap, pos = readVarint(data, pos)
+				p += gap
+				positions.append(p)
+			yield (docId, positions)
+
+	# @return the doc ids, in increasing order
+	def docIds(self):
+		return [docId for docId, positions in self]
+
+	# @param docIds, a set of doc ids
+	# @return dict doc id => positions for the documents of docIds in the list
+	def select(self, docIds):
+		return dict((docId, positions) for docId, positions in self if docId in docIds)
+
+
+class DocPostings:
+	'''
+	The documents a term occurs in, in increasing doc id order, with the number of
+	occurrences of the term in each. Iterating yields (doc id, term frequency).
+	'''
+	__slots__ = ('docIds', 'tfs', 'total')
+
+	# @param docIds, increasing doc ids
+	# @param tfs, the number of occurrences in each of them
+	def __init__(self, docIds, tfs):
+		self.docIds = array.array('i', docIds)
+		self.tfs = array.array('i', tfs)
+		self.total = sum(self.tfs)		# Number of occurrences in all the documents
+
+	def __len__(self):
+		return len(self.docIds)
+
+	def __iter__(self):
+		return zip(self.docIds, self.tfs)
+
+	# @param docId, a doc id
+	# @return the number of occurrences of the term in the document
+	def frequency(self, docId):
+		i = bisect.bisect_left(self.docIds, docId)
+		if i < len(self.docIds) and self.docIds[i] == docId:
+			return self.tfs[i]
+		return 0
@@ -0,0 +1,212 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+An index partitioned into shards searched in parallel.
+
+The documents file is split into numShards contiguous ranges of lines, each indexed by
+an Indexer living in its own worker process, so no process holds the whole index. The
+doc id of a document is its line number in the documents file whatever shard holds it:
+a shard adds the number of lines before its range to its own doc ids.
+
+Once the shards are built their term statistics are merged into one CollectionStats and
+sent back to every shard. A shard then expands the query terms against the terms of the
+whole collection and computes its IDF from the document frequencies of the whole
+collection, so its scores are the ones a single Indexer would give. A query is sent to
+every shard at once, each returns its own top-n hits and the top-n of their union is the
+result.
+
+	with ShardedIndex('data/docs.txt', 4) as index:
+		searcher = ShardedSearcher(index)
+		hits = searcher.search(Query('love AND death', SEARCH_MODE_BOOLEAN), 10)
+		docs = index.getDocsFromIds([hit.docId for hit in hits])
+
+	python ir_sharded_index.py docs.txt shards query...
+'''
+import bisect
+import concurrent.futures
+import heapq
+import os
+import shutil
+import sys
+import tempfile
+
+from ir_indexer import Indexer, CollectionStats
+from ir_index_searcher import IndexSearcher, Query, Hit, SEARCH_MODE_KEYWORD, SEARCH_MODE_SUBSTRING
+from metrics import METRICS
+
+POLL_SECONDS = 0.05		# Interval of the cancellation checks while waiting for the shards
+
+_searcher = None		# The IndexSearcher of the shard of a worker process, built once by _openShard
+
+
+# @param shardDir, directory of the files of the shard, its documents in docs.txt
+# @param tokenizer, an ir_tokenizer tokenizer or None
+def _openShard(shardDir, tokenizer):
+	global _searcher
+	files = [os.path.join(shardDir, name) for name in ('docs.txt', 'index.txt', 'dict.txt', 'params.txt')]
+	_searcher = IndexSearcher(Indexer(*files, tokenizer=tokenizer))
+
+def _shardStats():
+	return _searcher.indexer.localStats()
+
+def _setCollectionStats(stats):
+	_searcher.indexer.setCollectionStats(stats)
+
+def _searchShard(query, topN):
+	hits = _searcher.search(query, topN)
+	return [(hit.docId, hit.score) for hit in hits] if hits else []
+
+def _getDocs(docIds):
+	return _searcher.indexer.getDocsFromIds(docIds)
+
+# @param docsFile, the documents file, one document per line
+# @param numShards, number of shards
+# @param shardDir, directory receiving one sub-directory per shard
+# @return list of (shard directory, doc id of its first document)
+def splitDocs(docsFile, numShards, shardDir):
+	with open(docsFile, encoding='utf-8') as fd:
+		totalDocs = sum(1 for line in fd)
+	shards = []
+	with open(docsFile, encoding='utf-8') as fd:
+		for i in range(numShards):
+			start = totalDocs * i // numShards
+			end = totalDocs * (i + 1) // numShards
+			directory = os.path.join(shardDir, 'shard{0}'.format(i))
+			os.makedirs(directory, exist_ok=True)
+			with open(os.path.join(directory, 'docs.txt'), 'w', encoding='utf-8') as out:
+				for j in range(start, end):
+					out.write(fd.readline())
+			shards.append((directory, start))
+	return shards
+
+
+class ShardedIndex:
+	'''
+	The shards of a documents file, each one a worker process holding its Indexer. The
+	shards are built and their statistics merged in the constructor, close() stops the
+	workers and removes the shard files when they were written to a temporary directory.
+	'''
+	# @param docsFile, the documents file, one document per line
+	# @param numShards, number of shards and worker processes, the number of CPUs by default
+	# @param shardDir, directory the shards are written to, a temporary one if None
+	# @param tokenizer, an ir_tokenizer tokenizer, WhitespaceTokenizer by default
+	def __init__(self, docsFile, numShards=None, shardDir=None, tokenizer=None):
+		self.docsFile = docsFile
+		self.numShards = numShards or os.cpu_count() or 1
+		self.tempDir = shardDir is None
+		self.shardDir = tempfile.mkdtemp(prefix='ir_shards_') if shardDir is None else shardDir
+		self.executors = []
+		try:
+			with METRICS.timer('index.shard_split'):
+				shards = splitDocs(docsFile, self.numShards, self.shardDir)
+			self.offsets = [start for directory, start in shards]
+			# One single-process pool per shard, so that every call reaches the process of its shard
+			for directory, start in shards:
+				self.executors.append(concurrent.futures.ProcessPoolExecutor(
+					max_workers=1, initializer=_openShard, initargs=(directory, tokenizer)))
+			with METRICS.timer('index.shard_build'):
+				self.stats = CollectionStats.merge(self.scatter(_shardStats))
+			self.scatter(_setCollectionStats, self.stats)
+		except BaseException:
+			self.close()
+			raise
+		self.totalDocs = self.stats.totalDocs
+
+	def close(self):
+		for executor in self.executors:
+			executor.shutdown()
+		self.executors = []
+		if self.tempDir:
+			shutil.rmtree(self.shardDir, ignore_errors=True)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, excType, excValue, tb):
+		self.close()
+		return False
+
+	# @param func, a module-level function run in the worker of every shard
+	# @param args, the arguments of func
+	# @param cancelToken, an optional workers.CancelToken checked while waiting
+	# @return the results of func, one per shard in shard order
+	def scatter(self, func, *args, cancelToken=None):
+		futures = [executor.submit(func, *args) for executor in self.executors]
+		try:
+			while True:
+				done, pending = concurrent.futures.wait(futures, timeout=POLL_SECONDS if cancelToken is not None else None)
+				if not pending:
+					break
+				cancelToken.check(len(done), len(futures))
+		except BaseException:
+			# The shards finish the call, its results are dropped
+			for future in futures:
+				future.cancel()
+			raise
+		return [future.result() for future in futures]
+
+	# @param docId, a global doc id
+	# @return the index of the shard holding it, the last of the shards starting at or
+	# before it since the shards before it with the same start are empty
+	def shardOf(self, docId):
+		return bisect.bisect_right(self.offsets, docId) - 1
+
+	# @param docIds, a list of global doc ids
+	# @return dict doc id => document, read from the shards holding them
+	def getDocsFromIds(self, docIds):
+		byShard = {}
+		for docId in docIds:
+			shard = self.shardOf(docId)
+			byShard.setdefault(shard, []).append(docId - self.offsets[shard])
+		futures = dict((shard, self.executors[shard].submit(_getDocs, localIds)) for shard, localIds in byShard.items())
+		docs = {}
+		for shard, future in futures.items():
+			for localId, doc in future.result().items():
+				docs[localId + self.offsets[shard]] = doc
+		return docs
+
+
+class ShardedSearcher:
+	'''
+	Searches a ShardedIndex like IndexSearcher searches an Indexer, the hits carry global
+	doc ids. Keyword, phrase and Boolean queries are supported, substring queries are not
+	since the n-gram scores need the number of matching documents over all shards.
+	'''
+	# @param index, the ShardedIndex searched
+	def __init__(self, index):
+		self.indexer = index
+
+	# @param query, a Query object representing a query
+	# @param topN, number of hits returned with top-n scores
+	# @param cancelToken, an optional workers.CancelToken checked while waiting for the shards
+	# @return a list of Hit objects representing search results or None if no match
+	def search(self, query, topN=10, cancelToken=None):
+		if query.searchMode == SEARCH_MODE_SUBSTRING:
+			raise ValueError('Substring search is not supported on a sharded index')
+		METRICS.incr('search.queries')
+		with METRICS.timer('search.total'):
+			results = self.indexer.scatter(_searchShard, query, topN, cancelToken=cancelToken)
+		METRICS.incr('search.shards', len(results))
+		hits = []
+		for offset, shardHits in zip(self.indexer.offsets, results):
+			hits.extend(Hit(docId + offset, score) for docId, score in shardHits)
+		if not hits:
+			return
+		METRICS.incr('search.hits', min(len(hits), topN))
+		return heapq.nlargest(topN, hits, key=lambda x: x.score)
+
+
+def main():
+	if len(sys.argv) < 4:
+		print('Usage: python ir_sharded_index.py docs.txt shards query...')
+		return
+	with ShardedIndex(sys.argv[1], int(sys.argv[2])) as index:
+		searcher = ShardedSearcher(index)
+		hits = searcher.search(Query(' '.join(sys.argv[3:]), SEARCH_MODE_KEYWORD), 10)
+		if hits is not None:
+			for hit in hits:
+				print(hit)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,122 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Sorted term dictionary for query term expansion.
+
+	termDict = TermDictionary(indexer.dict)
+	termDict.prefix('econ')			Terms starting with 'econ'
+	termDict.wildcard('th?u*')		Terms matching the pattern, '*' any run of characters
+									and '?' one character
+	termDict.fuzzy('beuty', 2)		(term, edit distance) of the terms within 2 edits
+
+The terms are kept in one sorted list. The terms starting with a prefix are a range of
+it found with bisect, and a wildcard pattern only scans the range of its literal
+prefix. fuzzy walks the list as the trie it implicitly is: consecutive terms share
+their Levenshtein rows for their common prefix, and when every cell of a row exceeds
+the bound the whole range of terms with that prefix is skipped.
+'''
+import bisect
+import re
+
+MAX_CODE_POINT = 0x10ffff
+
+
+# @param term, a query term missing from the dictionary
+# @return the number of edits tolerated for a term of its length, none for short terms
+# where one edit already gives another common word
+def autoEdits(term):
+	if len(term) <= 2:
+		return 0
+	elif len(term) <= 5:
+		return 1
+	return 2
+
+
+class TermDictionary:
+	# @param terms, iterable of the terms of the index
+	def __init__(self, terms):
+		self.terms = sorted(terms)
+
+	def __len__(self):
+		return len(self.terms)
+
+	def __contains__(self, term):
+		i = bisect.bisect_left(self.terms, term)
+		return i < len(self.terms) and self.terms[i] == term
+
+	# @param prefix, a string
+	# @return (lo, hi), the terms starting with prefix are terms[lo:hi]
+	def prefixRange(self, prefix):
+		terms = self.terms
+		if prefix == '':
+			return (0, len(terms))
+		lo = bisect.bisect_left(terms, prefix)
+		last = ord(prefix[-1])
+		if last == MAX_CODE_POINT:
+			hi = lo
+			while hi < len(terms) and terms[hi].startswith(prefix):
+				hi += 1
+			return (lo, hi)
+		# Every term starting with prefix sorts before prefix with its last character incremented
+		return (lo, bisect.bisect_left(terms, prefix[:-1] + chr(last + 1), lo))
+
+	# @param prefix, a string
+	# @return the terms starting with prefix, in sorted order
+	def prefix(self, prefix):
+		lo, hi = self.prefixRange(prefix)
+		return self.terms[lo:hi]
+
+	# @param pattern, a term with '*' (any run of characters) and '?' (one character)
+	# @return the terms matching the whole pattern, in sorted order
+	def wildcard(self, pattern):
+		literal = re.match(r'[^*?]*', pattern).group()
+		if literal == pattern:
+			return [pattern] if pattern in self else []
+		regex = re.compile(''.join('.*' if c == '*' else '.' if c == '?' else re.escape(c) for c in pattern), re.DOTALL)
+		lo, hi = self.prefixRange(literal)
+		return [t for t in self.terms[lo:hi] if regex.fullmatch(t)]
+
+	# @param term, a string
+	# @param maxEdits, maximum Levenshtein distance
+	# @return list of (term, distance) of the terms within maxEdits of term, closest first
+	def fuzzy(self, term, maxEdits):
+		terms = self.terms
+		n = len(term)
+		rows = [list(range(n+1))]		# rows[k] is the row of the first k characters of prev
+		prev = ''
+		result = []
+		i = 0
+		while i < len(terms):
+			t = terms[i]
+			common = 0
+			limit = min(len(prev), len(t), len(rows) - 1)
+			while common < limit and prev[common] == t[common]:
+				common += 1
+			del rows[common+1:]
+			dead = -1
+			for k in range(common, len(t)):
+				c = t[k]
+				row = rows[-1]
+				new = [row[0] + 1]
+				for j in range(1, n+1):
+					cost = row[j-1] if term[j-1] == c else row[j-1] + 1
+					if new[j-1] + 1 < cost:
+						cost = new[j-1] + 1
+					if row[j] + 1 < cost:
+						cost = row[j] + 1
+					new.append(cost)
+				rows.append(new)
+				if min(new) > maxEdits:
+					dead = k
+					break
+			if dead >= 0:
+				# No term starting with t[:dead+1] can come within maxEdits
+				prev = t[:dead+1]
+				i = max(i + 1, self.prefixRange(prev)[1])
+				continue
+			if rows[-1][n] <= maxEdits:
+				result.append((t, rows[-1][n]))
+			prev = t
+			i += 1
+		result.sort(key=lambda item: (item[1], item[0]))
+		return result
@@ -0,0 +1,127 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Tokenizers turning a document or a query into index terms. The Indexer and the
+IndexSearcher must use the same one, IndexSearcher takes the tokenizer of its Indexer
+unless told otherwise.
+
+	WhitespaceTokenizer()				Strip ASCII punctuation and split on white spaces,
+										for English text such as the Shakespeare corpus
+	SegmenterTokenizer('mp')			Runs of Chinese characters are segmented into
+										words by MaxProbabilitySegment ('mp') or BMMSegment
+										('bmm'), the rest is split like WhitespaceTokenizer
+
+	indexer = Indexer(docsFile, indexFile, dictFile, paramsFile, tokenizer=SegmenterTokenizer('mp'))
+
+A tokenizer has tokenize(text) for one query or document and tokenizeMany(texts) for
+the whole corpus at index build time, which SegmenterTokenizer spreads over a process
+pool of segmenters.
+'''
+import re
+import string
+
+from metrics import METRICS
+
+ASCII_PUNCTUATION = re.compile('[{0}]'.format(re.escape(string.punctuation)))
+# General punctuation (quotes, dashes), CJK symbols and punctuation and the full-width
+# forms of the ASCII punctuation, they separate words in Chinese text
+CJK_PUNCTUATION = re.compile('[\u2010-\u206f\u3000-\u303f\uff01-\uff0f\uff1a-\uff20\uff3b-\uff40\uff5b-\uff65]')
+# CJK unified ideographs, extension A and compatibility ideographs
+CJK_RUN = re.compile('[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+')
+MIN_PARALLEL_CHUNKS = 64		# Fewer chunks are segmented in this process
+
+
+# @param text, text without Chinese characters
+# @return its words, CJK punctuation separates words and ASCII punctuation is removed
+def splitWords(text):
+	return ASCII_PUNCTUATION.sub('', CJK_PUNCTUATION.sub(' ', text)).split()
+
+
+class WhitespaceTokenizer:
+	'''
+	The tokenizer the Indexer always used: punctuation removed, then split on white spaces
+	'''
+	# @param text, a document or a query
+	# @return a list of words with punctuations removed
+	def tokenize(self, text):
+		return ASCII_PUNCTUATION.sub('', text).split()
+
+	# @param texts, a list of documents
+	# @return a list of word lists, one per document
+	def tokenizeMany(self, texts):
+		return [self.tokenize(text) for text in texts]
+
+
+class SegmenterTokenizer:
+	'''
+	Segments the runs of Chinese characters with a dictionary segmenter, and tokenizes
+	the text around them (Latin words, numbers) like WhitespaceTokenizer. Queries are
+	segmented in this process by a segmenter built on first use. tokenizeMany cuts the
+	runs into chunks the way parallel_segment does and segments them in a
+	ParallelSegmenter, which is only started for the duration of the call.
+	'''
+	# @param algorithm, 'mp' or 'bmm'
+	# @param processes, size of the pool of tokenizeMany, 1 to segment in this process
+	# @param lexiconFile, a lexicon file mapped by the segmenters, see lexicon.py, or None
+	def __init__(self, algorithm='mp', processes=None, lexiconFile=None):
+		if algorithm not in ('mp', 'bmm'):
+			raise ValueError('Unknown segmentation algorithm: ' + algorithm)
+		self.algorithm = algorithm
+		self.processes = processes
+		self.lexiconFile = lexiconFile
+		self.segmenter = None
+
+	# @return the segmenter of this process
+	def getSegmenter(self):
+		if self.segmenter is None:
+			from parallel_segment import createSegmenter
+			self.segmenter = createSegmenter(self.algorithm, lexiconFile=self.lexiconFile)
+		return self.segmenter
+
+	# @param text, a document or a query
+	# @return a list of words with punctuations removed
+	def tokenize(self, text):
+		return self.tokenizeMany([text])[0]
+
+	# @param texts, a list of documents
+	# @return a list of word lists, one per document
+	def tokenizeMany(self, texts):
+		from parallel_segment import splitChunks, DEFAULT_MAX_CHUNK
+		# A document is a list of parts, a part being either a list of words or the index
+		# of a chunk of Chinese characters in chunks
+		docs = []
+		chunks = []
+		for text in texts:
+			parts = []
+			pos = 0
+			for m in CJK_RUN.finditer(text):
+				if m.start() > pos:
+					parts.append(splitWords(text[pos:m.start()]))
+				for offset, chunk in splitChunks(m.group(), DEFAULT_MAX_CHUNK):
+					parts.append(len(chunks))
+					chunks.append(chunk)
+				pos = m.end()
+			if pos < len(text):
+				parts.append(splitWords(text[pos:]))
+			docs.append(parts)
+
+		with METRICS.timer('tokenizer.segment'):
+			segmented = self.segmentChunks(chunks)
+		METRICS.incr('tokenizer.chunks', len(chunks))
+		result = []
+		for parts in docs:
+			words = []
+			for part in parts:
+				words.extend(segmented[part] if isinstance(part, int) else part)
+			result.append(words)
+		return result
+
+	# @param chunks, a list of strings of Chinese characters
+	# @return a list of word lists, one per chunk
+	def segmentChunks(self, chunks):
+		if self.processes == 1 or len(chunks) < MIN_PARALLEL_CHUNKS:
+			segmenter = self.getSegmenter()
+			return [segmenter.segmentWords(chunk) for chunk in chunks]
+		from parallel_segment import ParallelSegmenter
+		with ParallelSegmenter(self.algorithm, self.processes, lexiconFile=self.lexiconFile) as pool:
+			return pool.segmentChunks([(0, chunk) for chunk in chunks])
@@ -0,0 +1,302 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+One interned lexicon for the BMM dictionary, the MP word frequencies and the HMM word
+ids, stored in a single read-only file which every process maps into memory, so all
+the worker processes of a machine share one copy of the pages.
+
+	python lexicon.py			Build data/lexicon.bin from the three dictionary files
+
+	lex = Lexicon()
+	bmm = BMMSegment(4, lexicon=lex)
+	mp = MaxProbabilitySegment(lexicon=lex)
+	tagger = HMM_Viterbi_POS_TAGGER(lexicon=lex)
+
+File layout, every section 8-byte aligned, integers little-endian:
+	header		magic, format, number of words, hash slots, number of HMM words, number
+				of tags, followed by the offset of every section
+	offsets		uint32[n+1], word i is strings[offsets[i]:offsets[i+1]]
+	strings		the utf-8 words, sorted by their utf-8 bytes
+	freq		float64[n], MP probability or -1
+	tag			int16[n], index into tags or -1 for a word not in the BMM dictionary
+	hmmId		int32[n], HMM word id or -1
+	slots		int32[slots], open-addressing hash index (crc32, linear probing), -1 empty
+	tags		the '\\n' separated tag strings
+'''
+import array
+import mmap
+import os
+import struct
+import sys
+import threading
+import zlib
+
+LEXICON_FILE = 'data/lexicon.bin'
+BMM_DICT_FILE = 'data/chinese_dict.txt'
+MP_DICT_FILE = 'data/word_frequency.txt'
+HMM_WORDS_FILE = 'data/words.txt'
+
+MAGIC = b'LEX1'
+LEXICON_FORMAT = 1
+HEADER = struct.Struct('<4sIIIII' + 'Q' * 7)
+SECTIONS = ('offsets', 'strings', 'freq', 'tag', 'hmmId', 'slots', 'tags')
+ABSENT = object()
+
+
+def align(n):
+	return (n + 7) & ~7
+
+# @param column, an array of numbers
+# @return its bytes in little-endian order whatever the byte order of this host
+def littleEndian(column):
+	if sys.byteorder != 'little':
+		column = array.array(column.typecode, column)
+		column.byteswap()
+	return column.tobytes()
+
+# @param view, a memoryview on a little-endian section of the lexicon file
+# @param code, the array type code of its numbers
+# @return the numbers, the mapped memory itself on a little-endian host and a
+# byte-swapped private copy elsewhere
+def readColumn(view, code):
+	if sys.byteorder == 'little':
+		return view.cast(code)
+	column = array.array(code, view.tobytes())
+	column.byteswap()
+	return column
+
+# @return {word: [freq, tag, hmm id]} merged from the three dictionary files
+def readDictionaries(bmmFile=BMM_DICT_FILE, mpFile=MP_DICT_FILE, hmmFile=HMM_WORDS_FILE):
+	entries = {}
+	with open(bmmFile, encoding='gbk') as f:
+		for line in f:
+			tokens = line.rstrip('\n').split(',')
+			entries.setdefault(tokens[0], [-1.0, '', -1])[1] = tokens[1] if len(tokens) > 1 else ''
+	with open(mpFile, encoding='gbk') as f:
+		for line in f:
+			tokens = line.split(',')
+			entries.setdefault(tokens[0], [-1.0, None, -1])[0] = float(tokens[2].rstrip('%\n')) * 0.01
+	with open(hmmFile, encoding='utf-8') as f:
+		for i, w in enumerate(f):
+			entries.setdefault(w.strip(), [-1.0, None, -1])[2] = i
+	return entries
+
+# @param path, the lexicon file to write
+# @return number of words
+def buildLexicon(path=LEXICON_FILE, bmmFile=BMM_DICT_FILE, mpFile=MP_DICT_FILE, hmmFile=HMM_WORDS_FILE):
+	entries = readDictionaries(bmmFile, mpFile, hmmFile)
+	words = sorted(entries, key=lambda w: w.encode('utf-8'))
+	tagIds = {}
+	offsets = array.array('I', [0])
+	strings = bytearray()
+	freq = array.array('d')
+	tag = array.array('h')
+	hmmId = array.array('i')
+	hmmCount = 0
+	for w in words:
+		p, t, h = entries[w]
+		strings += w.encode('utf-8')
+		offsets.append(len(strings))
+		freq.append(p)
+		tag.append(-1 if t is None else tagIds.setdefault(t, len(tagIds)))
+		hmmId.append(h)
+		hmmCount = max(hmmCount, h + 1)
+
+	slots = 1
+	while slots < 2 * len(words):
+		slots <<= 1
+	table = array.array('i', [-1]) * slots
+	for i, w in enumerate(words):
+		s = zlib.crc32(w.encode('utf-8')) & (slots - 1)
+		while table[s] != -1:
+			s = (s + 1) & (slots - 1)
+		table[s] = i
+	tags = '\n'.join(sorted(tagIds, key=tagIds.get)).encode('utf-8')
+
+	sections = [littleEndian(offsets), bytes(strings), littleEndian(freq), littleEndian(tag), littleEndian(hmmId), littleEndian(table), tags]
+	pos = align(HEADER.size)
+	starts = []
+	for data in sections:
+		starts.append(pos)
+		pos = align(pos + len(data))
+	tmp = path + '.tmp'
+	with open(tmp, 'wb') as fd:
+		fd.write(HEADER.pack(MAGIC, LEXICON_FORMAT, len(words), slots, hmmCount, len(tagIds), *starts))
+		for start, data in zip(starts, sections):
+			fd.write(b'\0' * (start - fd.tell()))
+			fd.write(data)
+	os.replace(tmp, path)
+	return len(words)
+
+
+class Lexicon:
+	'''
+	Read-only view of a lexicon file through mmap. Nothing is copied into the process:
+	the columns are memoryviews on the mapping and a lookup hashes the utf-8 bytes of
+	the word with crc32 and compares the candidate slots against the string table. A
+	big-endian host reads the numeric columns into byte-swapped private copies instead.
+	'''
+	def __init__(self, path=LEXICON_FILE):
+		self.path = path
+		with open(path, 'rb') as fd:
+			self.mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+		magic, fmt, self.count, slots, self.hmmCount, numTags, *starts = HEADER.unpack_from(self.mm, 0)
+		if magic != MAGIC or fmt != LEXICON_FORMAT:
+			raise ValueError('Not a lexicon file or unsupported format: ' + path)
+		view = memoryview(self.mm)
+		n = self.count
+		sizes = {'offsets': 4 * (n + 1), 'freq': 8 * n, 'tag': 2 * n, 'hmmId': 4 * n, 'slots': 4 * slots}
+		ends = starts[1:] + [len(self.mm)]
+		sec = {}
+		for name, start, end in zip(SECTIONS, starts, ends):
+			sec[name] = view[start:start + sizes[name]] if name in sizes else view[start:end]
+		self.offsets = readColumn(sec['offsets'], 'I')
+		self.strings = sec['strings']
+		self.freq = readColumn(sec['freq'], 'd')
+		self.tag = readColumn(sec['tag'], 'h')
+		self.hmmId = readColumn(sec['hmmId'], 'i')
+		self.slots = readColumn(sec['slots'], 'i')
+		self.mask = slots - 1
+		tags = bytes(sec['tags']).rstrip(b'\0').decode('utf-8')
+		self.tags = tags.split('\n') if numTags > 0 else []
+
+	# @return index of word in the sorted string table, or -1
+	def find(self, word):
+		key = word.encode('utf-8')
+		slots = self.slots
+		offsets = self.offsets
+		mask = self.mask
+		s = zlib.crc32(key) & mask
+		while True:
+			i = slots[s]
+			if i < 0:
+				return -1
+			if self.strings[offsets[i]:offsets[i+1]] == key:
+				return i
+			s = (s + 1) & mask
+
+	# @return the word at index i of the sorted string table
+	def word(self, i):
+		return bytes(self.strings[self.offsets[i]:self.offsets[i+1]]).decode('utf-8')
+
+	def __len__(self):
+		return self.count
+
+	# @return the dictionary tag of data/chinese_dict.txt, or None
+	def tagOf(self, word):
+		i = self.find(word)
+		return self.tags[self.tag[i]] if i >= 0 and self.tag[i] >= 0 else None
+
+	def bmmView(self):
+		return LexiconView(self, self.tag)
+
+	def probView(self):
+		return LexiconView(self, self.freq)
+
+	def hmmView(self):
+		return LexiconView(self, self.hmmId, self.hmmCount)
+
+	def close(self):
+		for column in (self.offsets, self.freq, self.tag, self.hmmId, self.slots, self.strings):
+			if isinstance(column, memoryview):
+				column.release()
+		self.mm.close()
+
+
+class LexiconView:
+	'''
+	One column of a Lexicon seen as a mapping from word to value, a negative value
+	meaning the word is not in this vocabulary. It supports the parts of the set and
+	dict interfaces the engines use; updates (BMMSegment.addWord and friends) go into
+	a small per-process overlay, the shared file is never written. The lookups read the
+	overlay without locking, each of them is a single dict or set operation.
+	'''
+	# @param column, one of the columns of lexicon
+	# @param size, number of non-negative values of column, counted on the first len() if None
+	def __init__(self, lexicon, column, size=None):
+		self.lexicon = lexicon
+		self.column = column
+		self.size = size
+		self.sizeChange = 0		# Words the overlay adds to the column, minus those it removes
+		self.added = {}
+		self.removed = set()
+		self.lock = threading.Lock()		# Held by the updates of the overlay and its snapshots
+
+	def get(self, word, default=None):
+		if self.added:
+			value = self.added.get(word, ABSENT)
+			if value is not ABSENT:
+				return value
+		if self.removed and word in self.removed:
+			return default
+		i = self.lexicon.find(word)
+		if i < 0:
+			return default
+		value = self.column[i]
+		return value if value >= 0 else default
+
+	def __contains__(self, word):
+		# The hot path of BMM, kept free of the get() call
+		if self.added and word in self.added:
+			return True
+		if self.removed and word in self.removed:
+			return False
+		i = self.lexicon.find(word)
+		return i >= 0 and self.column[i] >= 0
+
+	def __getitem__(self, word):
+		value = self.get(word)
+		if value is None:
+			raise KeyError(word)
+		return value
+
+	def __setitem__(self, word, value):
+		with self.lock:
+			if self.get(word) is None:
+				self.sizeChange += 1
+			self.removed.discard(word)
+			self.added[word] = value
+
+	def __len__(self):
+		if self.size is None:
+			# Read once, the column of a shared lexicon is not loaded for anything else
+			self.size = sum(1 for value in self.column if value >= 0)
+		return self.size + self.sizeChange
+
+	# @param word, added with the value 0, for the set interface of BMMSegment.myDict
+	def add(self, word):
+		self[word] = 0
+
+	def pop(self, word, default=None):
+		with self.lock:
+			value = self.get(word)
+			if value is None:
+				return default
+			self.sizeChange -= 1
+			self.added.pop(word, None)
+			self.removed.add(word)
+			return value
+
+	def discard(self, word):
+		self.pop(word)
+
+	# @return the values of the words of the shared file, then those of the overlay
+	def values(self):
+		# A snapshot of the overlay, the updates of other threads go on while this runs
+		with self.lock:
+			added = list(self.added.values())
+			overridden = self.removed | set(self.added)
+		for i, value in enumerate(self.column):
+			if value >= 0 and (not overridden or self.lexicon.word(i) not in overridden):
+				yield value
+		for value in added:
+			yield value
+
+
+def main():
+	n = buildLexicon()
+	print('{0}: {1} words, {2:.1f} MB'.format(LEXICON_FILE, n, os.path.getsize(LEXICON_FILE) / 2**20))
+
+
+if __name__ == '__main__':
+	main()
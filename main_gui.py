@@ -3,16 +3,38 @@
 from tkinter import *
 from tkinter.ttk import *
 from tkinter.scrolledtext import ScrolledText
-from tkinter.filedialog import askopenfilename
+from tkinter.filedialog import askopenfilename, asksaveasfilename
+
+import sys
+import threading
+
+from metrics import METRICS
+from workers import BackgroundRunner, Cancelled
+
+# Models are built on first use, in the order preloadModels() warms them up.
+# The engine modules are imported by loadModel so that none of them slows down startup.
+MODEL_NAMES = ['mp', 'bmm', 'cykParser', 'parser', 'tagger']
+
+# @param name, one of MODEL_NAMES
+# @return a newly constructed engine
+def loadModel(name):
+    if name == 'bmm':
+        from bmm_segment import BMMSegment
+        return BMMSegment(4)
+    elif name == 'mp':
+        from max_prob_segment import MaxProbabilitySegment
+        return MaxProbabilitySegment()
+    elif name == 'tagger':
+        from viterbi_pos_tagger import HMM_Viterbi_POS_TAGGER
+        return HMM_Viterbi_POS_TAGGER(pruned=True)
+    elif name == 'parser':
+        from top_down_parser import TopDownParser
+        return TopDownParser()
+    elif name == 'cykParser':
+        from cyk_parser import CYKParser
+        return CYKParser()
+    raise ValueError('Unknown model: ' + name)
 
-from bmm_segment import BMMSegment
-from max_prob_segment import MaxProbabilitySegment
-from viterbi_pos_tagger import HMM_Viterbi_POS_TAGGER
-from top_down_parser import TopDownParser
-from cyk_parser import CYKParser
-import regex
-
-import time
 
 class App(Frame):
   
@@ -21,13 +43,44 @@ class App(Frame):
          
         self.parent = parent
         
+        METRICS.enable()
+        self.runner = BackgroundRunner(self)
+        self.models = {}
+        self.modelLocks = dict((name, threading.Lock()) for name in MODEL_NAMES)
         self.initUI()
-        
-        self.bmm = BMMSegment(4)
-        self.mp = MaxProbabilitySegment()
-        self.tagger = HMM_Viterbi_POS_TAGGER()
-        self.parser = TopDownParser()
-        self.cykParser = CYKParser()
+
+        # Start loading the models once the window is on screen
+        self.after(100, self.preloadModels)
+
+    # @param name, one of MODEL_NAMES
+    # @return the model, loading it first if needed. Safe to call from any thread,
+    # a caller asking for a model being loaded waits for it instead of loading it twice.
+    def getModel(self, name):
+        model = self.models.get(name)
+        if model is None:
+            with self.modelLocks[name]:
+                model = self.models.get(name)
+                if model is None:
+                    with METRICS.timer('load.' + name):
+                        model = loadModel(name)
+                    self.models[name] = model
+        return model
+
+    bmm = property(lambda self: self.getModel('bmm'))
+    mp = property(lambda self: self.getModel('mp'))
+    tagger = property(lambda self: self.getModel('tagger'))
+    parser = property(lambda self: self.getModel('parser'))
+    cykParser = property(lambda self: self.getModel('cykParser'))
+
+    def preloadModels(self):
+        def preload():
+            for name in MODEL_NAMES:
+                try:
+                    self.getModel(name)
+                except Exception as e:
+                    # Reported again when the model is actually used
+                    print('[Error] Failed to load model "' + name + '": ' + str(e), file=sys.stderr)
+        threading.Thread(target=preload, daemon=True).start()
   
     def initUI(self):
       
@@ -43,6 +96,8 @@ class App(Frame):
         self.menubar = Menu(self.parent)
         self.fileMenu = Menu(self.menubar, tearoff=0)
         self.fileMenu.add_command(label="读入规则文件", command=self.onLoadRules_CYK)
+        self.fileMenu.add_command(label="加载用户词典", command=self.onLoadUserDict)
+        self.fileMenu.add_command(label="导出性能指标", command=self.onExportMetrics)
         self.fileMenu.add_separator()
         self.fileMenu.add_command(label="退出", command=self.parent.quit)
         self.menubar.add_cascade(label="文件", menu=self.fileMenu)
@@ -88,13 +143,76 @@ class App(Frame):
 
         # HINT: Place additional button here
 
+        self.progress = Progressbar(self.rightFrame, mode='determinate', maximum=100, length=100)
+        self.progress.pack(side="top", expand=True, pady=8)
+
+        self.cancelBtn = Button(self.rightFrame, text="取消", command=self.onCancel, state=DISABLED)
+        self.cancelBtn.pack(side="top", expand=True, pady=8)
+
         self.quitBtn = Button(self.rightFrame, text="退出", command=self.onQuit)
         self.quitBtn.pack(side="top", expand=True, pady=8)
 
 
     def onQuit(self):
+        self.runner.shutdown()
         self.quit()
 
+    def onExportMetrics(self):
+        fname = asksaveasfilename(initialfile='metrics.prom')
+        if fname:
+            METRICS.writePrometheus(fname)
+
+    def onLoadUserDict(self):
+        fname = askopenfilename(initialdir='./data', initialfile='user_dict.txt')
+        if fname:
+            # Applied in place, no need to rebuild the segmenters. Read on the worker
+            # thread since the segmenters may still be loading
+            def work(token):
+                n = self.bmm.loadUserDict(fname)
+                self.mp.loadUserDict(fname)
+                return n
+
+            def done(n):
+                self.label2['text'] = '已加载用户词典：' + str(n) + '条'
+
+            self.runInBackground('加载用户词典中...', work, done)
+
+    def showMetrics(self, title):
+        self.label2['text'] = title + '    ' + METRICS.summary()
+
+
+    ##############################  Background tasks #########################################
+
+    # @param title, text shown while the task is running
+    # @param work, called on a worker thread with a CancelToken, must not touch any widget
+    # @param done, called on the Tk thread with the return value of work
+    def runInBackground(self, title, work, done):
+        METRICS.reset()
+        self.label2['text'] = title
+        self.progress['value'] = 0
+        self.cancelBtn['state'] = NORMAL
+        self.runner.submit(work, lambda result: self.onTaskDone(done, result), self.onTaskError, self.onTaskProgress)
+
+    def onTaskDone(self, done, result):
+        self.progress['value'] = 100
+        self.cancelBtn['state'] = DISABLED
+        done(result)
+
+    def onTaskError(self, error):
+        self.progress['value'] = 0
+        self.cancelBtn['state'] = DISABLED
+        if isinstance(error, Cancelled):
+            self.label2['text'] = '已取消'
+        else:
+            self.label2['text'] = '出错: ' + str(error)
+
+    def onTaskProgress(self, fraction):
+        if fraction is not None:
+            self.progress['value'] = fraction * 100
+
+    def onCancel(self):
+        self.runner.cancel()
+
 
     ##############################  BMM Segmentation #########################################
     
@@ -102,14 +220,19 @@ class App(Frame):
         self.outputText.delete('1.0', END)
         inStr = self.inputText.get('1.0', END).strip()
 
-        start = time.clock()
-        result = self.bmm.BMM(inStr, self.inputText)
+        def work(token):
+            normalized = self.bmm.removeWhiteSpace(inStr)
+            return (normalized, self.bmm.matchBothWays(normalized, token))
 
-        self.outputText.insert(INSERT, result)
-        elapsed = time.clock() - start
+        def done(result):
+            # Ambiguities are resolved with dialogs, so the rest of BMM runs on the Tk thread
+            normalized, flags = result
+            result = self.bmm.BMM(normalized, self.inputText, flags=flags)
+            self.outputText.insert(INSERT, result)
+            if result != '':
+                self.showMetrics('分词结果')
 
-        if result != '':
-            self.label2['text'] = '分词结果    耗时: ' + '{0:.1f} ms'.format(elapsed*1000)
+        self.runInBackground('分词中...', work, done)
 
 
     ######################### Maximum Probability Segmentation ###############################
@@ -118,14 +241,16 @@ class App(Frame):
         self.outputText.delete('1.0', END)
         inStr = self.inputText.get('1.0', END).strip()
 
-        start = time.clock()
-        result = self.mp.MaxProbability(inStr)
+        def work(token):
+            with METRICS.timer('mp.total'):
+                return self.mp.MaxProbability(inStr, token)
 
-        self.outputText.insert(INSERT, result)
-        elapsed = time.clock() - start
+        def done(result):
+            self.outputText.insert(INSERT, result)
+            if result != '':
+                self.showMetrics('分词结果')
 
-        if result != '':
-            self.label2['text'] = '分词结果    耗时: ' + '{0:.1f} ms'.format(elapsed*1000)
+        self.runInBackground('分词中...', work, done)
 
 
     ############################## HMM Pos-tagging ##########################################
@@ -136,18 +261,19 @@ class App(Frame):
         if inStr == '':
             return 
 
-        start = time.clock()
-
-        segmented = self.mp.MaxProbability(inStr)
+        def work(token):
+            with METRICS.timer('hmm.total'):
+                segmented = self.mp.MaxProbability(inStr, token)
 
-        obs = [w.strip('/') for w in segmented.split()]
-        result = self.tagger.Viterbi(obs)
-        elapsed = time.clock() - start
+                obs = [w.strip('/') for w in segmented.split()]
+                return self.tagger.Viterbi(obs, token)
 
-        self.outputText.insert(INSERT, result)
+        def done(result):
+            self.outputText.insert(INSERT, result)
+            if result != '':
+                self.showMetrics('词性标注结果')
 
-        if result != '':
-            self.label2['text'] = '词性标注结果     耗时: ' + '{0:.1f} ms'.format(elapsed*1000)
+        self.runInBackground('词性标注中...', work, done)
 
 
     ##############################  Top-down parsing #########################################
@@ -160,12 +286,15 @@ class App(Frame):
         else:
             sentence = inStr.strip().split()
 
-        start = time.clock()
-        succeed = self.parser.parse(sentence)
-        elapsed = time.clock() - start
+        def work(token):
+            with METRICS.timer('topdown.total'):
+                return self.parser.parseTree(sentence, token)
 
-        if succeed:
-            self.label2['text'] = '语法分析完成     结果：成功       耗时：' + '{0:.1f} ms'.format(elapsed*1000)
+        self.runInBackground('语法分析中...', work, self.showParseTree_TopDown)
+
+    def showParseTree_TopDown(self, tree):
+        if tree is not None:
+            self.showMetrics('语法分析完成     结果：成功')
             newWindow = Toplevel(self)
             newWindow.title('自顶向下语法分析')
             self.textbox = Entry(newWindow)
@@ -174,12 +303,11 @@ class App(Frame):
             self.tree.heading('#0', text='语法树', anchor='w')
             self.tree.pack(fill=BOTH, expand=1)
 
-            parseString = self.parser.printParseTree()
-            self.textbox.insert(INSERT, parseString)
+            self.textbox.insert(INSERT, tree.bracketed())
 
-            self.buildParseTree_TopDown('', 'S', self.parser.rules, self.parser.choices)            
+            self.insertParseTree(tree)
         else:
-            self.label2['text'] = '语法分析完成     结果：失败       耗时：' + '{0:.1f} ms'.format(elapsed*1000)
+            self.showMetrics('语法分析完成     结果：失败')
 
     def onLoadRules_TopDown(self):
         fname = askopenfilename(initialdir='./data', initialfile='rules.txt')
@@ -187,17 +315,25 @@ class App(Frame):
             self.inputText.delete('1.0', END)
             with open(fname) as f:
                 self.inputText.insert(INSERT, f.read())
+            self.loadRulesInBackground(fname)
+
+    # @param fname, a rules file loaded into the top-down parser on the worker thread,
+    # which waits for the parser if it is still being preloaded
+    def loadRulesInBackground(self, fname):
+        def work(token):
             self.parser.loadRules(fname)
 
-    def buildParseTree_TopDown(self, parent, symbol, rules, choices):
-        if choices[symbol] == -1:
-            newNode = self.tree.insert(parent, 'end', text=symbol, open=True)
-            self.tree.insert(newNode, 'end', text=' | '.join(rules[symbol][0]))
-        else:
-            c = choices[symbol]
-            newParent = self.tree.insert(parent, 'end', text=symbol, open=True)
-            for symbl in rules[symbol][c]:
-                self.buildParseTree_TopDown(newParent, symbl, rules, choices)
+        def done(result):
+            self.label2['text'] = '已读入规则文件：' + fname
+
+        self.runInBackground('读入规则文件中...', work, done)
+
+    # @param tree, a parse_tree.ParseTree shown in self.tree
+    def insertParseTree(self, tree):
+        items = []
+        for i, label in enumerate(tree.labels):
+            parent = items[tree.parent[i]] if tree.parent[i] >= 0 else ''
+            items.append(self.tree.insert(parent, 'end', text=label, open=True))
     
 
     ##############################  CYK-PCFG parsing #########################################
@@ -208,19 +344,7 @@ class App(Frame):
             self.inputText.delete('1.0', END)
             with open(fname) as f:
                 self.inputText.insert(INSERT, f.read())
-            self.parser.loadRules(fname)
-
-    def buildParseTree_CYK(self, parent, beg, end, symbol_id):
-        backPt = self.cykParser.BP[beg][end][symbol_id]
-        symbol = self.cykParser.id2symb[symbol_id]
-
-        if backPt.s == -1:
-            newNode = self.tree.insert(parent, 'end', text=symbol, open=True)
-            self.tree.insert(newNode, 'end', text=self.cykParser.words[beg-1], open=True)
-        else:
-            newParent = self.tree.insert(parent, 'end', text=symbol, open=True)
-            self.buildParseTree_CYK(newParent, beg, backPt.s, backPt.Y)
-            self.buildParseTree_CYK(newParent, backPt.s+1, end, backPt.Z)
+            self.loadRulesInBackground(fname)
 
     def onCYK(self):
         inStr = self.outputText.get('1.0', END).strip()
@@ -230,11 +354,18 @@ class App(Frame):
         else:
             sentence = inStr
 
-        start = time.clock()
-        parseString, prob = self.cykParser.parse(sentence)
-        elapsed = time.clock() - start
+        def work(token):
+            with METRICS.timer('cyk.total'):
+                return self.cykParser.parseTree(sentence, token)
+
+        self.runInBackground('PCFG语法分析中...', work, self.showParseTree_CYK)
 
-        self.label2['text'] = 'PCFG语法分析完成     结果：成功       耗时：' + '{0:.1f} ms'.format(elapsed*1000)
+    def showParseTree_CYK(self, result):
+        tree, prob = result
+        if tree is None:
+            self.showMetrics('PCFG语法分析完成     结果：失败')
+            return
+        self.showMetrics('PCFG语法分析完成     结果：成功')
         newWindow = Toplevel(self)
         newWindow.title('PCFG语法分析')
         self.textbox = Entry(newWindow)
@@ -243,9 +374,9 @@ class App(Frame):
         self.tree.heading('#0', text='语法树 (概率:{0:.8f})'.format(prob), anchor='w')
         self.tree.pack(fill=BOTH, expand=1)
 
-        self.textbox.insert(INSERT, parseString)
+        self.textbox.insert(INSERT, tree.bracketed())
 
-        self.buildParseTree_CYK('', 1, len(self.cykParser.words), self.cykParser.symb2id['S'])
+        self.insertParseTree(tree)
 
     def onRE(self):
         window = Toplevel(self)
@@ -256,13 +387,14 @@ class App(Frame):
         result.pack(fill=BOTH, expand=1)
 
         htmlFile = 'data/凤凰网.html'
+        import regex
         
-        start = time.clock()
-        titles = regex.fetchTitles(htmlFile)
-        links = regex.fetchLinks(htmlFile)
-        elapsed = time.clock() - start
+        METRICS.reset()
+        with METRICS.timer('regex.total'):
+            titles = regex.fetchTitles(htmlFile)
+            links = regex.fetchLinks(htmlFile)
 
-        label['text'] = '耗时:  {0:.1f} ms'.format(elapsed*1000)
+        label['text'] = METRICS.summary()
 
         result.insert(INSERT, 'Titles:\n')
         result.insert(INSERT, '\n'.join(titles))
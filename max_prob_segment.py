@@ -2,6 +2,11 @@
  # -*- coding: utf-8 -*-  
 
 import re
+import threading
+
+from metrics import METRICS
+from sentence_cache import fileVersion
+from user_dict import USER_DICT_FILE, readUserDict
 
 K_DICT_FILE = 'data/word_frequency.txt'
 
@@ -14,8 +19,21 @@ class Word:
 
 
 class MaxProbabilitySegment:
-	def __init__(self):
-		self.mydict = self.buildDict()
+	# @param cache, an optional sentence_cache.SentenceCache of segmented strings
+	# @param lexicon, an optional lexicon.Lexicon shared with the other engines, used in
+	# place of the dictionary file
+	def __init__(self, cache=None, lexicon=None):
+		self.mydict = lexicon.probView() if lexicon is not None else self.buildDict()
+		self.defaultP = None		# Probability of a user word without frequency, see defaultProbability
+		self.cache = cache
+		self.dictLock = threading.Lock()
+		self.updates = 0
+		self.modelVersion = None
+		self.updateVersion()
+
+	def updateVersion(self):
+		''' Change the model version after a dictionary update so cached results are not reused '''
+		self.modelVersion = 'mp|{0}|{1}'.format(fileVersion(K_DICT_FILE), self.updates)
 
 	def buildDict(self):
 		with open(K_DICT_FILE, encoding='gbk') as f:
@@ -25,9 +43,74 @@ class MaxProbabilitySegment:
 				mydict[tokens[0]] = float(tokens[2].rstrip('%\n')) * 0.01
 			return mydict
 
+	##############################  Live dictionary updates #########################################
+	# Each update is a single dict operation, atomic for a segmentation running on another
+	# thread, and the lock keeps concurrent updates and the model version consistent.
+
+	# @return the smallest probability of the dictionary, computed on the first call since
+	# it reads the whole frequency column of a shared lexicon
+	def defaultProbability(self):
+		if self.defaultP is None:
+			self.defaultP = min(self.mydict.values(), default=1e-8)
+		return self.defaultP
+
+	# @param word, a word to add or reweight
+	# @param p, probability of the word, or None to keep the one of a word already in the
+	# dictionary and give a new word the smallest one of the dictionary
+	def addWord(self, word, p=None):
+		with self.dictLock:
+			if p is not None:
+				self.mydict[word] = p
+			elif word not in self.mydict:
+				self.mydict[word] = self.defaultProbability()
+			self.updates += 1
+			self.updateVersion()
+
+	# @return True if word was in the dictionary
+	def removeWord(self, word):
+		with self.dictLock:
+			if self.mydict.pop(word, None) is None:
+				return False
+			self.updates += 1
+			self.updateVersion()
+			return True
+
+	# @param p, new probability of word
+	# @return True if word was in the dictionary, otherwise nothing is changed
+	def reweightWord(self, word, p):
+		with self.dictLock:
+			if word not in self.mydict:
+				return False
+			self.mydict[word] = p
+			self.updates += 1
+			self.updateVersion()
+			return True
+
+	# @param path, a user dictionary file, see user_dict.py
+	# @return number of entries applied
+	def loadUserDict(self, path=USER_DICT_FILE):
+		entries = readUserDict(path)
+		for word, p, remove in entries:
+			if remove:
+				self.removeWord(word)
+			else:
+				self.addWord(word, p)
+		return len(entries)
+
 	# @param inputStr, input string
+	# @param cancelToken, an optional workers.CancelToken checked once per start position
 	# @return segmented string using Maximum Probability algorithm
-	def MaxProbability(self, inputStr):
+	def MaxProbability(self, inputStr, cancelToken=None):
+		if self.cache is None:
+			return self.MaxProbabilityAux(inputStr, cancelToken)
+		key = self.cache.key(self.modelVersion, inputStr)
+		result = self.cache.get(key)
+		if result is None:
+			result = self.MaxProbabilityAux(inputStr, cancelToken)
+			self.cache.put(key, result)
+		return result
+
+	def MaxProbabilityAux(self, inputStr, cancelToken):
 		if inputStr == '':
 			return ''
 		inputStr = self.removeWhiteSpace(inputStr)
@@ -35,24 +118,38 @@ class MaxProbabilitySegment:
 		maxEnding = None	# Keep track of the ending word with maximum cumulative probability
 		maxProb = 0.0
 		length = len(inputStr)
-		for i in range(0, length):	# Start position
-			for j in range(1, length-i+1):	# Substring length
-				subStr = inputStr[i:i+j]
-				if subStr in self.mydict:
-					# Make one candidate word
-					w = Word(i, i+j-1)
-					w.p = self.mydict[subStr]
-					w.leftNeighbour = self.findBestLeftNeighbour(w, candidates)
-					if w.leftNeighbour is not None:
-						w.p *= w.leftNeighbour.p
-					candidates.append(w)
-					# Find ending word with maximum cumulative probability
-					if (i+j) == length and w.p > maxProb:
-						maxEnding = w
-						maxProb = w.p
+		with METRICS.timer('mp.candidates'):
+			for i in range(0, length):	# Start position
+				if cancelToken is not None:
+					cancelToken.check(i, length)
+				for j in range(1, length-i+1):	# Substring length
+					# A single lookup, the word may be removed by another thread in between two
+					p = self.mydict.get(inputStr[i:i+j])
+					if p is not None:
+						# Make one candidate word
+						w = Word(i, i+j-1)
+						w.p = p
+						w.leftNeighbour = self.findBestLeftNeighbour(w, candidates)
+						if w.leftNeighbour is not None:
+							w.p *= w.leftNeighbour.p
+						candidates.append(w)
+						# Find ending word with maximum cumulative probability
+						if (i+j) == length and w.p > maxProb:
+							maxEnding = w
+							maxProb = w.p
+		if METRICS.enabled:
+			METRICS.incr('mp.dict_probes', length * (length + 1) // 2)
+			METRICS.incr('mp.candidates', len(candidates))
 		if maxEnding is None:
 			maxEnding = Word(length, length)
-		return self.constructResult(maxEnding, inputStr, candidates)
+		with METRICS.timer('mp.backtrack'):
+			return self.constructResult(maxEnding, inputStr, candidates)
+
+	# @param inputStr, input string
+	# @param cancelToken, an optional workers.CancelToken
+	# @return list of words, white spaces removed
+	def segmentWords(self, inputStr, cancelToken=None):
+		return [w for w in self.MaxProbability(inputStr, cancelToken).split('/  ') if w]
 
 	# @param word, a candidate word inputStr[beg..end]
 	# @param candidates, list of candidate words found so far
@@ -0,0 +1,203 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Lightweight instrumentation shared by all the engines.
+
+Engines report into the module-level METRICS object. It is disabled by default:
+`incr` returns immediately and `timer` hands back a shared no-op context manager,
+so the cost of an instrumented call is one attribute check. Hot loops count into
+local variables and report once per call.
+
+	from metrics import METRICS
+	METRICS.enable()
+	with METRICS.profile(cpu=True, memory=True):
+		mp.MaxProbability(text)
+	print(METRICS.asDict())
+	METRICS.writePrometheus('metrics.prom')
+'''
+import io
+import threading
+import time
+
+PROMETHEUS_PREFIX = 'nlp_'
+
+
+class _NullTimer:
+	'''
+	Context manager returned by Metrics.timer while the metrics are disabled
+	'''
+	def __enter__(self):
+		return self
+
+	def __exit__(self, excType, excValue, tb):
+		return False
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+	def __init__(self, metrics, name):
+		self.metrics = metrics
+		self.name = name
+		self.start = 0.0
+
+	def __enter__(self):
+		self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, excType, excValue, tb):
+		self.metrics.observe(self.name, time.perf_counter() - self.start)
+		return False
+
+
+class _Profile:
+	'''
+	Context manager capturing a cProfile and/or a tracemalloc report into Metrics.lastProfile
+	'''
+	def __init__(self, metrics, cpu, memory, limit):
+		self.metrics = metrics
+		self.cpu = cpu
+		self.memory = memory
+		self.limit = limit
+		self.profiler = None
+
+	def __enter__(self):
+		if self.cpu:
+			import cProfile
+			self.profiler = cProfile.Profile()
+			self.profiler.enable()
+		# Started last and stopped first so the profiler's own allocations are not traced
+		if self.memory:
+			import tracemalloc
+			tracemalloc.start()
+		return self
+
+	def __exit__(self, excType, excValue, tb):
+		report = {}
+		if self.memory:
+			import tracemalloc
+			snapshot = tracemalloc.take_snapshot()
+			current, peak = tracemalloc.get_traced_memory()
+			tracemalloc.stop()
+			lines = ['current: {0} bytes, peak: {1} bytes'.format(current, peak)]
+			for stat in snapshot.statistics('lineno')[:self.limit]:
+				lines.append(str(stat))
+			report['memory'] = '\n'.join(lines)
+		if self.cpu:
+			import pstats
+			self.profiler.disable()
+			out = io.StringIO()
+			pstats.Stats(self.profiler, stream=out).sort_stats('cumulative').print_stats(self.limit)
+			report['cpu'] = out.getvalue()
+		self.metrics.lastProfile = report
+		return False
+
+
+class Metrics:
+	'''
+	Named counters and per-stage timers. Timers keep the number of observations,
+	the total and the maximum elapsed seconds.
+	'''
+	def __init__(self):
+		self.enabled = False
+		self.counters = {}
+		self.timers = {}		# name => [count, total seconds, max seconds]
+		self.lastProfile = {}
+		self.lock = threading.Lock()
+
+	def enable(self):
+		self.enabled = True
+
+	def disable(self):
+		self.enabled = False
+
+	def reset(self):
+		with self.lock:
+			self.counters = {}
+			self.timers = {}
+			self.lastProfile = {}
+
+	# @param name, counter name such as 'bmm.dict_probes'
+	# @param n, amount to add
+	def incr(self, name, n=1):
+		if not self.enabled:
+			return
+		with self.lock:
+			self.counters[name] = self.counters.get(name, 0) + n
+
+	# @param name, stage name
+	# @param seconds, elapsed time of one run of the stage
+	def observe(self, name, seconds):
+		if not self.enabled:
+			return
+		with self.lock:
+			stat = self.timers.get(name)
+			if stat is None:
+				self.timers[name] = [1, seconds, seconds]
+			else:
+				stat[0] += 1
+				stat[1] += seconds
+				if seconds > stat[2]:
+					stat[2] = seconds
+
+	# @param name, stage name
+	# @return a context manager timing the enclosed block
+	def timer(self, name):
+		if not self.enabled:
+			return _NULL_TIMER
+		return _Timer(self, name)
+
+	# @param cpu, capture a cProfile report
+	# @param memory, capture a tracemalloc report
+	# @param limit, number of lines kept in each report
+	# @return a context manager, the reports end up in self.lastProfile
+	def profile(self, cpu=True, memory=False, limit=20):
+		return _Profile(self, cpu, memory, limit)
+
+	def asDict(self):
+		with self.lock:
+			return {
+				'counters': dict(self.counters),
+				'timers': {name: {'count': s[0], 'total_ms': s[1] * 1000, 'max_ms': s[2] * 1000}
+							for name, s in self.timers.items()},
+			}
+
+	# @return the metrics in the Prometheus text exposition format
+	def toPrometheus(self):
+		lines = []
+		with self.lock:
+			for name, value in sorted(self.counters.items()):
+				metric = PROMETHEUS_PREFIX + name.replace('.', '_') + '_total'
+				lines.append('# TYPE {0} counter'.format(metric))
+				lines.append('{0} {1}'.format(metric, value))
+			if self.timers:
+				metric = PROMETHEUS_PREFIX + 'stage_seconds'
+				lines.append('# TYPE {0} summary'.format(metric))
+				for name, s in sorted(self.timers.items()):
+					lines.append('{0}_count{{stage="{1}"}} {2}'.format(metric, name, s[0]))
+					lines.append('{0}_sum{{stage="{1}"}} {2:.9f}'.format(metric, name, s[1]))
+				metric = PROMETHEUS_PREFIX + 'stage_max_seconds'
+				lines.append('# TYPE {0} gauge'.format(metric))
+				for name, s in sorted(self.timers.items()):
+					lines.append('{0}{{stage="{1}"}} {2:.9f}'.format(metric, name, s[2]))
+		return '\n'.join(lines) + '\n'
+
+	def writePrometheus(self, path):
+		with open(path, 'w') as fd:
+			fd.write(self.toPrometheus())
+
+	# @param prefix, only report metrics whose name starts with this prefix
+	# @return a one-line human readable summary, used by the GUIs
+	def summary(self, prefix=''):
+		with self.lock:
+			parts = []
+			for name, s in sorted(self.timers.items()):
+				if name.startswith(prefix):
+					parts.append('{0}: {1:.1f} ms'.format(name, s[1] * 1000))
+			for name, value in sorted(self.counters.items()):
+				if name.startswith(prefix):
+					parts.append('{0}: {1}'.format(name, value))
+		return '    '.join(parts)
+
+
+METRICS = Metrics()
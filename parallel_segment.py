@@ -0,0 +1,199 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Segment large documents on all cores.
+
+The input is cut after sentence-final punctuation and at line boundaries, where no
+dictionary word can straddle the cut, so segmenting the chunks independently gives the
+same words as segmenting sentence by sentence. Chunks are decoded in a process pool and
+the words are mapped back to offsets in the original text.
+
+	python parallel_segment.py input.txt output.txt [mp|bmm|bigram] [processes]
+'''
+import concurrent.futures
+import os
+import re
+import sys
+
+from metrics import METRICS
+
+# A chunk ends after a run of sentence-final punctuation or at the end of a line
+SENTENCE_END = re.compile(r'[。！？!?；;…]+[”’"\')）]*|\n')
+DEFAULT_MAX_CHUNK = 2000		# Longer chunks are cut blindly to keep MP's quadratic lattice bounded
+DEFAULT_BATCH = 64				# Chunks sent to a worker per task
+
+_segmenter = None		# The segmenter of a worker process, built once by _initWorker
+
+
+# @param algorithm, 'mp', 'bmm' or 'bigram'
+# @param cacheBytes, size of the sentence cache placed in front of mp and bmm, or None
+# @param lexiconFile, a lexicon file mapped by mp and bmm in place of their dictionaries, so
+# the workers share one copy of it, or None. bigram has no dictionary to replace and
+# raises ValueError if given one, see checkLexicon
+# @return a segmenter exposing segmentWords(inputStr)
+def createSegmenter(algorithm, cacheBytes=None, lexiconFile=None):
+	checkLexicon(algorithm, lexiconFile)
+	cache = None
+	if cacheBytes:
+		from sentence_cache import SentenceCache
+		cache = SentenceCache(cacheBytes, name=algorithm + '_cache')
+	lexicon = None
+	if lexiconFile is not None:
+		from lexicon import Lexicon
+		lexicon = Lexicon(lexiconFile)
+	if algorithm == 'mp':
+		from max_prob_segment import MaxProbabilitySegment
+		return MaxProbabilitySegment(cache=cache, lexicon=lexicon)
+	elif algorithm == 'bmm':
+		from bmm_segment import BMMSegment
+		return BMMSegment(4, cache=cache, lexicon=lexicon)
+	elif algorithm == 'bigram':
+		from bigram_segment import BigramSegment
+		return BigramSegment()
+	raise ValueError('Unknown segmentation algorithm: ' + algorithm)
+
+# @param algorithm, a segmentation algorithm
+# @param lexiconFile, a lexicon file or None
+def checkLexicon(algorithm, lexiconFile):
+	if lexiconFile is not None and algorithm not in ('mp', 'bmm'):
+		raise ValueError('A lexicon file is only used by mp and bmm, not ' + algorithm)
+
+def _initWorker(algorithm, cacheBytes, lexiconFile):
+	global _segmenter
+	_segmenter = createSegmenter(algorithm, cacheBytes, lexiconFile)
+
+def _segmentBatch(chunks):
+	return [_segmenter.segmentWords(chunk) for chunk in chunks]
+
+
+# @param text, input text
+# @param maxChunk, maximum chunk length
+# @return list of (offset, chunk) with chunk == text[offset:offset+len(chunk)], chunks
+# holding only white spaces are dropped
+def splitChunks(text, maxChunk=DEFAULT_MAX_CHUNK):
+	chunks = []
+	beg = 0
+	for m in SENTENCE_END.finditer(text):
+		end = m.end()
+		appendChunk(chunks, text, beg, end, maxChunk)
+		beg = end
+	appendChunk(chunks, text, beg, len(text), maxChunk)
+	return chunks
+
+def appendChunk(chunks, text, beg, end, maxChunk):
+	while beg < end:
+		stop = min(end, beg + maxChunk)
+		if text[beg:stop].strip():
+			chunks.append((beg, text[beg:stop]))
+		beg = stop
+
+# @param offset, offset of chunk in the original text
+# @param chunk, the chunk text
+# @param words, words returned by the segmenter, white spaces removed
+# @return list of (start, end, word), end exclusive, offsets into the original text
+def alignWords(offset, chunk, words):
+	result = []
+	pos = 0
+	for w in words:
+		while chunk[pos].isspace():
+			pos += 1
+		start = pos
+		# Walk over the word's characters, skipping the white spaces removed from the chunk
+		for ch in w:
+			while chunk[pos] != ch:
+				pos += 1
+			pos += 1
+		result.append((offset + start, offset + pos, w))
+	return result
+
+
+class ParallelSegmenter:
+	'''
+	A process pool whose workers each hold one segmenter. segment() returns every word
+	with its offsets in the input, segmentFile() streams a large file line block by line
+	block and writes the result in the 'w/  ' format of MaxProbabilitySegment.
+	'''
+	def __init__(self, algorithm='mp', processes=None, maxChunk=DEFAULT_MAX_CHUNK, batch=DEFAULT_BATCH, cacheBytes=None,
+			lexiconFile=None):
+		# Raised here rather than by every worker's initializer
+		checkLexicon(algorithm, lexiconFile)
+		self.algorithm = algorithm
+		self.processes = processes or os.cpu_count() or 1
+		self.maxChunk = maxChunk
+		self.batch = batch
+		self.executor = concurrent.futures.ProcessPoolExecutor(
+			max_workers=self.processes, initializer=_initWorker, initargs=(algorithm, cacheBytes, lexiconFile))
+
+	def close(self):
+		self.executor.shutdown()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, excType, excValue, tb):
+		self.close()
+		return False
+
+	# @param chunks, list of (offset, chunk)
+	# @return list of word lists, in the order of chunks
+	def segmentChunks(self, chunks):
+		batches = [[c for o, c in chunks[i:i+self.batch]] for i in range(0, len(chunks), self.batch)]
+		results = []
+		for words in self.executor.map(_segmentBatch, batches):
+			results.extend(words)
+		return results
+
+	# @param text, input text of any length
+	# @return list of (start, end, word) with offsets into text
+	def segment(self, text):
+		with METRICS.timer('parallel.segment'):
+			chunks = splitChunks(text, self.maxChunk)
+			result = []
+			for (offset, chunk), words in zip(chunks, self.segmentChunks(chunks)):
+				result.extend(alignWords(offset, chunk, words))
+		METRICS.incr('parallel.chunks', len(chunks))
+		return result
+
+	# @param text, input text
+	# @return segmented string, same format as MaxProbabilitySegment.MaxProbability
+	def segmentString(self, text):
+		return ''.join(w + '/  ' for start, end, w in self.segment(text))
+
+	# @param inFile, input file, utf-8
+	# @param outFile, output file, one segmented line per input line
+	# @param linesPerBlock, number of lines read and dispatched at a time
+	def segmentFile(self, inFile, outFile, linesPerBlock=10000):
+		with open(inFile, encoding='utf-8') as fin, open(outFile, 'w', encoding='utf-8') as fout:
+			while True:
+				lines = []
+				for line in fin:
+					lines.append(line.rstrip('\n'))
+					if len(lines) == linesPerBlock:
+						break
+				if not lines:
+					break
+				chunks = []
+				owners = []		# Index of the line each chunk comes from
+				for i, line in enumerate(lines):
+					for offset, chunk in splitChunks(line, self.maxChunk):
+						chunks.append((offset, chunk))
+						owners.append(i)
+				out = [''] * len(lines)
+				for owner, words in zip(owners, self.segmentChunks(chunks)):
+					out[owner] += ''.join(w + '/  ' for w in words)
+				for line in out:
+					fout.write(line + '\n')
+
+
+def main():
+	if len(sys.argv) < 3:
+		print('Usage: python parallel_segment.py input.txt output.txt [mp|bmm|bigram] [processes]')
+		return
+	algorithm = sys.argv[3] if len(sys.argv) > 3 else 'mp'
+	processes = int(sys.argv[4]) if len(sys.argv) > 4 else None
+	with ParallelSegmenter(algorithm, processes) as segmenter:
+		segmenter.segmentFile(sys.argv[1], sys.argv[2])
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,99 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Compact parse trees shared by the parsers.
+
+A tree is stored as flat arrays in preorder: the label of every node, its number of
+children and the index of its parent. Words are leaf nodes under their part-of-speech
+node. Trees are built and serialized without recursion, so sentence length is not
+limited by the interpreter's recursion limit, and nothing is printed, so parsers can
+build trees on several threads at once.
+
+	tree.bracketed()	S(NP(fish)VP(V(fish)NP(tanks)))		the format printParseTree always returned
+	tree.penn()			(S (NP fish) (VP (V fish) (NP tanks)))
+	tree.json()			{"label": "S", "children": [{"label": "NP", "children": ["fish"]}, ...]}
+'''
+import array
+import json
+
+
+class ParseTree:
+	def __init__(self):
+		self.labels = []
+		self.arity = array.array('i')
+		self.parent = array.array('i')
+
+	# @param label, symbol or word of the node
+	# @param parent, index of the parent node, -1 for the root
+	# @return index of the new node, nodes must be added in preorder
+	def add(self, label, parent=-1):
+		self.labels.append(label)
+		self.arity.append(0)
+		self.parent.append(parent)
+		if parent >= 0:
+			self.arity[parent] += 1
+		return len(self.labels) - 1
+
+	def __len__(self):
+		return len(self.labels)
+
+	def __str__(self):
+		return self.bracketed()
+
+	# @return list of the indices of the children of node i
+	def children(self, i):
+		result = []
+		j = i + 1
+		for c in range(self.arity[i]):
+			result.append(j)
+			j = self.end(j)
+		return result
+
+	# @return index just past the subtree of node i
+	def end(self, i):
+		remaining = 1
+		while remaining > 0:
+			remaining += self.arity[i] - 1
+			i += 1
+		return i
+
+	# @return the words, left to right
+	def leaves(self):
+		return [label for label, n in zip(self.labels, self.arity) if n == 0]
+
+	# @param openNode, function(label) => text starting an inner node
+	# @param leaf, function(label) => text of a leaf
+	# @param close, text ending an inner node
+	# @param sep, text between two siblings
+	def serialize(self, openNode, leaf, close, sep):
+		out = []
+		remaining = []		# Children still to be written for each open node
+		for i, label in enumerate(self.labels):
+			if remaining and remaining[-1][0] < remaining[-1][1]:
+				out.append(sep)
+			if self.arity[i] > 0:
+				out.append(openNode(label))
+				remaining.append([self.arity[i], self.arity[i]])
+				continue
+			out.append(leaf(label))
+			# Close every node whose last child was just written
+			while remaining:
+				remaining[-1][0] -= 1
+				if remaining[-1][0] > 0:
+					break
+				remaining.pop()
+				out.append(close)
+		return ''.join(out)
+
+	# @return the tree in the 'S(NP(fish)VP(...))' format of the parsers
+	def bracketed(self):
+		return self.serialize(lambda label: label + '(', lambda label: label, ')', '')
+
+	# @return the tree in Penn Treebank format
+	def penn(self):
+		return self.serialize(lambda label: '(' + label + ' ', lambda label: label, ')', ' ')
+
+	# @return the tree as JSON, an inner node is {"label": ..., "children": [...]} and a word a string
+	def json(self):
+		return self.serialize(lambda label: '{"label": ' + json.dumps(label, ensure_ascii=False) + ', "children": [',
+			lambda label: json.dumps(label, ensure_ascii=False), ']}', ', ')
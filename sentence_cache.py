@@ -0,0 +1,142 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Bounded LRU cache of per-sentence engine results.
+
+Keys are a 16-byte BLAKE2 digest of the engine's model version and the normalized
+sentence, so a cache persisted to disk is never reused with a changed model. The size
+bound is in bytes, estimated from the keys and values held.
+
+	cache = SentenceCache(maxBytes=64 * 2**20, path='data/mp_cache.pickle', name='mp_cache')
+	mp = MaxProbabilitySegment(cache=cache)
+'''
+import atexit
+import collections
+import hashlib
+import os
+import pickle
+import re
+import sys
+import threading
+
+from metrics import METRICS
+
+DEFAULT_MAX_BYTES = 64 * 2**20
+CACHE_FORMAT = 1
+ENTRY_OVERHEAD = 100	# Bytes per entry for the dict slot and the linked list node of the LRU
+
+WHITE_SPACE = re.compile(r'\s+')
+
+
+# @param paths, files a model is loaded from
+# @return a string which changes whenever one of the files changes
+def fileVersion(*paths):
+	parts = []
+	for path in paths:
+		try:
+			st = os.stat(path)
+			parts.append('{0}:{1}:{2}'.format(path, st.st_size, int(st.st_mtime)))
+		except OSError:
+			parts.append(path + ':missing')
+	return '|'.join(parts)
+
+# @return approximate number of bytes held by obj (str, bytes, list, tuple and scalars)
+def estimateSize(obj):
+	size = sys.getsizeof(obj)
+	if isinstance(obj, (list, tuple)):
+		for item in obj:
+			if isinstance(item, (list, tuple, str, bytes)):
+				size += estimateSize(item)
+	return size
+
+
+class SentenceCache:
+	'''
+	Thread-safe LRU mapping sentence keys to results. Hits and misses are counted locally
+	and reported into METRICS as '<name>.hits' and '<name>.misses'.
+	'''
+	def __init__(self, maxBytes=DEFAULT_MAX_BYTES, path=None, name='cache'):
+		self.maxBytes = maxBytes
+		self.path = path
+		self.name = name
+		self.entries = collections.OrderedDict()	# key => (value, size)
+		self.bytes = 0
+		self.hits = 0
+		self.misses = 0
+		self.lock = threading.Lock()
+		if path is not None:
+			self.load()
+			atexit.register(self.save)
+
+	# @param modelVersion, a string identifying the model which computed the value
+	# @param sentence, the sentence or a string built from the engine input
+	# @return the cache key
+	def key(self, modelVersion, sentence):
+		h = hashlib.blake2b(digest_size=16)
+		h.update(modelVersion.encode('utf-8'))
+		h.update(b'\0')
+		h.update(WHITE_SPACE.sub('', sentence).encode('utf-8'))
+		return h.digest()
+
+	# @return the cached value or None
+	def get(self, key):
+		with self.lock:
+			entry = self.entries.get(key)
+			if entry is None:
+				self.misses += 1
+			else:
+				self.entries.move_to_end(key)
+				self.hits += 1
+		METRICS.incr(self.name + ('.misses' if entry is None else '.hits'))
+		return None if entry is None else entry[0]
+
+	def put(self, key, value):
+		size = estimateSize(key) + estimateSize(value) + ENTRY_OVERHEAD
+		if size > self.maxBytes:
+			return
+		with self.lock:
+			old = self.entries.pop(key, None)
+			if old is not None:
+				self.bytes -= old[1]
+			self.entries[key] = (value, size)
+			self.bytes += size
+			while self.bytes > self.maxBytes:
+				k, (v, s) = self.entries.popitem(last=False)
+				self.bytes -= s
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+			self.bytes = 0
+
+	def hitRate(self):
+		total = self.hits + self.misses
+		return self.hits / total if total > 0 else 0.0
+
+	def stats(self):
+		return {'entries': len(self.entries), 'bytes': self.bytes, 'hits': self.hits,
+				'misses': self.misses, 'hit_rate': self.hitRate()}
+
+	# @param path, file to write, defaults to the path given to the constructor
+	def save(self, path=None):
+		path = path or self.path
+		if path is None:
+			return
+		with self.lock:
+			items = [(k, v) for k, (v, s) in self.entries.items()]
+		tmp = path + '.tmp'
+		with open(tmp, 'wb') as fd:
+			pickle.dump({'format': CACHE_FORMAT, 'items': items}, fd, protocol=pickle.HIGHEST_PROTOCOL)
+		os.replace(tmp, path)
+
+	# @param path, file to read, defaults to the path given to the constructor
+	def load(self, path=None):
+		path = path or self.path
+		if path is None or not os.path.exists(path):
+			return
+		with open(path, 'rb') as fd:
+			data = pickle.load(fd)
+		if data.get('format') != CACHE_FORMAT:
+			return
+		for k, v in data['items']:		# Oldest first, so the LRU order is preserved
+			self.put(k, v)
@@ -1,16 +1,184 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 import re
-import copy
-import sys
-import io
+
+from metrics import METRICS
+from parse_tree import ParseTree
 
 RULES_FILE = 'data/rules.txt'
 
-class State:
-	def __init__(self, production, pos):
-		self.symbols = production
-		self.pos = pos
+class Expansion:
+	'''
+	A subgoal being expanded by SubgoalTable.spans, a frame of its explicit stack. It
+	records where the expansion stopped: the production i, the symbol k of it and the
+	j-th of the prefix ends (starts) that symbol k is extending.
+	'''
+	def __init__(self, symbol, pos, word, productions):
+		self.key = (symbol, pos)
+		self.word = word			# First word of the subgoal, for the FIRST set pruning
+		self.productions = productions
+		self.ends = {}				# end => derivation, found so far
+		self.heads = set()			# Subgoals being expanded the ends of this pass depend on
+		self.grown = False			# Whether this pass found new ends
+		self.i = -1
+		self.k = 0
+		self.starts = None			# list of (prefix end, children) of the production's symbols before k
+		self.j = 0
+		self.extended = None		# prefix end => children, once symbol k is added
+		self.restLength = 0			# Fewest words the symbols after k generate
+
+class SubgoalTable:
+	'''
+	The well-formed substring table of one parse: for a subgoal (symbol, pos) the end
+	positions the symbol can derive the words from pos (one-based) up to, each with the
+	first derivation found for it as a tree of ((symbol, alternative index), children).
+	A subgoal is expanded once and its ends are reused by every continuation needing it.
+
+	A left-recursive subgoal (NP -> NP PP) reads its own ends while they are being found,
+	and is expanded again until they stop growing. A subgoal whose ends depended on
+	another subgoal still being expanded is not stored, it is expanded again when that
+	one has its final ends.
+
+	The subgoals being expanded are kept on an explicit stack of Expansion frames, so the
+	depth of the derivations is not bounded by the recursion limit.
+	'''
+	def __init__(self, parser, sentence, cancelToken):
+		self.parser = parser
+		self.sentence = sentence
+		self.cancelToken = cancelToken
+		self.table = {}			# (symbol, pos) => dict end => derivation, final
+		self.active = {}		# (symbol, pos) => dict end => derivation, of the subgoals being expanded
+		self.expansions = 0
+		self.backtracks = 0
+		self.pruned = 0
+		self.reused = 0
+
+	# @param symbol, a grammar symbol
+	# @param pos, position of the first word, one-based
+	# @return (dict end => derivation, set of the subgoals being expanded the ends depend on)
+	def spans(self, symbol, pos):
+		result = self.lookup(symbol, pos)
+		if result is not None:
+			return result
+		stack = [self.open(symbol, pos)]
+		while True:
+			subgoal = self.advance(stack[-1], result)
+			if subgoal is not None:
+				stack.append(self.open(*subgoal))
+				result = None
+				continue
+			# The frame on top is done, its spans go to the frame waiting for them
+			result = self.close(stack.pop())
+			if not stack:
+				return result
+
+	# @param symbol, a grammar symbol
+	# @param pos, position of the first word, one-based
+	# @return the spans of the subgoal if they are known without expanding it, else None
+	def lookup(self, symbol, pos):
+		key = (symbol, pos)
+		if key in self.table:
+			self.reused += 1
+			return (self.table[key], ())
+		if key in self.active:
+			return (self.active[key], (key,))
+
+		parser = self.parser
+		word = self.sentence[pos-1] if pos <= len(self.sentence) else None
+		if word not in parser.first.get(symbol, ()):
+			self.pruned += 1
+			self.table[key] = {}
+			return ({}, ())
+		if symbol in parser.terminals:
+			# The terminal matches the current word, its leaf is built by buildTree
+			ends = {pos+1: ((symbol, -1), ())}
+			self.table[key] = ends
+			return (ends, ())
+		return None
+
+	# @return the Expansion of a subgoal lookup does not know
+	def open(self, symbol, pos):
+		N = len(self.sentence)
+		if self.cancelToken is not None:
+			self.cancelToken.check(pos - 1, N)
+		frame = Expansion(symbol, pos, self.sentence[pos-1], self.parser.findRules(symbol))
+		self.active[frame.key] = frame.ends
+		self.expansions += 1
+		return frame
+
+	# @param frame, an Expansion
+	# @param result, the spans of the subgoal frame waits for, None when it is not waiting
+	# @return the (symbol, pos) of a subgoal to expand before frame can go on, or None once
+	# the ends of frame are final
+	def advance(self, frame, result):
+		parser = self.parser
+		minLength = parser.minLength
+		N = len(self.sentence)
+		symbol = frame.key[0]
+		while True:
+			if frame.starts is None:
+				# Next production, or another pass over them
+				frame.i += 1
+				if frame.i == len(frame.productions):
+					# Only a subgoal reading its own ends can find more of them on another pass
+					if not frame.grown or frame.key not in frame.heads:
+						return None
+					self.expansions += 1
+					frame.i = 0
+					frame.heads = set()
+					frame.grown = False
+				production = frame.productions[frame.i]
+				if frame.word not in parser.first.get(production[0], ()):
+					self.pruned += 1
+					continue
+				self.startSymbol(frame, 0, [(frame.key[1], ())])
+
+			production = frame.productions[frame.i]
+			if frame.j < len(frame.starts):
+				# The ends of the prefix extended by the symbol k
+				start, children = frame.starts[frame.j]
+				if result is None:
+					result = self.lookup(production[frame.k], start)
+					if result is None:
+						return (production[frame.k], start)
+				sEnds, deps = result
+				result = None
+				frame.heads.update(deps)
+				for end, derivation in sEnds.items():
+					if end not in frame.extended and end + frame.restLength <= N + 1:
+						frame.extended[end] = children + (derivation,)
+				frame.j += 1
+			elif not frame.extended:
+				self.backtracks += 1
+				frame.starts = None
+			elif frame.k + 1 < len(production):
+				self.startSymbol(frame, frame.k + 1, list(frame.extended.items()))
+			else:
+				for end, children in frame.extended.items():
+					if end not in frame.ends:
+						frame.ends[end] = ((symbol, frame.i), children)
+						frame.grown = True
+				frame.starts = None
+
+	# @param frame, an Expansion
+	# @param k, index of the next symbol of its production
+	# @param starts, list of (prefix end, children) of the symbols before k
+	def startSymbol(self, frame, k, starts):
+		production = frame.productions[frame.i]
+		frame.k = k
+		frame.starts = starts
+		frame.j = 0
+		frame.extended = {}
+		frame.restLength = sum(self.parser.minLength.get(r, 1) for r in production[k+1:])
+
+	# @param frame, an Expansion whose ends are final
+	# @return its spans, stored in the table unless they depend on a subgoal still expanded
+	def close(self, frame):
+		del self.active[frame.key]
+		frame.heads.discard(frame.key)
+		if not frame.heads:
+			self.table[frame.key] = frame.ends
+		return (frame.ends, frame.heads)
 
 class DictList(dict):
 	'''
@@ -27,7 +195,9 @@ class TopDownParser:
 	def __init__(self):
 		self.rules = None
 		self.terminals = None
-		self.choices = {}	# Used to keep track of our choices on each non-terminal symbol
+		self.first = None		# symbol => set of the words a derivation of it can start with
+		self.minLength = None	# symbol => fewest words a derivation of it generates
+		self.choices = []	# The derivation of the last parse, see buildTree
 
 	def loadRules(self, rulesfile):
 		'''
@@ -59,6 +229,38 @@ class TopDownParser:
 					self.rules[head.strip()] = body.strip().split('|')
 					terminals.append(head.strip())
 		self.terminals = set(terminals)
+		self.computeFirstSets()
+
+	def computeFirstSets(self):
+		'''
+		FIRST set and minimum yield of every symbol, iterated to a fixed point. The rules
+		have no empty productions, so only the first symbol of a production counts
+		towards FIRST. A symbol without rules gets an empty FIRST set and is never expanded.
+		'''
+		first = {}
+		minLength = {}
+		for symbol in self.terminals:
+			first[symbol] = set(w for rule in self.rules[symbol] for w in rule)
+			minLength[symbol] = 1
+		changed = True
+		while changed:
+			changed = False
+			for symbol, productions in self.rules.items():
+				if symbol in self.terminals:
+					continue
+				words = first.setdefault(symbol, set())
+				for production in productions:
+					extra = first.get(production[0], set()) - words
+					if extra:
+						words |= extra
+						changed = True
+					if all(s in minLength for s in production):
+						n = sum(minLength[s] for s in production)
+						if n < minLength.get(symbol, n + 1):
+							minLength[symbol] = n
+							changed = True
+		self.first = first
+		self.minLength = minLength
 
 	def findRules(self, symbol):
 		return self.rules[symbol]
@@ -72,89 +274,93 @@ class TopDownParser:
 				return True
 		return False
 
+	# @return the parse string of the last parsed sentence
 	def printParseTree(self):
-		'''
-		Construct the parse string using a helper method and some tricks
-		(redirect stdout to a StringIO object temporally)
-		'''
-		sys.stdout = mystdout = io.StringIO()
-		self.printParseTreeAux('S', self.choices, self.rules)
-		parseString = mystdout.getvalue()
-		sys.stdout = sys.__stdout__
-		mystdout.close()
-		return parseString
-
-	# @param symbol, a non-terminal symbol
-	# @param choices, a dict which records which choices we made during the parsing process
-	# @param rules, a dict of rules 
-	# @return nothing
-	def printParseTreeAux(self, symbol, choices, rules):
+		return self.buildTree(self.choices).bracketed()
+
+	# @param choices, a list of (symbol, alternative index) which records the choices we made
+	# during the parsing process
+	# @return a ParseTree
+	def buildTree(self, choices):
 		'''
 		Choices mean which production we selected, eg. there are two productions for symbol 'NP':
 			NP -> art n, NP -> art adj n
-		Choices['NP'] = 1 means we select the #1(zero-based) production which is NP -> art adj n
-		With this information in hand, we can simply backtrack from the 'S' symbol to construct the parse string.
+		('NP', 1) means we select the #1(zero-based) production which is NP -> art adj n, and
+		('art', -1) that the terminal art matched a word. The parser always expands the
+		leftmost symbol, so the choices come in the preorder of the tree and each one is
+		the next child of the innermost node still missing children. A terminal's leaf
+		lists the words it can generate.
 		'''
-		if choices[symbol] == -1:
-			print(symbol + '(' + '|'.join(rules[symbol][0]) + ')', end='')
-		else:
-			c = choices[symbol]
-			print(symbol, end='')
-			print('(', end='')
-			for symbl in rules[symbol][c]:
-				self.printParseTreeAux(symbl, choices, rules)
-			print(')', end='')
-
-	def parse(self, sentence):
-		stack = []
-		succeed = False
-		failed = False
-		# Begin with the START symbol
-		currState = State(['S'], 1)
-		while not succeed and not failed:
-
-			if not currState.symbols and currState.pos == len(sentence)+1:
-				return True
-			elif (not currState.symbols and not stack and currState.pos != len(sentence)+1) or (currState.pos == len(sentence)+1):
-				return False
-
-			# First symbol of this production
-			s1 = currState.symbols[0]
-			if (s1 in self.terminals) and self.checkWordInSymbol(sentence[currState.pos-1], s1):
-				# If s1 is a terminal and it matches current word, create new state by removing
-				# s1, updating the word position 
-				del currState.symbols[0] 
-				currState.pos += 1
-				self.choices[s1] = -1 	# Set terminal marker used to build the parse tree
-
-			elif s1 not in self.terminals:
-				# If this is a non-terminal, expand s1 with its production and push possible alternatives to stack
-				rules = self.findRules(s1)
-				if len(rules) > 1:
-					oldState = copy.deepcopy(currState)
-				if rules is not None:
-					# Record our choices which will be used to build the parse tree
-					if s1 in self.choices:
-						self.choices[s1] += 1
-					else:
-						self.choices[s1] = 0
-
-					del currState.symbols[0]
-					currState = State(rules[0] + currState.symbols, currState.pos)
-					# Push candidates into stack
-					if len(rules) > 1:
-						del oldState.symbols[0]
-						for i in range(1, len(rules)):
-							stack.append((State(rules[i] + oldState.symbols, oldState.pos), s1))
-			elif stack:
-				# If current state is empty, and the sentence not yet exhausted, backtrack!
-				currState, s1 = stack.pop()
-				if s1 in self.choices:
-					self.choices[s1] += 1
-				else:
-					self.choices[s1] = 0
+		tree = ParseTree()
+		unfinished = []		# [node, children still to add] of the nodes missing children
+		for symbol, choice in choices:
+			parent = -1
+			if unfinished:
+				parent = unfinished[-1][0]
+				unfinished[-1][1] -= 1
+				if unfinished[-1][1] == 0:
+					unfinished.pop()
+			node = tree.add(symbol, parent)
+			if choice == -1:
+				tree.add('|'.join(self.rules[symbol][0]), node)
 			else:
-				failed = True
+				unfinished.append([node, len(self.rules[symbol][choice])])
+		return tree
+
+	# @param sentence, a list of words
+	# @param cancelToken, an optional workers.CancelToken checked once per step
+	# @return a ParseTree, or None if the sentence cannot be derived from 'S'
+	def parseTree(self, sentence, cancelToken=None):
+		succeed, choices = self.parseChoices(sentence, cancelToken)
+		self.choices = choices
+		return self.buildTree(choices) if succeed else None
+
+	# @param sentence, a list of words
+	# @param cancelToken, an optional workers.CancelToken checked once per step
+	# @return True if the sentence can be derived from 'S'
+	def parse(self, sentence, cancelToken=None):
+		succeed, choices = self.parseChoices(sentence, cancelToken)
+		self.choices = choices		# Kept for printParseTree and the GUI
+		return succeed
+
+	# @param sentence, a list of words
+	# @param cancelToken, an optional workers.CancelToken checked once per step
+	# @return (True if the sentence can be derived from 'S', the choices made), the choices
+	# are local to the call so several threads can parse at once
+	def parseChoices(self, sentence, cancelToken=None):
+		'''
+		Top-down expansion from 'S' over a SubgoalTable, the alternatives of a symbol tried
+		in the order of the rules file. An alternative is only expanded if its first symbol
+		can start with the next word (FIRST sets), and a prefix of it is only continued if
+		the symbols left need no more words than are left. Each (symbol, pos) subgoal is
+		expanded once whatever the symbols following it, so the work is polynomial in the
+		length of the sentence even for ambiguous and left-recursive grammars.
+		'''
+		N = len(sentence)
+		table = SubgoalTable(self, sentence, cancelToken)
+		ends, heads = table.spans('S', 1)
+		self.reportMetrics(table)
+		if N + 1 not in ends:
+			return (False, [])
+		return (True, self.derivationList(ends[N + 1]))
+
+	# @param derivation, a tree of ((symbol, alternative index), children)
+	# @return the list of (symbol, alternative index) in preorder
+	def derivationList(self, derivation):
+		choices = []
+		stack = [derivation]
+		while stack:
+			choice, children = stack.pop()
+			choices.append(choice)
+			stack.extend(reversed(children))
+		return choices
+
+	def reportMetrics(self, table):
+		if METRICS.enabled:
+			METRICS.incr('topdown.expansions', table.expansions)
+			METRICS.incr('topdown.backtracks', table.backtracks)
+			METRICS.incr('topdown.pruned', table.pruned)
+			METRICS.incr('topdown.reused', table.reused)
 
 def main():
 	sentence = ['the', 'old', 'man', 'cried']
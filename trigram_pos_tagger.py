@@ -0,0 +1,229 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import heapq
+import math
+
+from max_prob_segment import MaxProbabilitySegment
+from metrics import METRICS
+
+WORDS_FILE = 'data/words.txt'
+TAGS_FILE = 'data/tags.txt'
+TRIGRAM_MODEL_FILE = 'data/trigram_model.txt'	# Written by compute_hmm_parameters.computeTrigramHMMParameters
+
+OOV_LOG_EMIT_P = math.log(1e-20)	# Emission log-probability of a word not in the dictionary
+DEFAULT_MAX_STATES = 64				# Tag-pair states kept per position, bounds the work per token
+
+
+class TrigramHMMModel:
+	'''
+	Second-order HMM over tags. Counts are kept sparse: n-gram counts live in dicts keyed
+	by a packed integer (t1 * B + t2) * B + t3, where B = numTags + 2 leaves room for the
+	START and STOP padding tags. Transition log-probabilities are interpolated with the
+	deleted interpolation weights on first use and then cached.
+	'''
+	def __init__(self):
+		self.states = None
+		self.word2id = None
+		self.START = 0
+		self.STOP = 0
+		self.base = 0
+		self.lambdas = None
+		self.total = 0
+		self.unigrams = {}
+		self.histUnigrams = {}
+		self.bigrams = {}
+		self.histBigrams = {}
+		self.trigrams = {}
+		self.emitForWord = None		# word id => list of (tag id, emission log-probability)
+		self.transCache = {}
+		self.loadModelParameters()
+
+	def loadModelParameters(self):
+		''' Load words, tags and the sparse trigram counts from files '''
+		self.states = []
+		self.word2id = {}
+		with open(WORDS_FILE, encoding='utf-8') as fd:
+			for i, w in enumerate(fd):
+				self.word2id[w.strip()] = i
+		with open(TAGS_FILE, encoding='utf-8') as fd2:
+			for i, t in enumerate(fd2):
+				self.states.append(t.strip())
+		self.START = len(self.states)
+		self.STOP = self.START + 1
+		self.base = self.START + 2
+
+		sections = {
+			'#UNIGRAM': self.unigrams,
+			'#HIST_UNIGRAM': self.histUnigrams,
+			'#BIGRAM': self.bigrams,
+			'#HIST_BIGRAM': self.histBigrams,
+			'#TRIGRAM': self.trigrams,
+		}
+		emissions = []
+		tagCounts = [0] * self.base
+		section = None
+		with open(TRIGRAM_MODEL_FILE, encoding='utf-8') as fd:
+			for line in fd:
+				line = line.strip()
+				if line == '':
+					continue
+				if line.startswith('#'):
+					section = line
+					continue
+				fields = line.split()
+				if section == '#LAMBDAS':
+					self.lambdas = tuple(map(float, fields))
+				elif section == '#TOTAL':
+					self.total = int(fields[0])
+				elif section == '#EMIT':
+					t, w, ct = map(int, fields)
+					emissions.append((t, w, ct))
+					tagCounts[t] += ct
+				else:
+					ids = list(map(int, fields[:-1]))
+					sections[section][self.pack(*ids)] = int(fields[-1])
+
+		self.emitForWord = [[] for w in range(len(self.word2id))]
+		for t, w, ct in emissions:
+			self.emitForWord[w].append((t, math.log(ct / tagCounts[t])))
+		for tags in self.emitForWord:
+			tags.sort()
+
+	def pack(self, *tags):
+		key = 0
+		for t in tags:
+			key = key * self.base + t
+		return key
+
+	# @return log q(t3 | t1, t2), -inf if the interpolated probability is zero
+	def logTrans(self, t1, t2, t3):
+		key = (t1 * self.base + t2) * self.base + t3
+		logp = self.transCache.get(key)
+		if logp is not None:
+			return logp
+		l1, l2, l3 = self.lambdas
+		p = 0.0
+		h2 = self.histBigrams.get(t1 * self.base + t2, 0)
+		if h2 > 0:
+			p += l3 * self.trigrams.get(key, 0) / h2
+		h1 = self.histUnigrams.get(t2, 0)
+		if h1 > 0:
+			p += l2 * self.bigrams.get(t2 * self.base + t3, 0) / h1
+		p += l1 * self.unigrams.get(t3, 0) / self.total
+		logp = math.log(p) if p > 0.0 else float('-inf')
+		self.transCache[key] = logp
+		return logp
+
+
+class Trigram_HMM_POS_TAGGER:
+	'''
+	Viterbi over (previous tag, current tag) states of the trigram model. Each word only
+	proposes the tags it was seen with in training, unknown words propose oovTags (all
+	tags by default). At most maxStates states survive each position, and beamLogRatio
+	optionally drops states scoring more than that many nats below the best one, so the
+	work per token is bounded by maxStates times the number of candidate tags.
+	'''
+	def __init__(self, oovTags=None, maxStates=DEFAULT_MAX_STATES, beamLogRatio=None):
+		self.hmm = TrigramHMMModel()
+		self.maxStates = maxStates
+		self.beamLogRatio = beamLogRatio
+		self.oovCandidates = None
+		self.setOOVTags(oovTags)
+
+	# @param oovTags, a list of tag strings tried for unknown words, or None for all tags
+	def setOOVTags(self, oovTags):
+		if oovTags is None:
+			ids = range(len(self.hmm.states))
+		else:
+			tag2id = dict((t, i) for i, t in enumerate(self.hmm.states))
+			ids = sorted(tag2id[t] for t in oovTags)
+		self.oovCandidates = [(t, OOV_LOG_EMIT_P) for t in ids]
+
+	# @param observations, a list of segmented word
+	# @param cancelToken, an optional workers.CancelToken checked once per time step
+	# @return a pos-tagged string, same format as HMM_Viterbi_POS_TAGGER.Viterbi
+	def Viterbi(self, observations, cancelToken=None):
+		T = len(observations)
+		if T == 0:
+			return ''
+		hmm = self.hmm
+		logTrans = hmm.logTrans
+		START = hmm.START
+
+		# layer maps a state (u, v) to the best log score of a path ending with tags u, v,
+		# backs[t] maps the state at time t to the tag before u on that path
+		layer = {(START, START): 0.0}
+		backs = []
+		transitions = 0
+		oov = 0
+		with METRICS.timer('trigram.decode'):
+			for t in range(T):
+				if cancelToken is not None:
+					cancelToken.check(t, T)
+				w = hmm.word2id.get(observations[t], -1)
+				if w == -1:
+					candidates = self.oovCandidates
+					oov += 1
+				else:
+					candidates = hmm.emitForWord[w]
+				newLayer = {}
+				back = {}
+				for (prev, u), score in layer.items():
+					for v, logEmit in candidates:
+						s = score + logTrans(prev, u, v) + logEmit
+						key = (u, v)
+						if s > newLayer.get(key, float('-inf')):
+							newLayer[key] = s
+							back[key] = prev
+				transitions += len(layer) * len(candidates)
+				if not newLayer:
+					# Every candidate is unreachable, fall back to keeping the scores finite
+					for (prev, u), score in layer.items():
+						for v, logEmit in candidates:
+							newLayer[(u, v)] = score + logEmit
+							back[(u, v)] = prev
+				layer = self.prune(newLayer)
+				backs.append(back)
+
+		if METRICS.enabled:
+			METRICS.incr('trigram.tokens', T)
+			METRICS.incr('trigram.oov', oov)
+			METRICS.incr('trigram.transitions', transitions)
+
+		# Close the sentence with the STOP tag
+		best = None
+		for (u, v), score in layer.items():
+			s = score + logTrans(u, v, hmm.STOP)
+			if best is None or s > best[0]:
+				best = (s, u, v)
+		tags = [0] * T
+		tags[T-1] = best[2]
+		if T > 1:
+			tags[T-2] = best[1]
+		for t in range(T-1, 1, -1):
+			tags[t-2] = backs[t][(tags[t-1], tags[t])]
+
+		res = ''
+		for i in range(T):
+			res += observations[i] + '/' + hmm.states[tags[i]] + '   '
+		return res
+
+	# @param layer, a dict of state => log score
+	# @return the states surviving the beam
+	def prune(self, layer):
+		if self.beamLogRatio is not None and layer:
+			threshold = max(layer.values()) - self.beamLogRatio
+			layer = dict((key, s) for key, s in layer.items() if s >= threshold)
+		if self.maxStates is not None and len(layer) > self.maxStates:
+			layer = dict(heapq.nlargest(self.maxStates, layer.items(), key=lambda item: item[1]))
+		return layer
+
+
+if __name__ == '__main__':
+	inputStr = '在这一年中，中国的改革开放和现代化ss建设继续向前迈进。'
+	mp = MaxProbabilitySegment()
+	segmented =  mp.MaxProbability(inputStr)
+	print(segmented)
+	obs = [w.strip('/') for w in segmented.split()]
+	tagger = Trigram_HMM_POS_TAGGER()
+	print(tagger.Viterbi(obs))
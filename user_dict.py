@@ -0,0 +1,44 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+User dictionary files, applied on top of the system dictionaries of the segmenters at
+run time by BMMSegment.loadUserDict and MaxProbabilitySegment.loadUserDict.
+
+One entry per line, utf-8, in the format of the system dictionaries:
+	热词					add a word
+	热词,0.0012%			add a word with its frequency, used by MaxProbabilitySegment
+	热词,120,0.0012%		same, the line format of data/word_frequency.txt
+	-旧词					remove a word
+Lines starting with '#' are comments.
+'''
+
+USER_DICT_FILE = 'data/user_dict.txt'
+
+
+# @param field, a frequency such as '0.0012%' or a probability such as '0.000012'
+# @return the probability, or None if field is not a number (eg. a tag of data/chinese_dict.txt)
+def parseFrequency(field):
+	field = field.strip()
+	try:
+		if field.endswith('%'):
+			return float(field[:-1]) * 0.01
+		return float(field)
+	except ValueError:
+		return None
+
+# @param path, a user dictionary file
+# @return list of (word, probability or None, remove flag), in file order
+def readUserDict(path=USER_DICT_FILE):
+	entries = []
+	with open(path, encoding='utf-8') as f:
+		for line in f:
+			line = line.strip()
+			if line == '' or line.startswith('#'):
+				continue
+			if line.startswith('-'):
+				entries.append((line[1:].split(',')[0].strip(), None, True))
+				continue
+			fields = line.split(',')
+			p = parseFrequency(fields[-1]) if len(fields) > 1 else None
+			entries.append((fields[0].strip(), p, False))
+	return [e for e in entries if e[0] != '']
@@ -1,6 +1,8 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 from max_prob_segment import MaxProbabilitySegment
+from metrics import METRICS
+from sentence_cache import fileVersion
 
 WORDS_FILE = 'data/words.txt'
 TAGS_FILE = 'data/tags.txt'
@@ -8,23 +10,30 @@ TRANS_MATRIX_FILE = 'data/trans_matrix.txt'
 EMIT_MATRIX_FILE = 'data/emit_matrix.txt'
 INIT_PROB_FILE = 'data/init_prob.txt'
 
+OOV_EMIT_P = 1e-20		# Emission probability of a word not in the dictionary
+
 
 class HMMModel:
-	def __init__(self):
+	# @param lexicon, an optional lexicon.Lexicon providing the word ids in place of WORDS_FILE
+	def __init__(self, lexicon=None):
 		self.states = None
 		self.trans_p = None
 		self.emit_p = None
 		self.init_p = None
 		self.word2id = None
+		self.lexicon = lexicon
 		self.loadModelParameters()
 
 	def loadModelParameters(self):
 		''' Load HMM model parameters from files '''
 		self.states = []
-		self.word2id = {}
-		with open(WORDS_FILE, encoding='utf-8') as fd:
-			for i, w in enumerate(fd):
-				self.word2id[w.strip()] = i
+		if self.lexicon is not None:
+			self.word2id = self.lexicon.hmmView()
+		else:
+			self.word2id = {}
+			with open(WORDS_FILE, encoding='utf-8') as fd:
+				for i, w in enumerate(fd):
+					self.word2id[w.strip()] = i
 		with open(TAGS_FILE, encoding='utf-8') as fd2:
 			for i, t in enumerate(fd2):
 				self.states.append(t.strip())
@@ -46,51 +55,118 @@ class HMMModel:
 
 
 class HMM_Viterbi_POS_TAGGER:
-	def __init__(self):
-		self.hmm = HMMModel()
+	'''
+	With pruned=True, Viterbi only evaluates the tags each word has been observed with
+	(non-zero emission probability), and the tags in oovTags for a word not in the
+	dictionary. oovTags defaults to every tag, which keeps the result identical to the
+	exhaustive decoder. beamRatio additionally drops, at every time step, the states
+	whose score is below beamRatio times the best score of that step.
+	'''
+	def __init__(self, pruned=False, oovTags=None, beamRatio=None, cache=None, lexicon=None):
+		self.hmm = HMMModel(lexicon)
+		self.pruned = pruned
+		self.beamRatio = beamRatio
+		self.tagsForWord = None
+		self.oovTags = None
+		self.cache = cache
+		self.modelVersion = 'hmm|{0}|{1}|{2}|{3}'.format(pruned, oovTags, beamRatio,
+			fileVersion(WORDS_FILE, TAGS_FILE, TRANS_MATRIX_FILE, EMIT_MATRIX_FILE, INIT_PROB_FILE))
+		if pruned:
+			self.tagsForWord = self.buildTagDictionary()
+			self.setOOVTags(oovTags)
 
-	# @param observations, a lisf of segmented word
-	# @return a pos-tagged string using HMM-Viterbi algorithm
-	def Viterbi(self, observations):
-		''' Calculate the hidden state sequence with maxinum probability using HMM-Viterbi algorithm '''
-		K = len(self.hmm.states)
-		# obs = [self.hmm.word2id[w] for w in observations]	# Convert word to id
+	# @return a list indexed by word id of the sorted tag ids with non-zero emission probability
+	def buildTagDictionary(self):
+		tagsForWord = [[] for w in range(len(self.hmm.word2id))]
+		for i, row in enumerate(self.hmm.emit_p):
+			for w, p in enumerate(row):
+				if p > 0.0:
+					tagsForWord[w].append(i)
+		return tagsForWord
+
+	# @param oovTags, a list of tag strings tried for unknown words, or None for all tags
+	def setOOVTags(self, oovTags):
+		if oovTags is None:
+			self.oovTags = list(range(len(self.hmm.states)))
+		else:
+			tag2id = dict((t, i) for i, t in enumerate(self.hmm.states))
+			self.oovTags = sorted(tag2id[t] for t in oovTags)
+
+	# @param observations, a list of segmented word
+	# @return a list of word ids, -1 for a word not in the dictionary
+	def wordIds(self, observations):
 		obs = []
 		for w in observations:
 			try:
 				obs.append(self.hmm.word2id[w])
-			except:		
+			except:
 				obs.append(-1)
+		return obs
+
+	def formatResult(self, observations, tags):
+		res = ''
+		for i in range(len(observations)):
+			res += observations[i] + '/' + tags[i] + '   '
+		return res
+
+	# @param observations, a lisf of segmented word
+	# @param cancelToken, an optional workers.CancelToken checked once per time step
+	# @return a pos-tagged string using HMM-Viterbi algorithm
+	def Viterbi(self, observations, cancelToken=None):
+		''' Calculate the hidden state sequence with maxinum probability using HMM-Viterbi algorithm '''
+		if self.cache is not None:
+			# The key drops white spaces, join with NUL so the word boundaries are kept
+			key = self.cache.key(self.modelVersion, '\0'.join(observations))
+			result = self.cache.get(key)
+			if result is None:
+				result = self.ViterbiAux(observations, cancelToken)
+				self.cache.put(key, result)
+			return result
+		return self.ViterbiAux(observations, cancelToken)
+
+	def ViterbiAux(self, observations, cancelToken):
+		if self.pruned:
+			return self.ViterbiPruned(observations, cancelToken)
+		K = len(self.hmm.states)
+		obs = self.wordIds(observations)	# Convert word to id
 		T = len(obs)
 	  
-		# K x T
-		# V[i][j] stores the probability of the most likely path so far S = {s1,s2,...,sj}, 
-		# with sj = states[i] at time j
-		V = [[0.0 for i in range(T)] for j in range(K)]
-
-		# K x T
-		# P[i][j] stores the previous state sj-1 of the most likely path so far 
-		P = [[-1 for i in range(T)] for j in range(K)]
+		if METRICS.enabled:
+			METRICS.incr('viterbi.tokens', T)
+			METRICS.incr('viterbi.oov', obs.count(-1))
+			METRICS.incr('viterbi.transitions', max(T-1, 0) * K * K)
+
+		with METRICS.timer('viterbi.decode'):
+			# K x T
+			# V[i][j] stores the probability of the most likely path so far S = {s1,s2,...,sj}, 
+			# with sj = states[i] at time j
+			V = [[0.0 for i in range(T)] for j in range(K)]
+
+			# K x T
+			# P[i][j] stores the previous state sj-1 of the most likely path so far 
+			P = [[-1 for i in range(T)] for j in range(K)]
 		
-		# For each state at time 0, compute its probability
-		for i in range(K):	
-			emit_i_0 = 1e-20 if obs[0] == -1 else self.hmm.emit_p[i][obs[0]]
-			V[i][0] = self.hmm.init_p[i] * emit_i_0
-			P[i][0] = i
-
-		for t in range(1, T):	# For each time step
-			obs_t = obs[t]
-			for j in range(K):	# For each state at time t
-				maxp = -1.0
-				prev = -1
-				for k in range(K):	# For each previous state
-					# Special handling of the new word not in dictionary
-					emit_j_t = 1e-20 if obs_t == -1 else self.hmm.emit_p[j][obs[t]]
-					if maxp < emit_j_t * self.hmm.trans_p[k][j] * V[k][t-1]:
-						maxp = emit_j_t * self.hmm.trans_p[k][j] * V[k][t-1]
-						prev = k
-				V[j][t] = maxp
-				P[j][t] = prev
+			# For each state at time 0, compute its probability
+			for i in range(K):	
+				emit_i_0 = OOV_EMIT_P if obs[0] == -1 else self.hmm.emit_p[i][obs[0]]
+				V[i][0] = self.hmm.init_p[i] * emit_i_0
+				P[i][0] = i
+
+			for t in range(1, T):	# For each time step
+				if cancelToken is not None:
+					cancelToken.check(t, T)
+				obs_t = obs[t]
+				for j in range(K):	# For each state at time t
+					maxp = -1.0
+					prev = -1
+					for k in range(K):	# For each previous state
+						# Special handling of the new word not in dictionary
+						emit_j_t = OOV_EMIT_P if obs_t == -1 else self.hmm.emit_p[j][obs[t]]
+						if maxp < emit_j_t * self.hmm.trans_p[k][j] * V[k][t-1]:
+							maxp = emit_j_t * self.hmm.trans_p[k][j] * V[k][t-1]
+							prev = k
+					V[j][t] = maxp
+					P[j][t] = prev
 
 		# Find the last hidden state with maximum probability
 		maxp, state = max([(V[i][T-1], i) for i in range(K)])
@@ -102,10 +178,81 @@ class HMM_Viterbi_POS_TAGGER:
 			tags = [self.hmm.states[prev]] + tags
 			prev = P[prev][t]
 		
-		res = ''
-		for i in range(T):
-			res += observations[i] + '/' + tags[i] + '   '
-		return res
+		return self.formatResult(observations, tags)
+
+	# @param observations, a list of segmented word
+	# @param cancelToken, an optional workers.CancelToken checked once per time step
+	# @return a pos-tagged string, same format as Viterbi
+	def ViterbiPruned(self, observations, cancelToken=None):
+		'''
+		Viterbi restricted to the permissible tags of each word. States[t] lists the tag ids
+		kept at time t, V[t] and P[t] are parallel to it, P[t] holding the index of the best
+		previous state in States[t-1].
+		'''
+		if self.tagsForWord is None:
+			self.tagsForWord = self.buildTagDictionary()
+			self.setOOVTags(None)
+		obs = self.wordIds(observations)
+		T = len(obs)
+		emit_p = self.hmm.emit_p
+		trans_p = self.hmm.trans_p
+
+		States = []
+		V = []
+		P = []
+		transitions = 0
+		with METRICS.timer('viterbi.decode'):
+			for t in range(T):
+				if cancelToken is not None:
+					cancelToken.check(t, T)
+				w = obs[t]
+				candidates = self.oovTags if w == -1 else self.tagsForWord[w]
+				states = []
+				scores = []
+				backs = []
+				for j in candidates:
+					emit_j_t = OOV_EMIT_P if w == -1 else emit_p[j][w]
+					if t == 0:
+						maxp = self.hmm.init_p[j] * emit_j_t
+						prev = -1
+					else:
+						maxp = -1.0
+						prev = -1
+						prevScores = V[t-1]
+						for idx, k in enumerate(States[t-1]):	# For each surviving previous state
+							p = emit_j_t * trans_p[k][j] * prevScores[idx]
+							if maxp < p:
+								maxp = p
+								prev = idx
+						transitions += len(prevScores)
+					states.append(j)
+					scores.append(maxp)
+					backs.append(prev)
+
+				if self.beamRatio is not None and len(states) > 1:
+					threshold = max(scores) * self.beamRatio
+					keep = [idx for idx, score in enumerate(scores) if score >= threshold]
+					states = [states[idx] for idx in keep]
+					scores = [scores[idx] for idx in keep]
+					backs = [backs[idx] for idx in keep]
+				States.append(states)
+				V.append(scores)
+				P.append(backs)
+
+		if METRICS.enabled:
+			METRICS.incr('viterbi.tokens', T)
+			METRICS.incr('viterbi.oov', obs.count(-1))
+			METRICS.incr('viterbi.transitions', transitions)
+
+		# Find the last hidden state with maximum probability, ties go to the larger tag id
+		# as in the exhaustive decoder
+		maxp, state, idx = max((V[T-1][idx], States[T-1][idx], idx) for idx in range(len(States[T-1])))
+
+		tags = [None] * T
+		for t in reversed(range(T)):
+			tags[t] = self.hmm.states[States[t][idx]]
+			idx = P[t][idx]
+		return self.formatResult(observations, tags)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,105 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+Cancellation tokens checked by the engines' main loops, and a runner used by the GUIs
+to execute engine calls on a worker thread and deliver the results back on the Tk thread.
+'''
+import concurrent.futures
+
+
+class Cancelled(Exception):
+	'''
+	Raised inside an engine when the token of the running call has been cancelled
+	'''
+	pass
+
+
+class CancelToken:
+	'''
+	Shared between the caller and a running engine call. The engine calls check() once per
+	iteration of its main loop, which also records how far the call has progressed.
+	'''
+	def __init__(self):
+		self.cancelled = False
+		self.done = 0
+		self.total = 0
+
+	def cancel(self):
+		self.cancelled = True
+
+	# @param done, units of work finished so far
+	# @param total, total units of work
+	def check(self, done=None, total=None):
+		if done is not None:
+			self.done = done
+			self.total = total
+		if self.cancelled:
+			raise Cancelled()
+
+	# @return fraction of the work done in [0, 1], or None if the engine did not report it
+	def progress(self):
+		if not self.total:
+			return None
+		return min(1.0, self.done / self.total)
+
+
+class BackgroundRunner:
+	'''
+	Run one engine call at a time on a worker thread. The result is polled with
+	widget.after() so the callbacks always run on the Tk event loop. Submitting a
+	new call cancels the running one.
+	'''
+	def __init__(self, widget, pollMs=50):
+		self.widget = widget
+		self.pollMs = pollMs
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+		self.future = None
+		self.token = None
+		self.onDone = None
+		self.onError = None
+		self.onProgress = None
+
+	# @param func, called on the worker thread as func(token)
+	# @param onDone, called on the Tk thread with the return value of func
+	# @param onError, called on the Tk thread with the exception raised by func, Cancelled included
+	# @param onProgress, called on the Tk thread on every poll with token.progress()
+	# @return the CancelToken of the submitted call
+	def submit(self, func, onDone, onError=None, onProgress=None):
+		self.cancel()
+		token = CancelToken()
+		self.token = token
+		self.onDone = onDone
+		self.onError = onError
+		self.onProgress = onProgress
+		self.future = self.executor.submit(func, token)
+		self.widget.after(self.pollMs, self.poll, self.future)
+		return token
+
+	def isRunning(self):
+		return self.future is not None and not self.future.done()
+
+	def cancel(self):
+		if self.token is not None:
+			self.token.cancel()
+
+	def poll(self, future):
+		if future is not self.future:
+			return		# A newer call replaced this one, drop its result
+		if not future.done():
+			if self.onProgress is not None:
+				self.onProgress(self.token.progress())
+			self.widget.after(self.pollMs, self.poll, future)
+			return
+		self.future = None
+		self.token = None
+		error = future.exception()
+		if error is None:
+			self.onDone(future.result())
+		elif self.onError is not None:
+			self.onError(error)
+		else:
+			raise error
+
+	def shutdown(self):
+		self.cancel()
+		self.executor.shutdown(wait=False)